@@ -1,14 +1,62 @@
 # app.py
 import os
+import json
+import asyncio
+import time
+import base64
+import gzip
+import hashlib
+import atexit
 import uuid
+import random
 import logging
-from datetime import datetime, timedelta
-from collections import Counter
+import tempfile
+import sqlite3
+import multiprocessing
+from io import BytesIO
+import bisect
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from collections import Counter, OrderedDict, defaultdict, deque
 from flask import (
     Flask, render_template, request, jsonify, send_from_directory,
-    redirect, url_for, flash, make_response
+    redirect, url_for, flash, make_response, Request, g, has_request_context
 )
-from supabase import create_client, Client
+import click
+import httpx
+from supabase import create_client, Client, ClientOptions
+from supabase._async.client import create_client as acreate_client
+from gotrue._async.storage import AsyncMemoryStorage
+
+from local_store import LocalStore
+import instrumentation
+from instrumentation import (
+    HTTP_LATENCY, SUPABASE_LATENCY, UPLOAD_BYTES, UPLOAD_FILES, CACHE_LOOKUPS, FALLBACKS,
+    StackSampler, profile_path,
+)
+
+try:  # optional: without Pillow uploads simply get no derivatives
+    import imaging
+except ImportError:
+    imaging = None
+
+try:  # optional: faster JSON encoding for cached response bodies
+    import orjson
+except ImportError:
+    orjson = None
+
+try:  # optional: brotli variants next to gzip
+    import brotli
+except ImportError:
+    brotli = None
+
+try:  # Unix only; used to report peak memory on /health
+    import resource
+except ImportError:
+    resource = None
 
 # ---------- Basic logging ----------
 logging.basicConfig(level=logging.INFO)
@@ -38,46 +86,401 @@ SUPABASE_KEY = (
     or None
 )
 
+# Every Supabase call goes through SupabaseGateway. The client's HTTP sessions
+# are kept alive between requests (one pool per worker, limits below); each
+# attempt has a timeout and each call a deadline, so a hung Supabase can't
+# hold a gunicorn worker for the client's default two minutes. Reads are
+# retried with jittered backoff; writes are not (an insert that timed out may
+# have landed). After SUPABASE_BREAKER_FAILURES consecutive transport/5xx
+# failures the breaker opens and calls fail fast for SUPABASE_BREAKER_COOLDOWN
+# seconds, then a single trial call decides whether it closes again. While it
+# is open, catalog reads come from the local replica / last cached snapshot.
+SUPABASE_TIMEOUT = float(os.environ.get("SUPABASE_TIMEOUT", "5"))            # per attempt, seconds
+SUPABASE_STORAGE_TIMEOUT = float(os.environ.get("SUPABASE_STORAGE_TIMEOUT", "30"))
+SUPABASE_DEADLINE = float(os.environ.get("SUPABASE_DEADLINE", "10"))         # per call, retries included
+SUPABASE_RETRIES = int(os.environ.get("SUPABASE_RETRIES", "2"))
+SUPABASE_POOL_SIZE = int(os.environ.get("SUPABASE_POOL_SIZE", "10"))
+SUPABASE_BREAKER_FAILURES = int(os.environ.get("SUPABASE_BREAKER_FAILURES", "5"))
+SUPABASE_BREAKER_COOLDOWN = float(os.environ.get("SUPABASE_BREAKER_COOLDOWN", "30"))
+
+IDEMPOTENT_RPCS = {"download_buckets"}
+IDEMPOTENT_STORAGE = {"download", "list", "get_public_url", "create_signed_url"}
+WRITE_VERBS = {"insert", "upsert", "update", "delete"}
+
+class SupabaseUnavailable(Exception):
+    """Raised without calling Supabase while the circuit breaker is open."""
+
+def is_transient_error(e) -> bool:
+    """Network trouble or a 5xx: worth retrying, and counts against the breaker.
+
+    4xx-style errors (bad filter, missing RPC, duplicate key) mean Supabase
+    answered, so they are neither retried nor counted.
+    """
+    if isinstance(e, (httpx.TransportError, SupabaseUnavailable)):
+        return True
+    if isinstance(e, sqlite3.OperationalError):
+        return True   # the local store is busy or locked
+    status = getattr(e, "code", None)
+    if status is None and e.args and isinstance(e.args[0], dict):
+        status = e.args[0].get("statusCode")
+    return str(status or "").startswith("5")
+
+def is_missing_function_error(e) -> bool:
+    """An RPC whose Postgres function doesn't exist (PostgREST PGRST202, Postgres 42883)."""
+    code = getattr(e, "code", None)
+    if code is None and e.args and isinstance(e.args[0], dict):
+        code = e.args[0].get("code")
+    if str(code) in ("PGRST202", "42883"):
+        return True
+    message = str(e)
+    return "function" in message and ("does not exist" in message or "Could not find" in message)
+
+class SupabaseGateway:
+    """The Supabase client behind deadlines, read retries and a circuit breaker.
+
+    Exposes the same table()/rpc()/storage surface, so call sites don't change;
+    execute() and storage calls are routed through call(), which also times
+    them per table/bucket and operation. Under asgi.py the async client is
+    attached as .aclient: aexecute() runs a query on it with the same
+    breaker, retries and stats.
+    """
+    def __init__(self, client, deadline=SUPABASE_DEADLINE, retries=SUPABASE_RETRIES,
+                 failure_threshold=SUPABASE_BREAKER_FAILURES, cooldown=SUPABASE_BREAKER_COOLDOWN):
+        self.client = client
+        self.aclient = None
+        self.deadline = deadline
+        self.retries = retries
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.calls = 0
+        self.failures = 0
+        self.retried = 0
+        self.short_circuited = 0
+        self.last_error = None
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._latency = deque(maxlen=1000)   # seconds per attempt
+        self._lock = threading.Lock()
+
+    # supabase-client surface
+    def table(self, name: str):
+        return _GatewayBuilder(self, self.client.table(name), True, name, "query")
+
+    def rpc(self, fn: str, params=None):
+        return _GatewayBuilder(self, self.client.rpc(fn, params or {}), fn in IDEMPOTENT_RPCS, fn, "rpc")
+
+    @property
+    def storage(self):
+        return _GatewayStorage(self)
+
+    def _admit(self):
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = "half-open"
+            if self.state == "half-open" and not self._trial:
+                self._trial = True   # one trial call; everything else keeps failing fast
+                return
+            self.short_circuited += 1
+        FALLBACKS.labels("breaker_open").inc()
+        raise SupabaseUnavailable("Supabase circuit breaker is open")
+
+    def _record(self, seconds: float, error=None):
+        with self._lock:
+            self.calls += 1
+            self._latency.append(seconds)
+            self._trial = False
+            if error is None:
+                if self.state != "closed":
+                    log.info("Supabase reachable again; circuit breaker closed.")
+                self.state = "closed"
+                self._consecutive = 0
+                return
+            self.failures += 1
+            self._consecutive += 1
+            self.last_error = f"{type(error).__name__}: {error}"[:300]
+            if self.state == "half-open" or self._consecutive >= self.failure_threshold:
+                if self.state != "open":
+                    log.warning("Supabase failing (%s); circuit breaker open for %ss.", self.last_error, self.cooldown)
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+    def _retry_delay(self, error, attempt, deadline, idempotent, elapsed):
+        """Record a failed attempt; seconds to wait before retrying, or None to give up."""
+        transient = is_transient_error(error)
+        self._record(elapsed, error if transient else None)
+        if not (transient and idempotent) or attempt >= self.retries:
+            return None
+        delay = min(2.0, 0.1 * 2 ** attempt) * random.uniform(0.5, 1.5)
+        if time.monotonic() + delay >= deadline:
+            return None
+        with self._lock:
+            self.retried += 1
+        return delay
+
+    def call(self, fn, idempotent: bool, target="", operation=""):
+        """fn() with the breaker check, latency bookkeeping and, for reads, retries."""
+        start = time.monotonic()
+        outcome = "error"
+        try:
+            result = self._call(fn, idempotent)
+            outcome = "ok"
+            return result
+        except SupabaseUnavailable:
+            outcome = "rejected"
+            raise
+        finally:
+            observe_supabase_call(target, operation, outcome, time.monotonic() - start)
+
+    async def acall(self, fn, idempotent: bool, target="", operation=""):
+        """call() for a coroutine function."""
+        start = time.monotonic()
+        outcome = "error"
+        try:
+            result = await self._acall(fn, idempotent)
+            outcome = "ok"
+            return result
+        except SupabaseUnavailable:
+            outcome = "rejected"
+            raise
+        finally:
+            observe_supabase_call(target, operation, outcome, time.monotonic() - start)
+
+    def _call(self, fn, idempotent):
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            self._admit()
+            start = time.monotonic()
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, deadline, idempotent, time.monotonic() - start)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._record(time.monotonic() - start)
+            return result
+
+    async def _acall(self, fn, idempotent):
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            self._admit()
+            start = time.monotonic()
+            try:
+                result = await fn()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, deadline, idempotent, time.monotonic() - start)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self._record(time.monotonic() - start)
+            return result
+
+    async def aexecute(self, query):
+        """await query(db).execute() on the async client, e.g. query = lambda db: db.table(...).select(...)."""
+        return await query(_AsyncGateway(self)).execute()
+
+    def stats(self):
+        with self._lock:
+            samples = sorted(self._latency)
+            return {
+                "state": self.state,
+                "calls": self.calls,
+                "failures": self.failures,
+                "consecutive_failures": self._consecutive,
+                "retries": self.retried,
+                "short_circuited": self.short_circuited,
+                "last_error": self.last_error,
+                "latency_ms": {
+                    "p50": round(samples[len(samples) // 2] * 1000, 1) if samples else None,
+                    "p95": round(samples[int(len(samples) * 0.95)] * 1000, 1) if samples else None,
+                    "max": round(samples[-1] * 1000, 1) if samples else None,
+                },
+                "timeout": SUPABASE_TIMEOUT,
+                "deadline": self.deadline,
+            }
+
+def observe_supabase_call(target, operation, outcome, seconds):
+    SUPABASE_LATENCY.labels(target or "-", operation or "-", outcome).observe(seconds)
+    if has_request_context():
+        # per-request totals for the slow request log
+        g.supabase_calls = g.get("supabase_calls", 0) + 1
+        g.supabase_seconds = g.get("supabase_seconds", 0.0) + seconds
+
+class _GatewayBuilder:
+    """Wraps a postgrest request builder; chained calls stay wrapped.
+
+    target is the table or function name, operation the verb (select,
+    insert, ... or rpc) and label the metrics.
+    """
+    def __init__(self, gateway, builder, idempotent, target, operation, asynchronous=False):
+        self._gateway = gateway
+        self._builder = builder
+        self._idempotent = idempotent
+        self._target = target
+        self._operation = operation
+        self._asynchronous = asynchronous
+
+    def execute(self):
+        call = self._gateway.acall if self._asynchronous else self._gateway.call
+        return call(self._builder.execute, self._idempotent, self._target, self._operation)
+
+    def __getattr__(self, name):
+        attr = getattr(self._builder, name)
+        if not callable(attr):
+            return attr
+        idempotent = self._idempotent and name not in WRITE_VERBS
+        operation = name if name == "select" or name in WRITE_VERBS else self._operation
+        def chained(*args, **kwargs):
+            return _GatewayBuilder(
+                self._gateway, attr(*args, **kwargs), idempotent,
+                self._target, operation, self._asynchronous,
+            )
+        return chained
+
+class _AsyncGateway:
+    """table()/rpc() on the gateway's async client; execute() returns a coroutine."""
+    def __init__(self, gateway):
+        self._gateway = gateway
+
+    def table(self, name: str):
+        return _GatewayBuilder(self._gateway, self._gateway.aclient.table(name), True, name, "query", True)
+
+    def rpc(self, fn: str, params=None):
+        aclient = self._gateway.aclient
+        return _GatewayBuilder(self._gateway, aclient.rpc(fn, params or {}), fn in IDEMPOTENT_RPCS, fn, "rpc", True)
+
+class _GatewayStorage:
+    def __init__(self, gateway):
+        self._gateway = gateway
+
+    def from_(self, bucket: str):
+        return _GatewayBucket(self._gateway, self._gateway.client.storage.from_(bucket), bucket)
+
+class _GatewayBucket:
+    def __init__(self, gateway, bucket, name):
+        self._gateway = gateway
+        self._bucket = bucket
+        self._name = name
+
+    def __getattr__(self, name):
+        attr = getattr(self._bucket, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            return self._gateway.call(
+                lambda: attr(*args, **kwargs), name in IDEMPOTENT_STORAGE, f"storage:{self._name}", name
+            )
+        return call
+
+def _client_options(**kwargs):
+    return ClientOptions(
+        postgrest_client_timeout=SUPABASE_TIMEOUT,
+        storage_client_timeout=SUPABASE_STORAGE_TIMEOUT,
+        **kwargs,
+    )
+
+def _pool_postgrest(client):
+    """Swap the postgrest session for one with explicit pool limits and timeout.
+
+    Works for the sync and the async client; the replaced session has not
+    opened a connection yet.
+    """
+    pg = client.postgrest
+    old = pg.session
+    pg.session = type(old)(
+        base_url=old.base_url,
+        headers=old.headers,
+        timeout=SUPABASE_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=SUPABASE_POOL_SIZE,
+            max_keepalive_connections=SUPABASE_POOL_SIZE,
+            keepalive_expiry=60,
+        ),
+        http2=True,
+        follow_redirects=True,
+    )
+
 def init_supabase():
     if not SUPABASE_URL or not SUPABASE_KEY:
         log.warning("SUPABASE_URL or SUPABASE_KEY not configured; Supabase client won't be available.")
         return None
     try:
-        client: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+        client: Client = create_client(SUPABASE_URL, SUPABASE_KEY, options=_client_options())
+        _pool_postgrest(client)
         log.info("Supabase client initialized.")
-        return client
+        return SupabaseGateway(client)
     except Exception as e:
         log.exception("Failed to initialize Supabase client: %s", e)
         return None
 
 supabase = init_supabase()
+
+async def init_async_supabase():
+    """Attach an async client to the gateway (asgi.py calls this in each worker)."""
+    if not isinstance(supabase, SupabaseGateway) or not (SUPABASE_URL and SUPABASE_KEY):
+        return None
+    client = await acreate_client(SUPABASE_URL, SUPABASE_KEY, _client_options(storage=AsyncMemoryStorage()))
+    _pool_postgrest(client)
+    supabase.aclient = client
+    log.info("Async Supabase client initialized.")
+    return client
 BUCKET_NAME = os.environ.get("BUCKET_NAME", "wallpapers")  # ensure this bucket exists & is public if you plan to use get_public_url
 
-# ---------- Small local JSON fallback (for reads) ----------
-# This lets read endpoints work if Supabase is temporarily unavailable.
+# ---------- Local store (SQLite) ----------
+# Without Supabase credentials everything runs on local_store: SQLite in WAL
+# mode behind the same query surface as the Supabase client, with files kept
+# under UPLOAD_FOLDER. With Supabase it is a read replica: catalog reads are
+# mirrored into it and served from it while Supabase can't be reached.
+# database.json, the previous fallback, is imported on first open.
 DB_JSON = "database.json"
+LOCAL_DB = os.environ.get("LOCAL_DB", "vault.sqlite3")
 
-def load_database():
+def init_local_store():
     try:
-        with open(DB_JSON, "r") as f:
-            return json.load(f)
-    except Exception:
-        return {"wallpapers": [], "downloads": []}
+        store = LocalStore(LOCAL_DB, UPLOAD_FOLDER, seed_json=DB_JSON)
+        log.info("Local store opened at %s.", LOCAL_DB)
+        return store
+    except Exception as e:
+        log.exception("Failed to open local store %s: %s", LOCAL_DB, e)
+        return None
 
-def save_database(data):
-    with open(DB_JSON, "w") as f:
-        json.dump(data, f, indent=2)
+local_store = init_local_store()
+if supabase is None:
+    supabase = local_store
+
+def using_local_store() -> bool:
+    return supabase is not None and supabase is local_store
 
 # ---------- Helpers ----------
 def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def is_uuid(value) -> bool:
+    try:
+        uuid.UUID(str(value))
+    except ValueError:
+        return False
+    return True
+
 def public_storage_url(path: str) -> str:
     """
     Construct the conventional public storage URL:
     https://<project>.supabase.co/storage/v1/object/public/<bucket>/<path>
     (This is stable and works when the bucket is public.)
+    On the local store objects are plain static files.
     """
+    if using_local_store():
+        return f"/{UPLOAD_FOLDER}/{path}"
     return f"{SUPABASE_URL.rstrip('/')}/storage/v1/object/public/{BUCKET_NAME}/{path}"
 
 def _res_error(resp):
@@ -92,53 +495,2223 @@ def _res_error(resp):
     # some SDK calls return objects with 'status_code' and 'data'
     return None
 
-# ---------- Routes ----------
-@app.route("/")
-def index():
-    device_type = request.args.get("device", "mobile")
-    wallpapers = []
+# ---------- Catalog cache ----------
+# Every read route needs the wallpaper rows for one device type. Instead of a
+# full-table round trip per page view, rows are cached per key with a TTL and a
+# version. Uploads/deletes bump the version; the bump is also written to a small
+# stamp file (replaced atomically), so every gunicorn worker on the host sees it
+# on its next lookup at the cost of one stat() call.
+CATALOG_CACHE_TTL = float(os.environ.get("CATALOG_CACHE_TTL", "60"))
+CATALOG_CACHE_SIZE = int(os.environ.get("CATALOG_CACHE_SIZE", "64"))
+# Response bodies are keyed by user input (search terms, cursors), so they get
+# their own bound; a burst of distinct queries can't evict the catalog rows.
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "256"))
+CATALOG_STAMP_FILE = os.environ.get(
+    "CATALOG_STAMP_FILE", os.path.join(tempfile.gettempdir(), "amoled-vault-catalog.stamp")
+)
 
-    if supabase:
+ETAG_SALT = os.environ.get("RENDER_GIT_COMMIT", "")   # a new deploy gets new validators
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha1(ETAG_SALT.encode() + data).hexdigest()
+
+def content_etag(value) -> str:
+    """Strong ETag (hex digest) for a JSON-serialisable value.
+
+    Pre-encoded bodies inside value contribute their own etag.
+    """
+    body = json.dumps(value, sort_keys=True, separators=(",", ":"), default=lambda o: getattr(o, "etag", None) or str(o))
+    return _digest(body.encode())
+
+class CatalogCache:
+    def __init__(self, ttl: float, max_entries: int, stamp_file: str, parent=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stamp_file = stamp_file
+        self.parent = parent
+        self._children = []
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._local_version = 0
+        self._entries = OrderedDict()   # key -> (version, expires_at, value, validators)
+        self._modified = OrderedDict()  # key -> (etag, first seen), survives refills
+        self._lock = threading.Lock()
+
+    def _shared_stamp(self):
         try:
-            q = supabase.table("wallpapers").select("*")
-            if device_type in ("mobile", "pc"):
-                q = q.eq("device_type", device_type)
-            res = q.execute()
-            wallpapers = res.data or []
+            st = os.stat(self.stamp_file)
+            return (st.st_ino, st.st_mtime_ns)
+        except OSError:
+            return None
+
+    def scoped(self, max_entries: int, ttl: float = None):
+        """A separately bounded cache that shares this cache's version.
+
+        Its entries are invalidated by the same bump(), but filling it never
+        evicts anything from this cache. ttl defaults to this cache's.
+        """
+        child = CatalogCache(self.ttl if ttl is None else ttl, max_entries, self.stamp_file, parent=self)
+        self._children.append(child)
+        return child
+
+    def version(self):
+        """Current catalog version: this worker's counter + the shared stamp."""
+        if self.parent:
+            return self.parent.version()
+        return (self._local_version, self._shared_stamp())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def bump(self):
+        """Invalidate every cached entry here and in the other workers."""
+        if self.parent:
+            return self.parent.bump()
+        with self._lock:
+            self._local_version += 1
+            self._entries.clear()
+        for child in self._children:
+            child.clear()
+        tmp = f"{self.stamp_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write(f"{time.time_ns()} {os.getpid()}")
+            os.replace(tmp, self.stamp_file)
+        except OSError as e:
+            log.warning("Could not write catalog stamp %s: %s", self.stamp_file, e)
+
+    def get(self, key, loader):
+        """Return the cached value for key, calling loader() on a miss.
+
+        If loader() fails and an expired entry is still held, that last good
+        value is returned instead (stale-if-error); otherwise the exception
+        propagates and nothing is cached.
+        """
+        version, now = self.version(), time.monotonic()
+        hit, entry = self._lookup(key, version, now)
+        if hit:
+            return entry[2]
+        try:
+            value = loader()
         except Exception as e:
-            log.exception("Error querying supabase wallpapers: %s", e)
-            wallpapers = []
-    else:
-        db = load_database()
-        wallpapers = db.get("wallpapers", [])
+            return self._stale_or_raise(key, entry, e)
+        self._store(key, version, now, value)
+        return value
+
+    def cached(self, key) -> bool:
+        """True if key holds a current entry (not counted as a hit or miss)."""
+        version, now = self.version(), time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            return bool(entry) and entry[0] == version and entry[1] > now
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def put(self, key, value, version):
+        """Store a value loaded outside get() (asgi.py), under the version read before loading it."""
+        self._store(key, version, time.monotonic(), value)
+
+    def _lookup(self, key, version, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == version and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                CACHE_LOOKUPS.labels("hit").inc()
+                return True, entry
+            self.misses += 1
+        CACHE_LOOKUPS.labels("miss").inc()
+        return False, entry
+
+    def _stale_or_raise(self, key, entry, error):
+        if not entry:
+            raise error
+        with self._lock:
+            self.stale += 1
+        FALLBACKS.labels("stale_cache").inc()
+        log.warning("Catalog load for %s failed, serving the last good copy: %s", key, error)
+        return entry[2]
+
+    def _store(self, key, version, now, value):
+        with self._lock:
+            self._entries[key] = (version, now + self.ttl, value, None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def validators(self, key, value):
+        """(etag, last_modified) for a value just returned by get(key, ...).
+
+        The ETag is a hash of the content, computed once per fill, so it is the
+        same in every worker holding the same rows. Last-Modified is when this
+        worker first saw that content. Returns None if value is not what the
+        cache currently holds for key (e.g. a fallback after a failed load).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry or entry[2] is not value:
+                return None
+            if entry[3]:
+                return entry[3]
+        etag = content_etag(value)
+        with self._lock:
+            seen = self._modified.get(key)
+            if not seen or seen[0] != etag:
+                seen = (etag, datetime.now(timezone.utc).replace(microsecond=0))
+            self._modified[key] = seen
+            self._modified.move_to_end(key)
+            while len(self._modified) > self.max_entries:
+                self._modified.popitem(last=False)
+            entry = self._entries.get(key)
+            if entry and entry[2] is value:
+                self._entries[key] = entry[:3] + (seen,)
+        return seen
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "entries": len(self._entries),
+            "stale_served": self.stale,
+            "ttl": self.ttl,
+        }
+
+catalog_cache = CatalogCache(CATALOG_CACHE_TTL, CATALOG_CACHE_SIZE, CATALOG_STAMP_FILE)
+response_cache = catalog_cache.scoped(RESPONSE_CACHE_SIZE)   # encoded pages, bootstrap states
+
+def read_with_replica(query, device_type=None):
+    """query(client) against Supabase, or against the local replica if that fails.
+
+    The replica only answers once it holds a mirror of device_type's catalog;
+    before that the error propagates (and catalog_cache serves its last good
+    copy, if any) rather than an empty result.
+    """
+    try:
+        return query(supabase)
+    except Exception as e:
+        if local_store is None or supabase is local_store or not local_store.mirrored(device_type):
+            raise
+        FALLBACKS.labels("replica").inc()
+        log.warning("Supabase read failed, serving from the local replica: %s", e)
+        return query(local_store)
+
+def wallpapers_query(db, device_type: str):
+    q = db.table("wallpapers").select("*")
+    if device_type in ("mobile", "pc"):
+        q = q.eq("device_type", device_type)
+    return q
+
+def replica_wallpapers(device_type: str, error):
+    """Catalog rows from the local replica after a failed Supabase read (or re-raise)."""
+    if not local_store.mirrored(device_type):
+        raise error
+    FALLBACKS.labels("replica").inc()
+    log.warning("Supabase read failed, serving from the local replica: %s", error)
+    return wallpapers_query(local_store, device_type).execute().data or []
+
+# Mirroring rewrites a device's rows in SQLite (seconds at 100k rows), so it
+# runs on a background thread: reads hand over their rows and return at once.
+# Several reads within REPLICA_MIRROR_DELAY are coalesced (the newest rows win),
+# and rows whose digest matches the last mirror are not written again, so an
+# unchanged catalog costs one hash per worker instead of a table rewrite.
+REPLICA_MIRROR_DELAY = float(os.environ.get("REPLICA_MIRROR_DELAY", "2"))
+
+def _rows_digest(rows) -> str:
+    return _digest(json.dumps(rows, sort_keys=True, separators=(",", ":"), default=str).encode())
+
+class ReplicaMirror:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.mirrored = 0
+        self.skipped = 0
+        self._pending = {}   # device_type -> newest rows not yet mirrored
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        # started lazily (and again after a fork) so gunicorn --preload is safe
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="replica-mirror", daemon=True)
+            self._thread.start()
+
+    def submit(self, device_type: str, rows):
+        with self._lock:
+            self._pending[device_type] = rows
+        self._ensure_thread()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.delay)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for device_type, rows in pending.items():
+            try:
+                if local_store.mirror_wallpapers(device_type, rows, digest=_rows_digest(rows)):
+                    self.mirrored += 1
+                else:
+                    self.skipped += 1
+            except Exception as e:
+                log.warning("Could not update the local replica: %s", e)
+
+    def stats(self):
+        return {"mirrored": self.mirrored, "skipped": self.skipped, "pending": len(self._pending)}
+
+replica_mirror = ReplicaMirror(REPLICA_MIRROR_DELAY)
+
+def mirror_catalog(device_type: str, rows):
+    """Queue rows for the local replica; see ReplicaMirror."""
+    replica_mirror.submit(device_type, rows)
+
+def _query_wallpapers(device_type: str, replica: bool = True):
+    if local_store is None or using_local_store():
+        return wallpapers_query(supabase, device_type).execute().data or []
+    try:
+        rows = wallpapers_query(supabase, device_type).execute().data or []
+    except Exception as e:
+        if not replica:
+            raise
+        return replica_wallpapers(device_type, e)
+    mirror_catalog(device_type, rows)
+    return rows
+
+def catalog_key(device_type: str):
+    return ("wallpapers", device_type if device_type in ("mobile", "pc") else "all")
+
+def load_catalog(device_type: str):
+    """Cached wallpaper rows for a device type ("mobile", "pc", anything else = all).
+
+    The returned list is shared between requests; callers must not mutate it.
+    Query errors propagate; get_catalog() is the forgiving variant.
+    """
+    key = catalog_key(device_type)
+    return catalog_cache.get(key, lambda: _query_wallpapers(key[1]))
+
+def get_catalog(device_type: str):
+    """load_catalog(), or [] if the catalog can't be loaded."""
+    try:
+        return load_catalog(device_type)
+    except Exception as e:
+        FALLBACKS.labels("empty_catalog").inc()
+        if is_transient_error(e):
+            log.warning("Supabase unavailable, no catalog to serve: %s", e)
+        else:
+            log.exception("Error querying wallpapers: %s", e)
+        return []
+
+# ---------- Search index ----------
+# In-memory n-gram index over title and category. Two and three character
+# queries hit one posting list directly; longer ones intersect their trigram
+# postings and verify the survivors, so a search touches only the rows that
+# can match (a single character matches most of the catalog anyway and is
+# answered by a scan). A sorted term list answers autocomplete prefixes by bisect.
+# The index follows the catalog version: local uploads/deletes patch it in
+# place, a bump from another worker triggers one rebuild on the next query.
+SEARCH_FIELDS = ("title", "category")
+SEARCH_FUZZY_MIN_LEN = 4
+
+def _grams(text: str, n: int = 3):
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+def _all_grams(text: str):
+    return _grams(text, 2) | _grams(text, 3)
+
+def _edit_distance(a: str, b: str, limit: int) -> int:
+    """Edit distance counting adjacent transpositions as one edit; gives up
+    (returning limit + 1) as soon as the distance must exceed limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            d = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+            if prev2 is not None and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                d = min(d, prev2[j - 2] + 1)
+            cur.append(d)
+        if min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+class SearchIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._version = None
+        self._docs = {}                     # id -> row
+        self._text = {}                     # id -> {field: lowercased text}
+        self._postings = {f: defaultdict(set) for f in SEARCH_FIELDS}
+        self._terms = []                    # sorted [(term, kind)]
+        self._term_ids = defaultdict(set)   # (term, kind) -> ids
+
+    # -- maintenance --
+    def _add(self, row):
+        wid = row.get("id")
+        if not wid:
+            return
+        if wid in self._docs:
+            self._remove(wid)
+        text = {f: (row.get(f) or "").strip().lower() for f in SEARCH_FIELDS}
+        self._docs[wid] = row
+        self._text[wid] = text
+        for f in SEARCH_FIELDS:
+            for gram in _all_grams(text[f]):
+                self._postings[f][gram].add(wid)
+        for term in self._row_terms(row):
+            if not self._term_ids[term]:
+                bisect.insort(self._terms, term)
+            self._term_ids[term].add(wid)
+
+    def _remove(self, wid):
+        row = self._docs.pop(wid, None)
+        text = self._text.pop(wid, None)
+        if row is None:
+            return
+        for f in SEARCH_FIELDS:
+            for gram in _all_grams(text[f]):
+                ids = self._postings[f].get(gram)
+                if ids is not None:
+                    ids.discard(wid)
+                    if not ids:
+                        del self._postings[f][gram]
+        for term in self._row_terms(row):
+            ids = self._term_ids.get(term)
+            if ids is None:
+                continue
+            ids.discard(wid)
+            if not ids:
+                del self._term_ids[term]
+                i = bisect.bisect_left(self._terms, term)
+                if i < len(self._terms) and self._terms[i] == term:
+                    del self._terms[i]
+
+    @staticmethod
+    def _row_terms(row):
+        title = (row.get("title") or "").strip()
+        category = (row.get("category") or "").strip()
+        terms = set()
+        if title:
+            terms.add((title.lower(), "title"))
+        if category:
+            terms.add((category.lower(), "category"))
+        return terms
+
+    def rebuild(self, rows, version):
+        with self._lock:
+            self._reset()
+            for row in rows:
+                self._add(row)
+            self._version = version
+
+    def apply(self, added, removed, before, after):
+        """Patch the index for a local catalog change (before/after = catalog versions)."""
+        with self._lock:
+            if self._version != before:
+                return   # already stale; the next query rebuilds
+            for wid in removed:
+                self._remove(wid)
+            for row in added:
+                self._add(row)
+            self._version = after
+
+    def _ensure_current(self):
+        version = catalog_cache.version()
+        if version != self._version:
+            rows = catalog_cache.get(("wallpapers", "all"), lambda: _query_wallpapers("all"))
+            self.rebuild(rows, version)
+
+    # -- queries --
+    def _candidates(self, field, q):
+        if len(q) == 1:
+            return {wid for wid, text in self._text.items() if q in text[field]}
+        postings = self._postings[field]
+        grams = [q] if len(q) <= 3 else sorted(_grams(q), key=lambda gram: len(postings.get(gram, ())))
+        result = None
+        for gram in grams:
+            ids = postings.get(gram)
+            if not ids:
+                return set()
+            result = set(ids) if result is None else result & ids
+            if not result:
+                break
+        return {wid for wid in result or () if q in self._text[wid][field]}
+
+    def _fuzzy_candidates(self, q, limit):
+        # each edit breaks at most three bigrams (a transposition: "space" ->
+        # "spcae"), so a match shares the rest; short queries may share none
+        grams = _grams(q, 2)
+        need = len(grams) - 3 * limit
+        counts = Counter()
+        if need <= 0:
+            counts.update(dict.fromkeys(self._text, 0))
+        for f in SEARCH_FIELDS:
+            for gram in grams:
+                for wid in self._postings[f].get(gram, ()):
+                    counts[wid] += 1
+        matched = {}
+        for wid, shared in counts.items():
+            if shared < need:
+                continue
+            for rank, f in enumerate(SEARCH_FIELDS):
+                words = self._text[wid][f].split()
+                if any(_edit_distance(q, w[:len(q) + limit], limit) <= limit for w in words):
+                    matched[wid] = min(matched.get(wid, 9), 5 + rank)
+                    break
+        return matched
+
+    def search(self, q, device_type="all", category="all", fuzzy=False):
+        """Ranked rows matching q: title prefix, title word prefix, title substring,
+        then category matches, then (fuzzy) near misses; ties by downloads."""
+        q = q.strip().lower()
+        if not q:
+            return []
+        with self._lock:
+            self._ensure_current()
+            rank = {}
+            for wid in self._candidates("title", q):
+                t = self._text[wid]["title"]
+                rank[wid] = 0 if t.startswith(q) else 1 if f" {q}" in t else 2
+            for wid in self._candidates("category", q):
+                rank.setdefault(wid, 3 if self._text[wid]["category"].startswith(q) else 4)
+            if fuzzy and len(q) >= SEARCH_FUZZY_MIN_LEN:
+                for wid, r in self._fuzzy_candidates(q, 1 if len(q) < 7 else 2).items():
+                    rank.setdefault(wid, r)
+            rows = [self._docs[wid] for wid in rank]
         if device_type in ("mobile", "pc"):
-            wallpapers = [w for w in wallpapers if w.get("device_type", "mobile") == device_type]
-
-    # categories
-    categories = sorted({w.get("category", "") for w in wallpapers if w.get("category")})
-
-    # latest 5
-    latest_wallpapers = sorted(
-        wallpapers, key=lambda x: x.get("upload_date") or "", reverse=True
-    )[:5]
-
-    # popular top 6
-    popular_wallpapers = sorted(
-        wallpapers,
-        key=lambda x: int(x.get("download_count") or 0),
-        reverse=True
-    )[:6]
-
-    return render_template(
-        "index.html",
-        wallpapers=wallpapers,
-        categories=categories,
-        latest_wallpapers=latest_wallpapers,
-        popular_wallpapers=popular_wallpapers,
-        instagram_url=INSTAGRAM_URL,
-        current_device=device_type
+            rows = [w for w in rows if w.get("device_type", "mobile") == device_type]
+        if category != "all":
+            rows = [w for w in rows if (w.get("category") or "").lower() == category.lower()]
+        rows.sort(key=lambda w: (rank[w["id"]], -int(w.get("download_count") or 0), w.get("title") or ""))
+        return rows
+
+    def suggest(self, prefix, device_type="all", limit=8):
+        """Titles and categories starting with prefix, via bisect on the sorted term list."""
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        out = []
+        with self._lock:
+            self._ensure_current()
+            i = bisect.bisect_left(self._terms, (prefix, ""))
+            while i < len(self._terms) and len(out) < limit:
+                term, kind = self._terms[i]
+                if not term.startswith(prefix):
+                    break
+                ids = self._term_ids[(term, kind)]
+                rows = [self._docs[wid] for wid in ids]
+                if device_type in ("mobile", "pc"):
+                    rows = [w for w in rows if w.get("device_type", "mobile") == device_type]
+                if rows:
+                    out.append({"text": rows[0].get(kind), "type": kind, "count": len(rows)})
+                i += 1
+        return out
+
+search_index = SearchIndex()
+
+# ---------- Download index ----------
+# filename -> (file_path, category, id), so /download can redirect without a
+# database round trip. Versioned like the search index, except that a stale
+# index is rebuilt in the background: until it catches up (and for names it
+# doesn't know) downloads fall back to the one-row lookup instead of waiting
+# for the whole catalog.
+class FilenameIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._entries = {}   # filename -> (file_path, category, id)
+        self._rebuilding = False
+
+    @staticmethod
+    def entry(row):
+        filename = row.get("filename")
+        path = row.get("file_path") or f"{row.get('device_type') or 'mobile'}/{filename}"
+        return path, row.get("category") or "wallpaper", row.get("id")
+
+    def _add(self, row):
+        if row.get("filename"):
+            # linked duplicates share a filename; any of their rows will do
+            self._entries.setdefault(row["filename"], self.entry(row))
+
+    def rebuild(self, rows, version):
+        entries = {}
+        for row in rows:
+            if row.get("filename"):
+                entries.setdefault(row["filename"], self.entry(row))
+        with self._lock:
+            self._entries = entries
+            self._version = version
+
+    def apply(self, added, removed, before, after):
+        """Patch the index for a local catalog change (see SearchIndex.apply)."""
+        with self._lock:
+            if self._version != before:
+                return
+            if removed:
+                gone = set(removed)
+                self._entries = {f: e for f, e in self._entries.items() if e[2] not in gone}
+            for row in added:
+                self._add(row)
+            self._version = after
+
+    def _rebuild_in_background(self):
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+
+        def run():
+            try:
+                version = catalog_cache.version()
+                self.rebuild(load_catalog("all"), version)
+            except Exception as e:
+                log.warning("Could not build the download index: %s", e)
+            finally:
+                self._rebuilding = False
+        threading.Thread(target=run, name="filename-index", daemon=True).start()
+
+    def lookup(self, filename):
+        """Entry for filename; None if unknown or the index is behind the catalog."""
+        if self._version != catalog_cache.version():
+            self._rebuild_in_background()
+            return None
+        return self._entries.get(filename)
+
+filename_index = FilenameIndex()
+
+# ---------- Pagination ----------
+# /api/wallpapers pages with a keyset cursor over (upload_date, id), newest
+# first, so each page is one indexed range scan no matter how deep it is.
+PAGE_SIZE_DEFAULT = int(os.environ.get("PAGE_SIZE_DEFAULT", "60"))
+PAGE_SIZE_MAX = int(os.environ.get("PAGE_SIZE_MAX", "200"))
+WALLPAPER_FIELDS = (
+    "id", "title", "category", "device_type", "filename",
+    "file_path", "file_url", "upload_date", "download_count", "derivatives",
+)
+CURSOR_FIELDS = ("id", "upload_date")
+
+def encode_cursor(row) -> str:
+    raw = json.dumps([row.get("upload_date") or "", row.get("id") or ""], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    """Return (upload_date, id) or raise ValueError for a malformed cursor.
+
+    Both values end up inside a PostgREST filter, so the date must parse as
+    an ISO timestamp and the id as a UUID (returned in canonical form).
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        upload_date, wallpaper_id = json.loads(raw)
+        _parse_datetime(upload_date)
+        wallpaper_id = str(uuid.UUID(wallpaper_id))
+    except Exception:
+        raise ValueError("invalid cursor")
+    if not isinstance(upload_date, str):
+        raise ValueError("invalid cursor")
+    return upload_date, wallpaper_id
+
+def encode_offset_cursor(offset: int) -> str:
+    # ranked search results have no stable sort key, so they page by offset
+    return base64.urlsafe_b64encode(json.dumps({"o": offset}).encode()).decode().rstrip("=")
+
+def decode_offset_cursor(cursor: str) -> int:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        offset = int(json.loads(raw)["o"])
+    except Exception:
+        raise ValueError("invalid cursor")
+    if offset < 0:
+        raise ValueError("invalid cursor")
+    return offset
+
+def parse_fields(raw):
+    """Validated column list from a `fields=` parameter, or None for all columns."""
+    if not raw or raw.strip() == "*":
+        return None
+    fields = [f.strip() for f in raw.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in WALLPAPER_FIELDS]
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}")
+    return tuple(dict.fromkeys(fields))
+
+def parse_limit(raw) -> int:
+    try:
+        limit = int(raw)
+    except (TypeError, ValueError):
+        return PAGE_SIZE_DEFAULT
+    return max(1, min(limit, PAGE_SIZE_MAX))
+
+def _project(rows, fields):
+    if fields is None:
+        return rows
+    return [{f: w.get(f) for f in fields} for w in rows]
+
+def _query_page(device_type, category, fields, limit, cursor):
+    """One page of wallpapers plus the total match count on the first page."""
+    cols = "*"
+    if fields:
+        # rows projected to fields come back with derivatives None if the column is missing
+        selected = [f for f in fields if f != "derivatives" or derivatives_column()]
+        cols = ",".join(dict.fromkeys(tuple(selected) + CURSOR_FIELDS))
+
+    def query(db):
+        q = db.table("wallpapers").select(cols, count="exact" if cursor is None else None)
+        if device_type in ("mobile", "pc"):
+            q = q.eq("device_type", device_type)
+        if category != "all":
+            q = q.ilike("category", category)
+        if cursor is not None:
+            d, i = cursor
+            q = q.or_(f'upload_date.lt."{d}",and(upload_date.eq."{d}",id.lt."{i}")')
+        return q.order("upload_date", desc=True).order("id", desc=True).limit(limit + 1).execute()
+
+    res = read_with_replica(query, device_type)
+    rows, total = res.data or [], getattr(res, "count", None)
+
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return _project(rows[:limit], fields), next_cursor, total
+
+# ---------- Download counter (write-behind) ----------
+# /api/track-download only records the click in memory. A background thread
+# flushes on a size or time threshold: one bulk insert into `downloads`, then
+# one atomic increment per wallpaper through this Postgres function:
+#
+#   create or replace function increment_download_count(wid uuid, amount int)
+#   returns void language sql as $$
+#     update wallpapers set download_count = coalesce(download_count, 0) + amount
+#     where id = wid;
+#   $$;
+#
+# If the function is missing we fall back to read-then-update (still one write
+# per wallpaper per flush rather than per click). Only transient errors put
+# events back in the queue: rows Supabase rejects (a wallpaper deleted since,
+# a malformed id) are found by splitting the batch and dropped.
+DOWNLOAD_FLUSH_INTERVAL = float(os.environ.get("DOWNLOAD_FLUSH_INTERVAL", "2"))
+DOWNLOAD_FLUSH_SIZE = int(os.environ.get("DOWNLOAD_FLUSH_SIZE", "100"))
+DOWNLOAD_QUEUE_MAX = int(os.environ.get("DOWNLOAD_QUEUE_MAX", "10000"))
+
+class DownloadQueue:
+    def __init__(self, flush_interval: float, flush_size: int, max_pending: int):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_pending = max_pending
+        self.flushed_events = 0
+        self.failed_flushes = 0
+        self.dropped_events = 0
+        self._failed_at = 0.0
+        self._events = []
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._rpc_available = True
+
+    def _ensure_thread(self):
+        # started lazily (and again after a fork) so gunicorn --preload is safe
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="download-flusher", daemon=True)
+            self._thread.start()
+
+    def record(self, wallpaper_id: str, ip=None):
+        self._ensure_thread()
+        event = {"wallpaper_id": wallpaper_id, "ip": ip, "timestamp": datetime.now(timezone.utc).isoformat()}
+        if len(self._events) >= self.max_pending and time.monotonic() - self._failed_at >= self.flush_interval:
+            # queue is full (database down or far behind): apply backpressure,
+            # but don't retry a flush that just failed on every request
+            self.flush()
+        with self._lock:
+            self._events.append(event)
+            self._counts[wallpaper_id] += 1
+            pending = len(self._events)
+        if pending >= self.flush_size:
+            self._wake.set()
+        return event
+
+    def _requeue(self, events, counts):
+        with self._lock:
+            room = max(self.max_pending - len(self._events), 0)
+            if len(events) > room:
+                log.error("Download queue full; dropping %d events", len(events) - room)
+            self._events[:0] = events[:room]
+            self._counts.update(counts)
+
+    def _increment(self, wallpaper_id: str, amount: int):
+        if self._rpc_available:
+            try:
+                supabase.rpc("increment_download_count", {"wid": wallpaper_id, "amount": amount}).execute()
+                return
+            except Exception as e:
+                if not is_missing_function_error(e):
+                    raise   # Supabase is down or rejected this id; see flush()
+                log.warning("increment_download_count RPC unavailable, using read/update: %s", e)
+                FALLBACKS.labels("increment_read_update").inc()
+                self._rpc_available = False
+        current = supabase.table("wallpapers").select("download_count").eq("id", wallpaper_id).limit(1).execute()
+        if not current.data:
+            return
+        count = int(current.data[0].get("download_count") or 0) + amount
+        supabase.table("wallpapers").update({"download_count": count}).eq("id", wallpaper_id).execute()
+
+    def _insert(self, events):
+        """Bulk insert, splitting a rejected batch until the offending rows are found.
+
+        Returns (written, dropped, unwritten); unwritten is what was left,
+        in order, when a transient error stopped the insert.
+        """
+        written, dropped = [], []
+        batches = [events]   # a stack: the next batch in order is last
+        while batches:
+            batch = batches.pop()
+            try:
+                supabase.table("downloads").insert(batch).execute()
+            except Exception as e:
+                if is_transient_error(e):
+                    unwritten = batch + [ev for b in reversed(batches) for ev in b]
+                    log.warning("Could not flush %d download events, requeueing: %s", len(unwritten), e)
+                    return written, dropped, unwritten
+                if len(batch) == 1:
+                    log.error("Dropping download event %s: %s", batch[0], e)
+                    dropped.extend(batch)
+                else:
+                    batches += [batch[len(batch) // 2:], batch[:len(batch) // 2]]
+                continue
+            written.extend(batch)
+        return written, dropped, []
+
+    def flush(self) -> int:
+        """Write everything pending; returns the number of events written."""
+        with self._flush_lock:
+            with self._lock:
+                events, counts = self._events, self._counts
+                self._events, self._counts = [], Counter()
+            if not events and not counts:
+                return 0
+            if not supabase:
+                self._requeue(events, counts)
+                return 0
+            written, dropped, unwritten = self._insert(events) if events else ([], [], [])
+            if dropped:
+                self.dropped_events += len(dropped)
+                counts.subtract(Counter(ev["wallpaper_id"] for ev in dropped))
+                counts = +counts
+            if unwritten:
+                # Supabase is down: the counts wait with the events
+                self.failed_flushes += 1
+                self._failed_at = time.monotonic()
+                self._requeue(unwritten, counts)
+                self.flushed_events += len(written)
+                return len(written)
+            failed = Counter()
+            for wallpaper_id, amount in counts.items():
+                try:
+                    self._increment(wallpaper_id, amount)
+                except Exception as e:
+                    if not is_transient_error(e):
+                        log.error("Dropping %d download_count increments for %s: %s", amount, wallpaper_id, e)
+                        continue
+                    log.exception("Error incrementing download_count for %s: %s", wallpaper_id, e)
+                    failed[wallpaper_id] = amount
+            if failed:
+                self.failed_flushes += 1
+                self._failed_at = time.monotonic()
+                self._requeue([], failed)
+            self.flushed_events += len(written)
+            return len(written)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.exception("Download flusher error: %s", e)
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        self.flush()
+
+    def pending_events(self):
+        with self._lock:
+            return list(self._events)
+
+    @property
+    def flush_barrier(self):
+        """Lock that keeps flushes out while held (a flush in progress finishes first).
+
+        Read pending_events() and the tables under it and no event is in both.
+        """
+        return self._flush_lock
+
+    def stats(self):
+        return {
+            "pending": len(self._events),
+            "flushed_events": self.flushed_events,
+            "failed_flushes": self.failed_flushes,
+            "dropped_events": self.dropped_events,
+        }
+
+download_queue = DownloadQueue(DOWNLOAD_FLUSH_INTERVAL, DOWNLOAD_FLUSH_SIZE, DOWNLOAD_QUEUE_MAX)
+atexit.register(download_queue.close)
+
+# ---------- Download stats ----------
+# /api/stats is answered from running aggregates instead of re-reading and
+# re-parsing the downloads table: lifetime totals plus rolling windows made of
+# per-minute (24h) and per-hour (7d) ring buffers. Every counter is kept per
+# wallpaper, per device and per (device, category), so a stats read is a few
+# dict lookups. Seeding uses the already aggregated wallpapers.download_count
+# column plus one grouped query over the last 7 days:
+#
+#   create or replace function download_buckets(since timestamptz)
+#   returns table (wallpaper_id uuid, bucket timestamptz, downloads bigint)
+#   language sql stable as $$
+#     select wallpaper_id, date_trunc('minute', "timestamp"), count(*)
+#     from downloads where "timestamp" >= since group by 1, 2;
+#   $$;
+#
+# Each worker only sees the downloads it tracked itself, so aggregates are
+# re-seeded every STATS_RESEED_INTERVAL seconds and when another worker
+# changes the catalog. One thread reseeds while the others keep answering from
+# the current aggregates; a failed reseed keeps them too and is retried after
+# STATS_RETRY_INTERVAL seconds. Until the first seed succeeds there are no
+# aggregates to keep, so reads raise instead of answering zeros.
+STATS_RESEED_INTERVAL = float(os.environ.get("STATS_RESEED_INTERVAL", "300"))
+STATS_RETRY_INTERVAL = 5
+
+def empty_stats():
+    return {"total_downloads": 0, "total_wallpapers": 0, "downloads_24h": 0, "popular_categories": {}}
+
+def _parse_datetime(value) -> datetime:
+    """Aware UTC datetime for an ISO timestamp from Supabase (naive means UTC)."""
+    dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+def _parse_ts(value) -> float:
+    """Epoch seconds for an ISO timestamp from Supabase (naive means UTC)."""
+    return _parse_datetime(value).timestamp()
+
+class RollingWindow:
+    """Counts over the last `buckets * bucket_seconds` seconds, in a ring of buckets."""
+
+    def __init__(self, bucket_seconds: int, buckets: int):
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+        self.totals = Counter()             # aggregate key -> count inside the window
+        self._slots = [None] * buckets      # (bucket index, Counter of keys)
+        self._expired_through = None
+
+    def _expire(self, now: float):
+        cutoff = int(now // self.bucket_seconds) - self.buckets
+        start = cutoff - self.buckets + 1
+        if self._expired_through is not None:
+            start = max(start, self._expired_through + 1)
+        for b in range(start, cutoff + 1):
+            slot = self._slots[b % self.buckets]
+            if slot is not None and slot[0] == b:
+                self.totals.subtract(slot[1])
+                self._slots[b % self.buckets] = None
+        self._expired_through = cutoff if self._expired_through is None else max(self._expired_through, cutoff)
+
+    def add(self, keys, ts: float, n: int = 1, now: float = None):
+        now = time.time() if now is None else now
+        self._expire(now)
+        b = int(ts // self.bucket_seconds)
+        if b <= self._expired_through or ts > now + 60:
+            return
+        slot = self._slots[b % self.buckets]
+        if slot is None or slot[0] != b:
+            slot = (b, Counter())
+            self._slots[b % self.buckets] = slot
+        for key in keys:
+            slot[1][key] += n
+            self.totals[key] += n
+
+    def remove(self, keys):
+        """Drop everything counted for keys[0] (a wallpaper) from keys[1:] too."""
+        wallpaper_key = keys[0]
+        for slot in self._slots:
+            if slot is None:
+                continue
+            n = slot[1].pop(wallpaper_key, 0)
+            if n:
+                self.totals[wallpaper_key] -= n
+                for key in keys[1:]:
+                    slot[1][key] -= n
+                    self.totals[key] -= n
+
+    def get(self, key, now: float = None) -> int:
+        self._expire(time.time() if now is None else now)
+        return self.totals.get(key, 0)
+
+# Popular and trending rankings are kept next to the counters. "all" ranks by
+# lifetime downloads; the TRENDING_HALF_LIVES windows rank by exponentially
+# decayed scores. Those are stored forward-decayed: a download at t adds
+# 2 ** ((t - base) / half_life), so decay scales every score by the same
+# factor and a download only ever touches its own wallpaper's score. Each
+# aggregate key (device, device + category) keeps its best wallpapers in a
+# bounded min-heap (TopK), so a download costs one comparison with the heap
+# minimum and a ranking read is a slice of an already sorted list. A seed
+# ranks everything in one pass at the end instead.
+TRENDING_HALF_LIVES = {"24h": 6 * 3600, "7d": 42 * 3600}   # a download weighs 1/16 after 24h / 7d
+TRENDING_WINDOWS = ("24h", "7d", "all")
+TRENDING_TOP_K = 50
+TRENDING_REBASE = 64   # half-lives past base before scores are scaled back down
+
+class TopK:
+    """The largest (score, tiebreak, id) entries, at most one per id.
+
+    Up to 2 * k are kept, so removing a kept id only needs a refill once
+    fewer than k are left and some entry was evicted before.
+    """
+
+    def __init__(self, k: int):
+        self.k = k
+        self.capacity = 2 * k
+        self._heap = []         # min-heap: the entry to evict first is at [0]
+        self._entries = {}      # id -> its entry in the heap
+        self._sorted = None     # best first, rebuilt after a change
+        self._complete = True   # nothing evicted: every offered entry is kept
+
+    def offer(self, entry):
+        """Add an entry or raise one already kept; scores only go up."""
+        wid = entry[-1]
+        old = self._entries.get(wid)
+        if old is not None:
+            if old == entry:
+                return
+            self._heap[self._heap.index(old)] = entry
+            heapq.heapify(self._heap)
+        elif len(self._heap) < self.capacity and (self._complete or (self._heap and entry > self._heap[0])):
+            heapq.heappush(self._heap, entry)
+        elif self._heap and entry > self._heap[0]:
+            del self._entries[heapq.heapreplace(self._heap, entry)[-1]]
+            self._complete = False
+        else:
+            return
+        self._entries[wid] = entry
+        self._sorted = None
+
+    def remove(self, wid) -> bool:
+        """Drop an id; True if too few are left and the caller must refill()."""
+        entry = self._entries.pop(wid, None)
+        if entry is None:
+            return False
+        self._heap.remove(entry)
+        heapq.heapify(self._heap)
+        self._sorted = None
+        return not self._complete and len(self._heap) < self.k
+
+    def refill(self, entries):
+        """Replace the contents with the best of `entries` (a list of every candidate)."""
+        self._heap = heapq.nlargest(self.capacity, entries)
+        heapq.heapify(self._heap)
+        self._entries = {e[-1]: e for e in self._heap}
+        self._complete = len(entries) <= self.capacity
+        self._sorted = None
+
+    def rescale(self, factor: float):
+        # same factor for every score: the order and the heap shape hold
+        self._heap = [(e[0] * factor,) + e[1:] for e in self._heap]
+        self._entries = {e[-1]: e for e in self._heap}
+        self._sorted = None
+
+    def top(self, n: int):
+        if self._sorted is None:
+            self._sorted = sorted(self._heap, reverse=True)
+        return [e[-1] for e in self._sorted[:n]]
+
+class DecayedScores:
+    """Per-wallpaper download scores that halve every `half_life` seconds."""
+
+    def __init__(self, half_life: float, now: float = None):
+        self.half_life = half_life
+        self.base = time.time() if now is None else now
+        self.scores = {}   # wallpaper id -> score at `base`, times 2 ** ((t - base) / half_life)
+
+    def rebase(self, ts: float) -> float:
+        """Move base to ts once scores grow too large; the factor they were scaled by."""
+        if (ts - self.base) / self.half_life < TRENDING_REBASE:
+            return 1.0
+        factor = 2.0 ** ((self.base - ts) / self.half_life)
+        self.scores = {wid: score * factor for wid, score in self.scores.items()}
+        self.base = ts
+        return factor
+
+    def add(self, wallpaper_id, ts: float, n: int = 1) -> float:
+        score = self.scores.get(wallpaper_id, 0.0) + n * 2.0 ** ((ts - self.base) / self.half_life)
+        self.scores[wallpaper_id] = score
+        return score
+
+class DownloadStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seeding = threading.Lock()
+        self._version = None
+        self._seeded_at = 0.0
+        self._attempted_at = 0.0
+        self._reset()
+
+    def _reset(self):
+        self._meta = {}                         # wallpaper id -> (device, category)
+        self.lifetime = Counter()
+        self.categories = defaultdict(Counter)  # device -> category -> lifetime downloads
+        self.wallpaper_counts = Counter()       # ("d", device) -> number of wallpapers
+        self.last_24h = RollingWindow(60, 24 * 60)
+        self.last_7d = RollingWindow(3600, 7 * 24)
+        self._dates = {}                        # wallpaper id -> upload_date: ranking ties go to the newer
+        self.trending = {w: DecayedScores(h) for w, h in TRENDING_HALF_LIVES.items()}
+        self.rankings = {w: defaultdict(lambda: TopK(TRENDING_TOP_K)) for w in TRENDING_WINDOWS}
+
+    @staticmethod
+    def _keys(wallpaper_id, device, category):
+        return (("w", wallpaper_id), ("d", "all"), ("d", device), ("c", "all", category), ("c", device, category))
+
+    def _add_lifetime(self, keys, n):
+        for key in keys:
+            self.lifetime[key] += n
+        category = keys[3][2]
+        self.categories["all"][category] += n
+        self.categories[keys[2][1]][category] += n
+
+    def _score(self, window, wallpaper_id):
+        if window == "all":
+            return self.lifetime.get(("w", wallpaper_id), 0)
+        return self.trending[window].scores.get(wallpaper_id, 0.0)
+
+    def _rank(self, window, wallpaper_id, keys, score):
+        entry = (score, self._dates.get(wallpaper_id) or "", wallpaper_id)
+        for key in keys[1:]:
+            self.rankings[window][key].offer(entry)
+
+    def _refill(self, stale=None):
+        """Rebuild rankings from the scores: the (window, key) pairs in `stale`, or all."""
+        windows = TRENDING_WINDOWS if stale is None else {w for w, _ in stale}
+        candidates = {w: defaultdict(list) for w in windows}
+        for wid, meta in self._meta.items():
+            keys = self._keys(wid, *meta)[1:]
+            date = self._dates.get(wid) or ""
+            for window in windows:
+                score = self._score(window, wid)
+                # every wallpaper has a lifetime rank, only downloaded ones trend
+                if score or window == "all":
+                    entry, by_key = (score, date, wid), candidates[window]
+                    for key in keys:
+                        by_key[key].append(entry)
+        for window, by_key in candidates.items():
+            for key in (list(by_key) if stale is None else [k for w, k in stale if w == window]):
+                self.rankings[window][key].refill(by_key.get(key, []))
+
+    def _track(self, row, rank=True):
+        wid = row.get("id")
+        if not wid:
+            return
+        device = row.get("device_type") or "mobile"
+        category = row.get("category") or "uncategorized"
+        self._meta[wid] = (device, category)
+        self.wallpaper_counts[("d", "all")] += 1
+        self.wallpaper_counts[("d", device)] += 1
+        self._dates[wid] = row.get("upload_date")
+        keys = self._keys(wid, device, category)
+        self._add_lifetime(keys, int(row.get("download_count") or 0))
+        if rank:
+            self._rank("all", wid, keys, self.lifetime[("w", wid)])
+
+    def _untrack(self, wallpaper_id):
+        """Forget a wallpaper; returns the (window, key) rankings that need a refill."""
+        meta = self._meta.pop(wallpaper_id, None)
+        if meta is None:
+            return set()
+        device, category = meta
+        self.wallpaper_counts[("d", "all")] -= 1
+        self.wallpaper_counts[("d", device)] -= 1
+        keys = self._keys(wallpaper_id, device, category)
+        self.last_24h.remove(keys)
+        self.last_7d.remove(keys)
+        self._add_lifetime(keys, -self.lifetime.get(("w", wallpaper_id), 0))
+        self.lifetime.pop(("w", wallpaper_id), None)
+        self._dates.pop(wallpaper_id, None)
+        for scores in self.trending.values():
+            scores.scores.pop(wallpaper_id, None)
+        return {
+            (window, key) for window, rankings in self.rankings.items()
+            for key in keys[1:] if key in rankings and rankings[key].remove(wallpaper_id)
+        }
+
+    def _add_event(self, wallpaper_id, ts, n=1, lifetime=True, rank=True):
+        meta = self._meta.get(wallpaper_id)
+        if meta is None:
+            return
+        keys = self._keys(wallpaper_id, *meta)
+        if lifetime:
+            self._add_lifetime(keys, n)
+            if rank:
+                self._rank("all", wallpaper_id, keys, self.lifetime[("w", wallpaper_id)])
+        self.last_24h.add(keys, ts, n)
+        self.last_7d.add(keys, ts, n)
+        for window, scores in self.trending.items():
+            factor = scores.rebase(ts)
+            if factor != 1.0:
+                for ranking in self.rankings[window].values():
+                    ranking.rescale(factor)
+            score = scores.add(wallpaper_id, ts, n)
+            if rank:
+                self._rank(window, wallpaper_id, keys, score)
+
+    def seed(self):
+        version = catalog_cache.version()
+        # the replica only beats having nothing: once seeded, the aggregates
+        # hold downloads it never saw, so an outage keeps them instead
+        replica = not self.seeded()
+        # no flush between the pending snapshot and the reads, or its events
+        # would be counted from both
+        with download_queue.flush_barrier:
+            pending = download_queue.pending_events()
+            # uncached read: cached rows may carry download_count from before a flush
+            rows = _query_wallpapers("all", replica)
+            buckets = _query_download_buckets(stats_since(), replica)
+        self.load(version, pending, rows, buckets)
+
+    def load(self, version, pending, rows, buckets):
+        """Replace the aggregates with freshly read rows (seed() and asgi.py)."""
+        with self._lock:
+            self._reset()
+            for row in rows:
+                self._track(row, rank=False)
+            for wallpaper_id, ts, n in buckets:
+                self._add_event(wallpaper_id, ts, n, lifetime=False, rank=False)
+            # tracked here but not flushed yet: not in download_count nor downloads
+            for event in pending:
+                self._add_event(event["wallpaper_id"], _parse_ts(event["timestamp"]), rank=False)
+            self._refill()
+            self._version = version
+            self._seeded_at = time.monotonic()
+
+    def seeded(self) -> bool:
+        return self._seeded_at > 0
+
+    def due(self) -> bool:
+        return self._version != catalog_cache.version() or time.monotonic() - self._seeded_at > STATS_RESEED_INTERVAL
+
+    def begin_seed(self, wait=False) -> bool:
+        """Claim a due reseed; the caller then seeds or load()s and calls end_seed().
+
+        False if no reseed is due, the last attempt was less than
+        STATS_RETRY_INTERVAL seconds ago or another thread holds the claim
+        (with wait=True: until it is done).
+        """
+        # a waiting caller waits for a seed in progress before checking: that
+        # attempt is what made _retry_due() false
+        if not (wait or self._retry_due()) or not self._seeding.acquire(blocking=wait):
+            return False
+        if not self._retry_due():
+            self._seeding.release()
+            return False
+        self._attempted_at = time.monotonic()
+        return True
+
+    def end_seed(self):
+        self._seeding.release()
+
+    def _retry_due(self) -> bool:
+        return self.due() and time.monotonic() - self._attempted_at >= STATS_RETRY_INTERVAL
+
+    def _ensure_current(self):
+        # before the first seed there is nothing to answer from: wait for it
+        if self.begin_seed(wait=not self.seeded()):
+            try:
+                self.seed()
+            except Exception as e:
+                if not self.seeded():
+                    raise
+                FALLBACKS.labels("stale_stats").inc()
+                log.warning("Could not reseed download stats, serving the current aggregates: %s", e)
+            finally:
+                self.end_seed()
+        if not self.seeded():
+            # the first seed failed less than STATS_RETRY_INTERVAL ago
+            raise RuntimeError("download stats are not seeded yet")
+
+    def apply(self, added, removed, before, after):
+        """Patch aggregates for a local catalog change (see SearchIndex.apply)."""
+        with self._lock:
+            if self._version != before:
+                return
+            stale = set()
+            for wid in removed:
+                stale |= self._untrack(wid)
+            if stale:
+                self._refill(stale)
+            for row in added:
+                self._track(row)
+            self._version = after
+
+    def record(self, wallpaper_id, ts=None):
+        with self._lock:
+            self._add_event(wallpaper_id, time.time() if ts is None else ts)
+
+    def snapshot(self, device_type="all"):
+        self._ensure_current()
+        device = device_type if device_type in ("mobile", "pc") else "all"
+        with self._lock:
+            categories = +self.categories[device]
+            return {
+                "total_downloads": self.lifetime.get(("d", device), 0),
+                "total_wallpapers": self.wallpaper_counts.get(("d", device), 0),
+                "downloads_24h": self.last_24h.get(("d", device)),
+                "popular_categories": dict(categories.most_common(5)),
+            }
+
+    def _top(self, window, key, limit):
+        ranking = self.rankings[window].get(key)
+        return ranking.top(limit) if ranking is not None else []
+
+    def popular(self, device_type="all", window="all", category=None, limit=TRENDING_TOP_K):
+        """Ids of the best ranked wallpapers in a TRENDING_WINDOWS window, best first.
+
+        A trending window with fewer than `limit` downloaded wallpapers is
+        topped up from the lifetime ranking.
+        """
+        self._ensure_current()
+        device = device_type if device_type in ("mobile", "pc") else "all"
+        key = ("c", device, category) if category else ("d", device)
+        with self._lock:
+            ids = self._top(window, key, limit)
+            if len(ids) < limit and window != "all":
+                seen = set(ids)
+                ids += [wid for wid in self._top("all", key, limit) if wid not in seen][:limit - len(ids)]
+            return ids
+
+def stats_since() -> str:
+    return (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()
+
+def parse_download_buckets(data):
+    return [(r["wallpaper_id"], _parse_ts(r["bucket"]), int(r["downloads"])) for r in data or []]
+
+def _query_download_buckets(since: str, replica: bool = True):
+    """[(wallpaper_id, epoch seconds, count)] for downloads at or after `since`."""
+    try:
+        return parse_download_buckets(supabase.rpc("download_buckets", {"since": since}).execute().data)
+    except Exception as e:
+        log.warning("download_buckets RPC unavailable, reading raw downloads: %s", e)
+        FALLBACKS.labels("download_buckets_raw").inc()
+    return query_raw_download_buckets(since, replica)
+
+def query_raw_download_buckets(since: str, replica: bool = True):
+    read = read_with_replica if replica else (lambda query: query(supabase))
+    out, page = [], 1000
+    while True:
+        res = read(
+            lambda db: db.table("downloads").select("wallpaper_id,timestamp")
+            .gte("timestamp", since).order("timestamp").range(len(out), len(out) + page - 1).execute()
+        )
+        rows = res.data or []
+        out.extend((r.get("wallpaper_id"), _parse_ts(r["timestamp"]), 1) for r in rows if r.get("timestamp"))
+        if len(rows) < page:
+            return out
+
+download_stats = DownloadStats()
+
+def catalog_changed(added=(), removed=(), updated=()):
+    """Invalidate cached catalog reads after an upload/delete in this worker and
+    patch the in-memory indexes so they don't need a full rebuild.
+
+    `updated` rows replace the copies held under the same id (e.g. once their
+    derivatives are stored).
+    """
+    before = catalog_cache.version()
+    catalog_cache.bump()
+    after = catalog_cache.version()
+    # the indexes that hold rows re-add them; the aggregates don't key on what changed
+    search_index.apply([*added, *updated], removed, before, after)
+    filename_index.apply([*added, *updated], removed, before, after)
+    download_stats.apply(added, removed, before, after)
+    activity_log.apply(added, removed, before, after)
+
+# ---------- Activity log ----------
+# /api/activity and /api/activity/stream are answered from memory. Uploads
+# and downloads are kept as two date-sorted lists of at most ACTIVITY_LOG_SIZE
+# events each; a history query is a k-way merge of them (heapq.merge) that
+# stops after `limit` items. This worker's uploads, deletes and downloads are
+# applied as they happen. Other workers' events arrive through a reseed from
+# the catalog and the last ACTIVITY_SEED_DOWNLOADS download rows, at most every
+# ACTIVITY_RESEED_INTERVAL seconds or after a catalog change made elsewhere.
+#
+# Every event that enters the log also gets a sequence number. The stream
+# sends events past the client's Last-Event-ID. Ids carry the worker's pid;
+# an id from another worker gets a "reset" event, and the client reloads the
+# history.
+ACTIVITY_LOG_SIZE = int(os.environ.get("ACTIVITY_LOG_SIZE", "1000"))
+ACTIVITY_SEED_DOWNLOADS = int(os.environ.get("ACTIVITY_SEED_DOWNLOADS", "200"))
+ACTIVITY_RESEED_INTERVAL = float(os.environ.get("ACTIVITY_RESEED_INTERVAL", "60"))
+ACTIVITY_RETRY_INTERVAL = 5   # seconds between seed attempts while reads fail
+ACTIVITY_FEED_SIZE = 30
+
+def recent_downloads_query(db):
+    return db.table("downloads").select("*").order("timestamp", desc=True).limit(ACTIVITY_SEED_DOWNLOADS)
+
+class ActivityLog:
+    def __init__(self, size: int):
+        self.size = size
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._seq = 0
+        self._version = None
+        self._seeded_at = None
+        self._attempted_at = 0.0
+        self._seeding = False
+        self._meta = {}                                  # wallpaper id -> (title, filename, device)
+        self._sources = {"upload": [], "download": []}   # oldest first
+        self._keys = set()
+        self._recent = deque(maxlen=size)                # (seq, event) for the stream
+
+    # -- maintenance (callers hold the lock) --
+    def _push(self, event):
+        self._seq += 1
+        self._recent.append((self._seq, event))
+        self._changed.notify_all()
+
+    def _insert(self, kind, wallpaper_id, date):
+        meta = self._meta.get(wallpaper_id)
+        if meta is None or not date:
+            return
+        # one form for every source: the same download comes back from Postgres
+        # as "+00:00" text with trimmed fractions after being recorded here
+        try:
+            date = _parse_datetime(date).isoformat()
+        except ValueError:
+            return
+        key = (kind, wallpaper_id, date)
+        if key in self._keys:
+            return
+        source = self._sources[kind]
+        if len(source) >= self.size and date <= source[0]["date"]:
+            return   # older than everything the log still holds
+        title, filename, device = meta
+        event = {"type": kind, "wallpaper_id": wallpaper_id, "title": title,
+                 "filename": filename, "device": device, "date": date}
+        bisect.insort(source, event, key=lambda e: e["date"])
+        self._keys.add(key)
+        if len(source) > self.size:
+            old = source.pop(0)
+            self._keys.discard((kind, old["wallpaper_id"], old["date"]))
+        self._push(event)
+
+    def _track(self, row):
+        if row.get("id"):
+            self._meta[row["id"]] = (row.get("title"), row.get("filename"), row.get("device_type") or "mobile")
+
+    def _forget(self, wallpaper_ids):
+        for kind, source in self._sources.items():
+            for e in source:
+                if e["wallpaper_id"] in wallpaper_ids:
+                    self._keys.discard((kind, e["wallpaper_id"], e["date"]))
+            self._sources[kind] = [e for e in source if e["wallpaper_id"] not in wallpaper_ids]
+        for wid in wallpaper_ids:
+            meta = self._meta.pop(wid, None)
+            self._push({"type": "delete", "wallpaper_id": wid, "device": meta[2] if meta else None})
+
+    def seed(self):
+        with self._lock:
+            if self._seeding:
+                return
+            self._seeding = True
+            self._attempted_at = time.monotonic()
+        try:
+            version = catalog_cache.version()
+            rows = load_catalog("all")
+            downloads = recent_downloads_query(supabase).execute().data or []
+            uploads = heapq.nlargest(self.size, (w for w in rows if w.get("upload_date")), key=lambda w: w["upload_date"])
+            with self._lock:
+                self._meta = {}
+                for row in rows:
+                    self._track(row)
+                gone = {e["wallpaper_id"] for s in self._sources.values() for e in s} - self._meta.keys()
+                if gone:
+                    self._forget(gone)
+                for w in reversed(uploads):
+                    self._insert("upload", w["id"], w["upload_date"])
+                for d in reversed(downloads):
+                    self._insert("download", d.get("wallpaper_id"), d.get("timestamp"))
+                self._version = version
+                self._seeded_at = time.monotonic()
+        finally:
+            self._seeding = False
+
+    def refresh(self):
+        """Reseed if due; on failure keep serving what the log holds."""
+        due = self._version != catalog_cache.version() or self._seeded_at is None \
+            or time.monotonic() - self._seeded_at > ACTIVITY_RESEED_INTERVAL
+        if not due or time.monotonic() - self._attempted_at < ACTIVITY_RETRY_INTERVAL:
+            return
+        try:
+            self.seed()
+        except Exception as e:
+            log.warning("Could not reseed the activity log: %s", e)
+
+    def apply(self, added, removed, before, after):
+        """Patch the log for a local catalog change (see SearchIndex.apply)."""
+        with self._lock:
+            if self._version != before:
+                return
+            if removed:
+                self._forget(set(removed))
+            for row in added:
+                self._track(row)
+                self._insert("upload", row.get("id"), row.get("upload_date"))
+            self._version = after
+
+    def record_download(self, wallpaper_id, timestamp):
+        with self._lock:
+            self._insert("download", wallpaper_id, timestamp)
+
+    # -- queries --
+    def history(self, activity_type="all", device_type="all", limit=ACTIVITY_FEED_SIZE):
+        """The `limit` most recent events, newest first."""
+        self.refresh()
+        kinds = [k for k in ("upload", "download") if activity_type in ("all", f"{k}s")]
+        with self._lock:
+            merged = heapq.merge(*(reversed(self._sources[k]) for k in kinds), key=lambda e: e["date"], reverse=True)
+            if device_type in ("mobile", "pc"):
+                merged = (e for e in merged if e["device"] == device_type)
+            return list(itertools.islice(merged, limit))
+
+    def event_id(self, seq):
+        return f"{os.getpid()}-{seq}"
+
+    def parse_event_id(self, event_id):
+        """Sequence number for a Last-Event-ID from this worker, else None."""
+        pid, _, seq = (event_id or "").partition("-")
+        if pid != str(os.getpid()) or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def last_seq(self):
+        return self._seq
+
+    def since(self, seq, timeout=None):
+        """[(seq, event)] after seq, waiting up to timeout for one to arrive."""
+        with self._lock:
+            if timeout and self._seq <= seq:
+                self._changed.wait(timeout)
+            return [(s, e) for s, e in self._recent if s > seq]
+
+activity_log = ActivityLog(ACTIVITY_LOG_SIZE)
+
+def record_download(wallpaper_id, ip=None):
+    """Count one download: write-behind queue, live stats and the activity log."""
+    event = download_queue.record(wallpaper_id, ip)
+    download_stats.record(wallpaper_id)
+    activity_log.record_download(wallpaper_id, event["timestamp"])
+
+# ---------- Upload spooling ----------
+# Multipart file parts are written into an UploadSpool instead of werkzeug's
+# default buffer. Each part is SHA-256 hashed as it streams in and is kept in
+# memory only while the request's UPLOAD_MEMORY_BUDGET lasts; past that it
+# rolls over to a temp file, so a request never buffers more than the budget
+# no matter how many files it carries. Storage keys are the content hash
+# (mobile/<sha256>.png), which makes re-uploads detectable before any bytes
+# are sent to storage. UPLOAD_DEDUP decides what happens to them:
+#   reject - report the file as a duplicate of the existing wallpaper
+#   link   - add a catalog row that points at the existing object
+UPLOAD_MEMORY_BUDGET = int(os.environ.get("UPLOAD_MEMORY_BUDGET", str(2 * 1024 * 1024)))
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR") or None   # None = system temp dir
+UPLOAD_DEDUP = os.environ.get("UPLOAD_DEDUP", "reject").lower()
+
+class UploadSpool:
+    """Readable/writable buffer for one uploaded file, hashed while written."""
+
+    def __init__(self, budget):
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.path = None
+        self._budget = budget   # shared by every spool of one request
+        self._file = BytesIO()
+        self._detached = False
+
+    def write(self, data):
+        self.sha256.update(data)
+        if self.path is None:
+            budget = self._budget
+            if len(data) <= budget["left"]:
+                budget["left"] -= len(data)
+                budget["peak"] = max(budget["peak"], budget["cap"] - budget["left"])
+            else:
+                # move what we hold so far to disk and hand it back to the budget
+                fd, self.path = tempfile.mkstemp(prefix="upload-", dir=UPLOAD_SPOOL_DIR)
+                spill = os.fdopen(fd, "w+b")
+                spill.write(self._file.getbuffer())
+                budget["left"] += self.size
+                self._file = spill
+        self.size += len(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        # read/readline/seek/tell/... come straight from the backing file
+        return getattr(self._file, name)
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
+
+    def payload(self):
+        """The temp file path if spooled to disk, else the bytes."""
+        return self.path or self._file.getvalue()
+
+    def detach(self):
+        """Like payload(), but a temp file survives close(); the caller must delete it."""
+        self._detached = True
+        return self.payload()
+
+    def close(self):
+        self._file.close()
+        if self.path and not self._detached:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+class SpoolingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        budget = self.__dict__.setdefault(
+            "_spool_budget", {"cap": UPLOAD_MEMORY_BUDGET, "left": UPLOAD_MEMORY_BUDGET, "peak": 0}
+        )
+        return UploadSpool(budget)
+
+app.request_class = SpoolingRequest
+
+upload_stats = {"requests": 0, "files": 0, "bytes": 0, "spooled_to_disk": 0, "duplicates": 0, "peak_buffered": 0}
+_upload_stats_lock = threading.Lock()
+
+def peak_rss() -> int:
+    """High-water resident memory of this process in bytes (0 if unknown)."""
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024   # KiB on Linux
+
+# ---------- Upload pipeline ----------
+# Storage uploads for a batch run in parallel on a bounded pool; the catalog
+# rows are then written with one bulk insert.
+UPLOAD_CONCURRENCY = int(os.environ.get("UPLOAD_CONCURRENCY", "6"))
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY, thread_name_prefix="upload")
+
+def _store_object(file_path: str, data, content_type: str, upsert: bool = False):
+    """Upload one object to the bucket; returns an error (str) or None.
+
+    `data` is bytes or the path of a local file, which is streamed from disk.
+    """
+    if isinstance(data, str):
+        with open(data, "rb") as f:
+            return _store_object(file_path, f, content_type, upsert)
+    try:
+        try:
+            up_res = supabase.storage.from_(BUCKET_NAME).upload(
+                file=data,
+                path=file_path,
+                file_options={"content-type": content_type, "upsert": "true" if upsert else "false"}
+            )
+        except TypeError:
+            # some older/newer SDK shapes accept positional args - try fallback
+            up_res = supabase.storage.from_(BUCKET_NAME).upload(file_path, data, {"content-type": content_type})
+    except Exception as e:
+        return str(e) or e.__class__.__name__
+    err = _res_error(up_res)
+    return str(err) if err else None
+
+def _remove_objects(paths):
+    """Best-effort removal of storage objects in a single call."""
+    if not paths:
+        return
+    try:
+        supabase.storage.from_(BUCKET_NAME).remove(list(paths))
+    except Exception as e:
+        log.warning("Storage remove error for %d objects (best-effort): %s", len(paths), e)
+
+def _unreferenced_paths(paths):
+    """The paths no wallpaper row points at; none if that can't be checked."""
+    referenced = set()
+    try:
+        for chunk in _chunks(sorted(paths)):
+            res = supabase.table("wallpapers").select("file_path").in_("file_path", chunk).execute()
+            referenced.update(r["file_path"] for r in res.data or [])
+    except Exception as e:
+        log.warning("Could not check %d storage objects for references, keeping them: %s", len(paths), e)
+        return set()
+    return set(paths) - referenced
+
+def _object_paths(row):
+    """Every storage object belonging to a wallpaper row (original + derivatives)."""
+    paths = [row["file_path"]] if row.get("file_path") else []
+    for d in (row.get("derivatives") or {}).values():
+        if isinstance(d, dict) and d.get("path"):
+            paths.append(d["path"])
+    return paths
+
+# ---------- Deletes ----------
+# Set-based: one in_() read for the rows, one for other rows sharing their
+# objects, one delete per table and one storage remove() for the whole
+# batch. in_() values travel in the URL, so ids go IN_FILTER_CHUNK at a time.
+# Rows are deleted before their objects: a failure then leaves orphaned
+# objects rather than rows pointing at nothing.
+IN_FILTER_CHUNK = 100
+BATCH_DELETE_MAX = int(os.environ.get("BATCH_DELETE_MAX", "500"))
+
+def _chunks(items, size=IN_FILTER_CHUNK):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def delete_wallpapers(ids):
+    """Delete wallpapers by id; {id: {"status": deleted|not_found|failed, ...}} in request order.
+
+    Errors reading the rows propagate; a failed delete marks its chunk failed.
+    """
+    rows = {}
+    for chunk in _chunks(ids):
+        res = supabase.table("wallpapers").select("*").in_("id", chunk).execute()
+        rows.update((r["id"], r) for r in res.data or [])
+    results = {wid: {"id": wid, "status": "not_found"} for wid in ids}
+    if not rows:
+        return results
+
+    # with UPLOAD_DEDUP=link rows outside the batch can share an object
+    paths = sorted({r["file_path"] for r in rows.values() if r.get("file_path")})
+    kept = set()
+    for chunk in _chunks(paths):
+        res = supabase.table("wallpapers").select("id,file_path").in_("file_path", chunk).execute()
+        kept.update(r["file_path"] for r in res.data or [] if r["id"] not in rows)
+
+    deleted = []
+    for chunk in _chunks(list(rows)):
+        try:
+            supabase.table("downloads").delete().in_("wallpaper_id", chunk).execute()
+            supabase.table("wallpapers").delete().in_("id", chunk).execute()
+        except Exception as e:
+            log.exception("Deleting %d wallpapers failed: %s", len(chunk), e)
+            for wid in chunk:
+                results[wid].update(status="failed", error=str(e))
+                kept.add(rows[wid].get("file_path"))
+            continue
+        deleted.extend(chunk)
+
+    _remove_objects(sorted({
+        p for wid in deleted if rows[wid].get("file_path") not in kept for p in _object_paths(rows[wid])
+    }))
+    for wid in deleted:
+        results[wid].update(status="deleted", title=rows[wid].get("title"))
+    if deleted:
+        catalog_changed(removed=deleted)
+    return results
+
+def wants_json() -> bool:
+    if request.headers.get("X-Requested-With") == "XMLHttpRequest":
+        return True
+    return request.accept_mimetypes.best_match(["text/html", "application/json"]) == "application/json"
+
+# ---------- Image derivatives ----------
+# Each upload gets resized re-encodes stored next to the original
+# (mobile/abc.png -> mobile/abc.thumb.webp, ...). Their paths and sizes are
+# recorded in a jsonb column, created by running once in the SQL editor:
+#
+#   alter table wallpapers add column if not exists derivatives jsonb;
+#
+# Until it exists (derivatives_column() probes once per process; restart the
+# workers after adding it) reads leave the column out, images are served
+# from the originals and no derivatives are made, so a deploy that runs ahead
+# of the migration keeps working.
+# Encoding is CPU heavy, so it runs in a process pool off the request path
+# (imaging.py, which the pool's processes import instead of this app); a small
+# thread pool then uploads the results and updates the row.
+# `flask --app app backfill-derivatives` fills in rows uploaded before this.
+DERIVATIVE_SIZES = (("thumb", 480), ("preview", 1280), ("full", None))   # max long edge
+DERIVATIVE_FORMAT = os.environ.get("DERIVATIVE_FORMAT", "webp").lower()  # webp | avif
+DERIVATIVE_QUALITY = int(os.environ.get("DERIVATIVE_QUALITY", "80"))
+DERIVATIVE_WORKERS = int(os.environ.get("DERIVATIVE_WORKERS", "2"))
+
+_derivative_pool = None
+_derivative_pool_pid = None
+_derivatives_column = None   # None: not probed yet, or the probe hit an outage
+
+def derivatives_column() -> bool:
+    """True once wallpapers.derivatives is known to exist."""
+    global _derivatives_column
+    if _derivatives_column is None:
+        try:
+            supabase.table("wallpapers").select("derivatives").limit(1).execute()
+            _derivatives_column = True
+        except Exception as e:
+            if is_transient_error(e):
+                return False   # probe again on the next call
+            log.warning("wallpapers.derivatives is missing, serving originals only (see app.py for the migration): %s", e)
+            _derivatives_column = False
+    return _derivatives_column
+derivative_io = ThreadPoolExecutor(max_workers=2, thread_name_prefix="derivatives")
+
+def render_in_pool(data):
+    """Future for imaging.render_derivatives(data) with the configured sizes and format."""
+    return get_derivative_pool().submit(
+        imaging.render_derivatives, data, DERIVATIVE_SIZES, DERIVATIVE_FORMAT, DERIVATIVE_QUALITY,
     )
 
+def get_derivative_pool():
+    # created lazily, once per worker process (never inherited across a fork)
+    global _derivative_pool, _derivative_pool_pid
+    if _derivative_pool is None or _derivative_pool_pid != os.getpid():
+        _derivative_pool = ProcessPoolExecutor(
+            max_workers=DERIVATIVE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+        _derivative_pool_pid = os.getpid()
+    return _derivative_pool
+
+def store_derivatives(row, rendered):
+    """Upload rendered derivatives and record them on the row; returns the updated rows or None."""
+    stem = row["file_path"].rsplit(".", 1)[0]
+    derivatives = {}
+    for name, (data, width, height) in rendered.items():
+        path = f"{stem}.{name}.{DERIVATIVE_FORMAT}"
+        err = _store_object(path, data, f"image/{DERIVATIVE_FORMAT}", upsert=True)
+        if err:
+            log.error("Derivative upload error for %s: %s", path, err)
+            _remove_objects([d["path"] for d in derivatives.values()])
+            return None
+        derivatives[name] = {"path": path, "url": public_storage_url(path), "width": width, "height": height}
+    # keyed by object, so rows linked to the same upload all pick them up
+    res = supabase.table("wallpapers").update({"derivatives": derivatives}).eq("file_path", row["file_path"]).execute()
+    if _res_error(res):
+        log.error("Could not record derivatives for %s: %s", row["id"], _res_error(res))
+        return None
+    return res.data or [dict(row, derivatives=derivatives)]
+
+def schedule_derivatives(row, data):
+    """Queue derivative generation for a freshly uploaded row (fire and forget).
+
+    `data` is the image bytes or a temp file path; the file is deleted once
+    rendering has finished (or could not be started).
+    """
+    def discard():
+        if isinstance(data, str):
+            try:
+                os.unlink(data)
+            except OSError:
+                pass
+
+    if imaging is None or not derivatives_column():
+        discard()
+        return None
+
+    def finish(rendered):
+        rows = store_derivatives(row, rendered)
+        if rows is not None:
+            catalog_changed(updated=rows)
+
+    def done(future):
+        discard()
+        try:
+            rendered = future.result()
+        except Exception as e:
+            log.exception("Derivative rendering failed for %s: %s", row.get("file_path"), e)
+            return
+        derivative_io.submit(finish, rendered)
+
+    try:
+        future = render_in_pool(data)
+    except Exception:
+        discard()
+        raise
+    future.add_done_callback(done)
+    return future
+
+def image_src(w, size="thumb"):
+    """Best URL for an <img src>: the requested derivative, else the original."""
+    d = (w.get("derivatives") or {}).get(size)
+    if d and d.get("url"):
+        return d["url"]
+    return w.get("file_url") or url_for("static", filename="wallpapers/" + (w.get("filename") or ""))
+
+def image_srcset(w):
+    """`srcset` value listing every derivative by width ("" if none yet)."""
+    derivatives = w.get("derivatives") or {}
+    return ", ".join(
+        f"{d['url']} {d['width']}w"
+        for name, _ in DERIVATIVE_SIZES
+        for d in [derivatives.get(name)] if d and d.get("url") and d.get("width")
+    )
+
+app.jinja_env.globals.update(image_src=image_src, image_srcset=image_srcset)
+
+@app.cli.command("backfill-derivatives")
+@click.option("--limit", default=0, help="Stop after this many wallpapers (0 = all).")
+def backfill_derivatives(limit):
+    """Generate image derivatives for wallpapers that have none yet."""
+    if not supabase:
+        raise click.ClickException("Supabase is not configured")
+    if imaging is None:
+        raise click.ClickException("Pillow is not installed")
+    if not derivatives_column():
+        raise click.ClickException("wallpapers.derivatives does not exist; run the migration in app.py first")
+    res = supabase.table("wallpapers").select("id,file_path").is_("derivatives", "null").execute()
+    rows = [r for r in res.data or [] if r.get("file_path")]
+    if limit:
+        rows = rows[:limit]
+    click.echo(f"{len(rows)} wallpapers without derivatives")
+
+    def fetch(row):
+        return row, supabase.storage.from_(BUCKET_NAME).download(row["file_path"])
+
+    done = failed = 0
+    updated = []
+    # downloads overlap on threads, encodes fan out over the process pool
+    for row, data in upload_executor.map(fetch, rows):
+        try:
+            stored = store_derivatives(row, render_in_pool(data).result())
+        except Exception as e:
+            log.exception("Backfill failed for %s: %s", row["file_path"], e)
+            stored = None
+        ok = stored is not None
+        updated += stored or []
+        done += ok
+        failed += not ok
+        click.echo(f"{'ok  ' if ok else 'FAIL'} {row['file_path']}")
+    if done:
+        catalog_changed(updated=updated)
+    click.echo(f"done: {done} ok, {failed} failed")
+
+# ---------- HTTP caching ----------
+# Read endpoints send a strong ETag (content hash, see CatalogCache.validators)
+# and Cache-Control. A matching If-None-Match / If-Modified-Since is answered
+# with 304 and no body. The ETag is a hash of the encoded body, so the body
+# has to exist first: while it is cached (the common case) a 304 costs no
+# query, render or serialisation, but after a catalog change or an eviction
+# the body is rebuilt and cached before it can be compared. max-age lets
+# browsers and a CDN reuse a response outright; stale-while-revalidate lets
+# them keep serving it while they revalidate in the background.
+CACHE_POLICIES = {
+    "index": "public, max-age=15, stale-while-revalidate=600",
+    "wallpapers": "public, max-age=60, stale-while-revalidate=600",
+    "search": "public, max-age=30, stale-while-revalidate=300",
+    "popular": "public, max-age=120, stale-while-revalidate=600",
+    "stats": "public, max-age=15, stale-while-revalidate=60",
+    "bootstrap": "public, max-age=15, stale-while-revalidate=60",
+}
+
+
+# Bodies are encoded once and kept in response_cache as EncodedBody (keyed by
+# endpoint + query, invalidated with the catalog version like everything in
+# catalog_cache), together with gzip/brotli variants built on first request.
+# Accept-Encoding picks the variant, so a repeat request costs no encoding
+# and no compression. orjson is used when installed.
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", "6"))
+
+def dumps_json(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value, default=str)
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False, default=str).encode()
+
+def compress(data: bytes, coding: str) -> bytes:
+    if coding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    if coding == "gzip":
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    return data
+
+class EncodedBody:
+    """Response bytes plus compressed variants, built once and then shared."""
+
+    def __init__(self, raw: bytes, mimetype: str):
+        self.raw = raw
+        self.mimetype = mimetype
+        self.etag = _digest(raw)
+        self._variants = {"identity": raw}
+
+    @classmethod
+    def json(cls, value):
+        return cls(dumps_json(value), "application/json")
+
+    def encoded(self, coding: str):
+        """(coding actually used, bytes); tiny bodies are never compressed."""
+        if len(self.raw) < COMPRESS_MIN_SIZE:
+            coding = "identity"
+        data = self._variants.get(coding)
+        if data is None:
+            # concurrent first requests may both compress; the result is identical
+            data = self._variants[coding] = compress(self.raw, coding)
+        return coding, data
+
+    def response(self, coding: str):
+        coding, data = self.encoded(coding)
+        resp = app.response_class(data, mimetype=self.mimetype)
+        if coding != "identity":
+            resp.headers["Content-Encoding"] = coding
+        return resp
+
+def negotiate_encoding() -> str:
+    accept = request.accept_encodings
+    if brotli is not None and accept["br"]:
+        return "br"
+    if accept["gzip"]:
+        return "gzip"
+    return "identity"
+
+def cached_body(key, build, cache=None):
+    """(EncodedBody-bearing value, validators) from cache (response_cache); build() on a miss."""
+    cache = response_cache if cache is None else cache
+    value = cache.get(key, build)
+    return value, cache.validators(key, value)
+
+def cached_response(policy, validators, build):
+    """304 if the client's copy is current, else build(); validators = (etag, last_modified).
+
+    The validators come from cached_body(), which builds the body on a miss;
+    only the response object (and any compression) is skipped by a 304.
+
+    build() may return an EncodedBody, sent in the encoding the client
+    accepts; the ETag then names that variant ("<etag>-gzip") and a 304
+    echoes whichever variant the client holds. Without
+    validators (the data came from an error fallback) the response is
+    marked no-store so a CDN doesn't hold on to it.
+    """
+    coding = negotiate_encoding()
+
+    def materialise(result):
+        if isinstance(result, EncodedBody):
+            return result.response(coding)
+        return make_response(result)
+
+    if validators is None:
+        resp = materialise(build())
+        resp.headers["Cache-Control"] = "no-store"
+        return resp
+    etag, last_modified = validators
+    tags = [etag, f"{etag}-gzip", f"{etag}-br"]
+    matched = None
+    if request.if_none_match:
+        matched = next((tag for tag in tags if request.if_none_match.contains_weak(tag)), None)
+    elif last_modified and request.if_modified_since and last_modified <= request.if_modified_since:
+        matched = etag
+    if matched:
+        resp = make_response("", 304)
+        resp.set_etag(matched)
+    else:
+        resp = materialise(build())
+        used = resp.headers.get("Content-Encoding")
+        resp.set_etag(f"{etag}-{used}" if used else etag)
+    resp.vary.add("Accept-Encoding")
+    if last_modified:
+        resp.last_modified = last_modified
+    resp.headers["Cache-Control"] = CACHE_POLICIES[policy]
+    return resp
+
+# ---------- Service worker ----------
+# The service worker precaches these files under a version derived from their
+# contents (passed as ?v= when it is registered), so a deploy that changes
+# any of them replaces the cached app shell.
+SHELL_FILES = ("css/style.css", "js/main.js", "js/service-worker.js")
+
+def _asset_version() -> str:
+    h = hashlib.sha1()
+    for name in SHELL_FILES:
+        try:
+            with open(os.path.join(app.static_folder, name), "rb") as f:
+                h.update(f.read())
+        except OSError:
+            pass
+    return h.hexdigest()[:12]
+
+ASSET_VERSION = _asset_version()
+app.jinja_env.globals["asset_version"] = ASSET_VERSION
+
+# ---------- Bootstrap state ----------
+# Everything the gallery needs for first paint, derived from one catalog read:
+# the first page (same order and cursor as /api/wallpapers), categories, the
+# latest wallpapers, plus the most popular ones and the download stats from
+# the live aggregates. /api/bootstrap serves it for device switches and
+# analytics. index() embeds it in the page, which is cached for only
+# INDEX_CACHE_TTL seconds, so the popular and stats blocks there are at most
+# that old (main.js refreshes the stats on its own); a page rendered without
+# them (ranking or stats failed) is served once and not cached.
+INDEX_CACHE_TTL = float(os.environ.get("INDEX_CACHE_TTL", "15"))
+page_cache = catalog_cache.scoped(8, INDEX_CACHE_TTL)   # rendered gallery pages, one per device
+BOOTSTRAP_FIELDS = (
+    "id", "title", "category", "device_type", "filename",
+    "file_url", "upload_date", "download_count", "derivatives",
+)
+LATEST_SIZE = 5
+POPULAR_SIZE = 6
+POPULAR_SIZE_MAX = TRENDING_TOP_K   # the rankings keep no more
+ANALYTICS_TOP = 10   # rows in the analytics "top wallpapers" table
+
+def _catalog_state(device_type, limit):
+    wallpapers = load_catalog(device_type)
+    ordered = sorted(wallpapers, key=lambda w: (w.get("upload_date") or "", w.get("id") or ""), reverse=True)
+    return {
+        "device": catalog_key(device_type)[1],
+        "wallpapers": _project(ordered[:limit], BOOTSTRAP_FIELDS),
+        "next_cursor": encode_cursor(ordered[limit - 1]) if len(ordered) > limit else None,
+        "total": len(ordered),
+        "categories": sorted({w["category"] for w in wallpapers if w.get("category")}),
+        "latest": _project(ordered[:LATEST_SIZE], BOOTSTRAP_FIELDS),
+    }
+
+def catalog_by_id(device_type):
+    """load_catalog() keyed by wallpaper id (shared, don't mutate)."""
+    key = catalog_key(device_type)
+    return catalog_cache.get(("by_id", key[1]), lambda: {w["id"]: w for w in load_catalog(key[1])})
+
+def popular_wallpapers(device_type, window="all", category=None, top=POPULAR_SIZE):
+    """Catalog rows for DownloadStats.popular(), best first."""
+    rows = catalog_by_id(device_type)
+    ids = download_stats.popular(device_type, window, category, top)
+    return [rows[wid] for wid in ids if wid in rows]
+
+def parse_top(value):
+    try:
+        return max(1, min(int(value), POPULAR_SIZE_MAX))
+    except (TypeError, ValueError):
+        return POPULAR_SIZE
+
+def bootstrap_state(device_type, limit=PAGE_SIZE_DEFAULT, top=POPULAR_SIZE):
+    """(first-paint state, complete); the catalog part is cached, popular and stats are read live.
+
+    complete is False when popular or stats had to be left empty; such a
+    state must not be cached.
+    """
+    key = ("bootstrap", catalog_key(device_type)[1], limit)
+    state = response_cache.get(key, lambda: _catalog_state(device_type, limit))
+    # the catalog part is enough for a page: a ranking or stats error leaves those empty
+    complete = True
+    try:
+        popular = _project(popular_wallpapers(device_type, top=top), BOOTSTRAP_FIELDS)
+    except Exception as e:
+        log.warning("Could not rank popular wallpapers for the bootstrap state: %s", e)
+        popular, complete = [], False
+    try:
+        stats = download_stats.snapshot(device_type)
+    except Exception as e:
+        log.warning("Could not read download stats for the bootstrap state: %s", e)
+        stats, complete = empty_stats(), False
+    return dict(state, popular=popular, stats=stats), complete
+
+def empty_bootstrap_state(device_type):
+    return {
+        "device": catalog_key(device_type)[1],
+        "wallpapers": [], "next_cursor": None, "total": 0,
+        "categories": [], "latest": [], "popular": [],
+        "stats": empty_stats(),
+    }
+
+# ---------- Request instrumentation ----------
+# Every request is timed into a per-route histogram (see /metrics). Requests
+# slower than SLOW_REQUEST_MS are logged with their Supabase call count and
+# time. With PROFILE_SAMPLE_RATE > 0 that fraction of requests runs under a
+# stack sampler and leaves a collapsed-stack file in PROFILE_DIR.
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "1000"))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "vault-profiles"))
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")   # if set, /metrics wants "Authorization: Bearer <token>"
+
+def request_route() -> str:
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        g.sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000).start()
+
+@app.after_request
+def record_request(response):
+    started = g.pop("request_started", None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request_route()
+    HTTP_LATENCY.labels(route, request.method, str(response.status_code)).observe(elapsed)
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        log.warning(
+            "Slow request: %s %s -> %d in %.0fms (%d Supabase calls, %.0fms)",
+            request.method, request.full_path.rstrip("?"), response.status_code, elapsed * 1000,
+            g.get("supabase_calls", 0), g.get("supabase_seconds", 0.0) * 1000,
+        )
+    sampler = g.pop("sampler", None)
+    if sampler is not None:
+        sampler.stop()
+        try:
+            log.info("Profile for %s written to %s", route, sampler.write(profile_path(PROFILE_DIR, route, elapsed)))
+        except OSError as e:
+            log.warning("Could not write profile to %s: %s", PROFILE_DIR, e)
+    return response
+
+# ---------- Routes ----------
+@app.route("/")
+def index():
+    # normalised once: it keys the cached page and is what the page shows
+    device_type = catalog_key(request.args.get("device", "mobile"))[1]
+
+    def render(state):
+        return render_template(
+            "index.html",
+            wallpapers=state["wallpapers"],
+            total=state["total"],
+            categories=state["categories"],
+            latest_wallpapers=state["latest"],
+            popular_wallpapers=state["popular"],
+            bootstrap=state,
+            instagram_url=INSTAGRAM_URL,
+            current_device=device_type
+        )
+
+    partial = []
+
+    def build():
+        state, complete = bootstrap_state(device_type)
+        if not complete:
+            partial.append(state)
+        return EncodedBody(render(state).encode(), "text/html")
+
+    key = ("html", "index", device_type)
+    try:
+        body, validators = cached_body(key, build, page_cache)
+    except Exception as e:
+        log.exception("Error querying wallpapers: %s", e)
+        return cached_response("index", None, lambda: render(empty_bootstrap_state(device_type)))
+    if partial:
+        page_cache.discard(key)
+        validators = None
+    return cached_response("index", validators, lambda: body)
+
 @app.route("/manifest.json")
 def manifest():
     try:
@@ -146,116 +2719,197 @@ def manifest():
     except Exception:
         return jsonify({"name": "Amoled Vault", "start_url": "/", "display": "standalone"})
 
+@app.route("/service-worker.js")
+def service_worker():
+    # served from the root so its scope covers / and /api, not just /static/js
+    resp = send_from_directory(os.path.join(app.static_folder, "js"), "service-worker.js", max_age=0)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
 @app.route("/api/wallpapers")
 def api_wallpapers():
+    """Paged wallpaper list.
+
+    Query params: device, category, search (+ fuzzy=1 for typo tolerance),
+    limit (capped at PAGE_SIZE_MAX), cursor (from the previous page's
+    X-Next-Cursor header) and fields (comma separated column projection).
+    The body stays a plain JSON array; the next cursor is sent in
+    `X-Next-Cursor` / `Link`, the first page also carries `X-Total-Count`.
+    Searches are answered from the in-memory index, ranked by relevance.
+    """
     category = request.args.get("category", "all")
     device_type = request.args.get("device", "mobile")
     search = (request.args.get("search") or "").strip().lower()
+    fuzzy = request.args.get("fuzzy") in ("1", "true")
+    limit = parse_limit(request.args.get("limit"))
+    raw_cursor = request.args.get("cursor")
 
-    wallpapers = []
-    if supabase:
-        try:
-            q = supabase.table("wallpapers").select("*")
-            if device_type in ("mobile", "pc"):
-                q = q.eq("device_type", device_type)
-            if category != "all":
-                # ilike might require wildcard, but we'll leave as direct filter for simplicity
-                q = q.ilike("category", category)
-            res = q.execute()
-            wallpapers = res.data or []
-        except Exception as e:
-            log.exception("Error fetching wallpapers from supabase: %s", e)
-            wallpapers = []
-    else:
-        db = load_database()
-        wallpapers = db.get("wallpapers", [])
-        if device_type in ("mobile", "pc"):
-            wallpapers = [w for w in wallpapers if w.get("device_type") == device_type]
-        if category != "all":
-            wallpapers = [w for w in wallpapers if w.get("category", "").lower() == category.lower()]
+    try:
+        fields = parse_fields(request.args.get("fields"))
+        if search:
+            offset = decode_offset_cursor(raw_cursor) if raw_cursor else 0
+        else:
+            cursor = decode_cursor(raw_cursor) if raw_cursor else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    if search:
-        s = search
-        wallpapers = [w for w in wallpapers if s in (w.get("title","").lower()) or s in (w.get("category","").lower())]
+    def search_page():
+        matches = search_index.search(search, device_type, category, fuzzy=fuzzy)
+        page = _project(matches[offset:offset + limit], fields)
+        next_cursor = encode_offset_cursor(offset + limit) if len(matches) > offset + limit else None
+        return EncodedBody.json(page), next_cursor, len(matches) if not raw_cursor else None
+
+    def list_page():
+        page, next_cursor, total = _query_page(device_type, category, fields, limit, cursor)
+        return EncodedBody.json(page), next_cursor, total
 
-    return jsonify(wallpapers)
+    if search:
+        policy = "search"
+        key = ("search", device_type, category.lower(), search, fuzzy, fields, limit, offset, bool(raw_cursor))
+    else:
+        policy = "wallpapers"
+        key = ("page", device_type, category.lower(), fields, limit, cursor)
+    try:
+        (body, next_cursor, total), validators = cached_body(key, search_page if search else list_page)
+    except Exception as e:
+        log.exception("Error fetching wallpapers page: %s", e)
+        body, next_cursor, total, validators = EncodedBody.json([]), None, None, None
+
+    resp = cached_response(policy, validators, lambda: body)
+    if next_cursor:
+        resp.headers["X-Next-Cursor"] = next_cursor
+        next_args = request.args.to_dict()
+        next_args["cursor"] = next_cursor
+        resp.headers["Link"] = f'<{url_for("api_wallpapers", **next_args)}>; rel="next"'
+    if total is not None:
+        resp.headers["X-Total-Count"] = str(total)
+    return resp
+
+@app.route("/api/suggest")
+def api_suggest():
+    """Autocomplete for the search box: titles/categories starting with q."""
+    q = request.args.get("q") or ""
+    device_type = request.args.get("device", "mobile")
+    limit = max(1, min(parse_limit(request.args.get("limit") or 8), 20))
+    try:
+        suggestions = search_index.suggest(q, device_type, limit)
+    except Exception as e:
+        log.exception("Error building suggestions: %s", e)
+        suggestions = []
+    return jsonify(suggestions)
 
 @app.route("/api/activity")
 def api_activity():
     activity_type = request.args.get("type", "all")
     device_type = request.args.get("device", "mobile")
-    activity = []
-
-    wallpapers = []
-    if supabase:
-        try:
-            wq = supabase.table("wallpapers").select("*")
-            if device_type in ("mobile","pc"):
-                wq = wq.eq("device_type", device_type)
-            wres = wq.execute()
-            wallpapers = wres.data or []
-        except Exception as e:
-            log.exception("Error reading wallpapers: %s", e)
-            wallpapers = []
-    else:
-        db = load_database()
-        wallpapers = db.get("wallpapers", [])
-
-    by_id = {w["id"]: w for w in wallpapers if w.get("id")}
-    wallpaper_ids = set(by_id.keys())
-
-    # uploads
-    if activity_type in ("all","uploads"):
-        for w in wallpapers:
-            if w.get("upload_date"):
-                activity.append({"type":"upload","title":w.get("title"),"filename":w.get("filename"),"date":w.get("upload_date")})
-
-    # downloads
-    if activity_type in ("all","downloads"):
-        if supabase:
-            try:
-                dres = supabase.table("downloads").select("*").order("timestamp", desc=True).limit(200).execute()
-                downloads = dres.data or []
-            except Exception as e:
-                log.exception("Error reading downloads: %s", e)
-                downloads = []
-        else:
-            db = load_database()
-            downloads = db.get("downloads", [])
-        for d in downloads:
-            wid = d.get("wallpaper_id")
-            if wid in wallpaper_ids:
-                w = by_id.get(wid)
-                activity.append({"type":"download","title":w.get("title") if w else None,"filename":w.get("filename") if w else None,"date": d.get("timestamp")})
-
-    activity.sort(key=lambda x: x.get("date") or "", reverse=True)
-    return jsonify(activity[:30])
+    return jsonify(activity_log.history(activity_type, device_type))
+
+ACTIVITY_STREAM_SECONDS = float(os.environ.get("ACTIVITY_STREAM_SECONDS", "300"))
+ACTIVITY_STREAMS_MAX = int(os.environ.get("ACTIVITY_STREAMS_MAX", "4"))   # held open at once, per worker
+ACTIVITY_STREAM_RETRY_MS = int(os.environ.get("ACTIVITY_STREAM_RETRY_MS", "15000"))
+ACTIVITY_HEARTBEAT = 15
+
+open_streams = threading.BoundedSemaphore(ACTIVITY_STREAMS_MAX)
+
+def sse_event(event_id, data, event=None):
+    lines = [f"id: {event_id}"]
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {dumps_json(data).decode()}")
+    return "\n".join(lines) + "\n\n"
+
+def activity_stream_events(after, activity_type, device_type):
+    """(last seq, SSE text) for the log's events after seq `after` that match the filters."""
+    kinds = {k for k in ("upload", "download") if activity_type in ("all", f"{k}s")} | {"delete"}
+    events = activity_log.since(after)
+    out = []
+    for seq, event in events:
+        if event["type"] in kinds and (device_type not in ("mobile", "pc") or event["device"] in (device_type, None)):
+            out.append(sse_event(activity_log.event_id(seq), event))
+    return (events[-1][0] if events else after), "".join(out)
+
+@app.route("/api/activity/stream")
+def api_activity_stream():
+    """New activity as Server-Sent Events (type/device filters as /api/activity).
+
+    On a threaded server (gthread, see gunicorn.conf.py) the stream stays open
+    for ACTIVITY_STREAM_SECONDS; EventSource reconnects after that with
+    Last-Event-ID and picks up where it left off. Each open stream holds a
+    thread (until a heartbeat write fails after the client left), so at most
+    ACTIVITY_STREAMS_MAX are held per worker. Past that, and
+    on a sync worker, a connection sends what's new and closes, and the client
+    comes back after ACTIVITY_STREAM_RETRY_MS. asgi.py serves the stream on its
+    event loop instead.
+    """
+    activity_type = request.args.get("type", "all")
+    device_type = request.args.get("device", "mobile")
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    keep_open = bool(request.environ.get("wsgi.multithread")) and open_streams.acquire(blocking=False)
+
+    activity_log.refresh()
+    after = activity_log.parse_event_id(last_id)
+    reset = after is None and bool(last_id)
+    if after is None:
+        after = activity_log.last_seq()
+
+    def stream():
+        nonlocal after
+        yield f"retry: {ACTIVITY_STREAM_RETRY_MS}\n\n"
+        if reset:
+            # resumed against another worker: our ids mean nothing to it
+            yield sse_event(activity_log.event_id(after), {"type": "reset"}, "reset")
+        deadline = time.monotonic() + (ACTIVITY_STREAM_SECONDS if keep_open else 0)
+        while True:
+            after, chunk = activity_stream_events(after, activity_type, device_type)
+            yield chunk or ": ping\n\n"
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            activity_log.refresh()
+            activity_log.since(after, timeout=min(ACTIVITY_HEARTBEAT, remaining))
+
+    resp = app.response_class(stream(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-store"
+    resp.headers["X-Accel-Buffering"] = "no"   # nginx/Render proxies: don't buffer the stream
+    if keep_open:
+        resp.call_on_close(open_streams.release)
+    return resp
 
 @app.route("/download/<filename>")
 def download_wallpaper(filename):
-    # find wallpaper row
-    if supabase:
+    """Redirect to the stored file. With ?track=1 the download is also counted
+    (queued like /api/track-download), so the client needs no separate POST.
+
+    A counting response is no-store, so no cache can replay it, and browser
+    prefetches (Sec-Purpose / Purpose: prefetch) are redirected uncounted.
+    """
+    entry = filename_index.lookup(filename)
+    if entry is None:
         try:
-            res = supabase.table("wallpapers").select("*").eq("filename", filename).limit(1).execute()
+            res = read_with_replica(lambda db: db.table("wallpapers").select("id,filename,file_path,device_type,category").eq("filename", filename).limit(1).execute())
             rows = res.data or []
         except Exception as e:
             log.exception("Error fetching wallpaper for download: %s", e)
             rows = []
-    else:
-        db = load_database()
-        rows = [w for w in db.get("wallpapers", []) if w.get("filename") == filename]
-
-    if not rows:
-        return "File not found", 404
-
-    w = rows[0]
-    path = w.get("file_path") or f"{w.get('device_type','mobile')}/{filename}"
-    category = w.get("category", "wallpaper")
+        if not rows:
+            return "File not found", 404
+        entry = FilenameIndex.entry(rows[0])
+
+    path, category, wallpaper_id = entry
+    track = request.args.get("track") in ("1", "true")
+    prefetch = "prefetch" in (request.headers.get("Sec-Purpose") or request.headers.get("Purpose") or "")
+    if track and wallpaper_id and not prefetch:
+        record_download(wallpaper_id, request.remote_addr)
     ext = filename.rsplit(".",1)[-1]
     custom_name = f"{category}-{DOWNLOAD_NAME_SUFFIX}.{ext}"
 
-    url = f"{public_storage_url(path)}?download={custom_name}"
-    return redirect(url, code=302)
+    if using_local_store():
+        resp = send_from_directory(UPLOAD_FOLDER, path, as_attachment=True, download_name=custom_name)
+    else:
+        resp = redirect(f"{public_storage_url(path)}?download={custom_name}", code=302)
+    if track:
+        resp.headers["Cache-Control"] = "no-store"
+    return resp
 
 # Combined GET form + POST upload to make /upload usable from browser directly
 @app.route("/upload", methods=["GET","POST"])
@@ -293,14 +2947,18 @@ def upload_wallpaper():
             return resp
 
     # POST: handle upload
-    if "files" not in request.files:
-        flash("No files selected")
+    def fail(message, status=400):
+        if wants_json():
+            return jsonify({"error": message}), status
+        flash(message)
         return redirect(url_for("upload_page", secret=secret))
 
+    if "files" not in request.files:
+        return fail("No files selected")
+
     if not supabase:
         log.error("Upload attempted but Supabase client not available.")
-        flash("Server is not configured with Supabase. Uploads are disabled.")
-        return redirect(url_for("upload_page", secret=secret))
+        return fail("Server is not configured with Supabase. Uploads are disabled.", 500)
 
     files = request.files.getlist("files")
     title_base = (request.form.get("title") or "").strip()
@@ -308,73 +2966,156 @@ def upload_wallpaper():
     device_type = (request.form.get("device_type") or "").strip()
 
     if not files or all(f.filename == "" for f in files):
-        flash("No files selected")
-        return redirect(url_for("upload_page", secret=secret))
+        return fail("No files selected")
 
     if not title_base or not category or not device_type:
-        flash("Title, category, and device type are required")
-        return redirect(url_for("upload_page", secret=secret))
+        return fail("Title, category, and device type are required")
 
     if device_type not in ("mobile","pc"):
-        flash("Invalid device type")
-        return redirect(url_for("upload_page", secret=secret))
-
-    uploaded_count = 0
-    failed_count = 0
+        return fail("Invalid device type")
 
+    # 1) validate; each part was already hashed and spooled while the body streamed in
+    results = []
+    pending = []
     for i, file in enumerate(files):
+        status = {"index": i, "filename": getattr(file, "filename", None), "status": "failed"}
+        results.append(status)
         if not (file and allowed_file(file.filename)):
-            failed_count += 1
+            status["error"] = "Unsupported file type"
+            continue
+        spool = file.stream
+        if not isinstance(spool, UploadSpool):
+            log.error("Upload %s was not spooled (got %s)", file.filename, type(spool).__name__)
+            status["error"] = "Could not read file"
             continue
-        try:
-            ext = file.filename.rsplit(".",1)[1].lower()
-            unique_filename = f"{uuid.uuid4().hex}.{ext}"
-            file_path = f"{device_type}/{unique_filename}"
-            # read bytes
-            file_bytes = file.read()
-
-            # Upload via Supabase storage (use named args to be robust)
-            try:
-                up_res = supabase.storage.from_(BUCKET_NAME).upload(
-                    file=file_bytes,
-                    path=file_path,
-                    file_options={"content-type": file.mimetype, "upsert": "false"}
-                )
-            except TypeError:
-                # some older/newer SDK shapes accept positional args - try fallback
-                up_res = supabase.storage.from_(BUCKET_NAME).upload(file_path, file_bytes, {"content-type": file.mimetype})
-
-            err = _res_error(up_res)
-            if err:
-                log.error("Storage upload error for %s: %s", file.filename, err)
-                failed_count += 1
-                continue
 
-            public_url = public_storage_url(file_path)
-
-            file_title = f"{title_base} #{i+1}" if len(files) > 1 else title_base
-
-            ins_res = supabase.table("wallpapers").insert({
-                "id": str(uuid.uuid4()),
-                "title": file_title,
-                "category": category,
-                "device_type": device_type,
-                "filename": unique_filename,
-                "file_path": file_path,
-                "file_url": public_url,
-                "upload_date": datetime.utcnow().isoformat(),
-                "download_count": 0
-            }).execute()
-            if _res_error(ins_res):
-                log.error("DB insert error for %s: %s", unique_filename, _res_error(ins_res))
-                failed_count += 1
+        ext = file.filename.rsplit(".",1)[1].lower()
+        unique_filename = f"{spool.hexdigest()}.{ext}"
+        file_path = f"{device_type}/{unique_filename}"
+        row = {
+            "id": str(uuid.uuid4()),
+            "title": f"{title_base} #{i+1}" if len(files) > 1 else title_base,
+            "category": category,
+            "device_type": device_type,
+            "filename": unique_filename,
+            "file_path": file_path,
+            "file_url": public_storage_url(file_path),
+            "upload_date": datetime.utcnow().isoformat(),
+            "download_count": 0
+        }
+        pending.append((status, row, file))
+
+    # 2) keys are content hashes: one lookup tells which objects already exist
+    existing = {}
+    if pending:
+        keys = sorted({row["file_path"] for _, row, _ in pending})
+        try:
+            cols = "id,file_path,derivatives" if derivatives_column() else "id,file_path"
+            res = supabase.table("wallpapers").select(cols).in_("file_path", keys).execute()
+            for r in res.data or []:
+                existing.setdefault(r["file_path"], r)
+        except Exception as e:
+            log.warning("Duplicate lookup failed, uploading every file: %s", e)
+
+    jobs = []
+    linked = []
+    duplicates = 0
+    for status, row, file in pending:
+        dup = existing.get(row["file_path"])
+        if dup is not None:
+            duplicates += 1
+            if UPLOAD_DEDUP != "link":
+                status.update(status="duplicate", error="Already uploaded", id=dup["id"])
                 continue
+            if dup.get("derivatives"):
+                row["derivatives"] = dup["derivatives"]
+            linked.append((status, row, None))
+            continue
+        # later copies in this batch link to (or are rejected against) this one
+        existing[row["file_path"]] = row
+        # content-addressed, so overwriting an orphaned object is harmless
+        future = upload_executor.submit(_store_object, row["file_path"], file.stream.payload(), file.mimetype, True)
+        jobs.append((status, row, file.stream, future))
+
+    # 3) collect storage results
+    stored = []
+    for status, row, spool, future in jobs:
+        err = future.result()
+        if err:
+            log.error("Storage upload error for %s: %s", status["filename"], err)
+            status["error"] = "Storage upload failed"
+            continue
+        stored.append((status, row, spool))
+    # a linked copy of a file that failed to upload has nothing to point at
+    uploaded_paths = {row["file_path"] for _, row, _ in stored}
+    failed_paths = {row["file_path"] for _, row, _, _ in jobs} - uploaded_paths
+    for status, row, _ in linked:
+        if row["file_path"] in failed_paths:
+            status["error"] = "Storage upload failed"
+    linked = [item for item in linked if item[1]["file_path"] not in failed_paths]
+
+    # 4) one bulk insert; if it fails, remove the objects no row references
+    if stored or linked:
+        try:
+            ins_res = supabase.table("wallpapers").insert([row for _, row, _ in stored + linked]).execute()
+            err = _res_error(ins_res)
+        except Exception as e:
+            log.exception("Bulk insert of %d wallpapers failed: %s", len(stored) + len(linked), e)
+            err = e
+        if err:
+            # keys are content hashes written with upsert: an object may predate
+            # this request (the duplicate lookup failed) or back a concurrent
+            # upload of the same file, so only unreferenced ones go
+            orphaned = _unreferenced_paths(uploaded_paths)
+            log.error("DB insert error, rolling back %d of %d storage objects: %s", len(orphaned), len(uploaded_paths), err)
+            _remove_objects(sorted(orphaned))
+            for status, _, _ in stored + linked:
+                status["error"] = "Database insert failed"
+            stored = []
+            linked = []
+
+    new_rows = []
+    for status, row, spool in stored + linked:
+        status.update(status="uploaded", id=row["id"], file_url=row["file_url"])
+        new_rows.append(row)
+        if spool is None:
+            continue
+        try:
+            schedule_derivatives(row, spool.detach())
+        except Exception as e:
+            log.exception("Could not schedule derivatives for %s: %s", row["file_path"], e)
+
+    uploaded_count = len(new_rows)
+    failed_count = len(results) - uploaded_count
+
+    # memory held by this request's spools never exceeds UPLOAD_MEMORY_BUDGET
+    buffered = request.__dict__.get("_spool_budget", {}).get("peak", 0)
+    spools = [file.stream for _, _, file in pending]
+    total_bytes = sum(s.size for s in spools)
+    on_disk = sum(1 for s in spools if s.path)
+    with _upload_stats_lock:
+        upload_stats["requests"] += 1
+        upload_stats["files"] += len(spools)
+        upload_stats["bytes"] += total_bytes
+        upload_stats["spooled_to_disk"] += on_disk
+        upload_stats["duplicates"] += duplicates
+        upload_stats["peak_buffered"] = max(upload_stats["peak_buffered"], buffered)
+    UPLOAD_BYTES.inc(total_bytes)
+    for r in results:
+        UPLOAD_FILES.labels(r["status"]).inc()
+    log.info(
+        "Upload: %d file(s), %d bytes, %d spooled to disk, %d duplicate(s), %d bytes buffered at peak, process peak RSS %d bytes",
+        len(spools), total_bytes, on_disk, duplicates, buffered, peak_rss()
+    )
 
-            uploaded_count += 1
+    if uploaded_count > 0:
+        catalog_changed(added=new_rows)
 
-        except Exception as e:
-            log.exception("Exception uploading file %s: %s", getattr(file, "filename", "<unknown>"), e)
-            failed_count += 1
+    if wants_json():
+        return jsonify({
+            "uploaded": uploaded_count, "failed": failed_count,
+            "duplicates": sum(1 for r in results if r["status"] == "duplicate"), "files": results
+        })
 
     if uploaded_count > 0 and failed_count == 0:
         flash(f"Successfully uploaded {uploaded_count} wallpaper(s)!")
@@ -404,21 +3145,13 @@ def track_download():
         wallpaper_id = data.get("wallpaper_id")
         if not wallpaper_id:
             return jsonify({"error": "Missing wallpaper_id"}), 400
+        if not isinstance(wallpaper_id, str) or not is_uuid(wallpaper_id):
+            return jsonify({"error": "Invalid wallpaper_id"}), 400
 
         if not supabase:
             return jsonify({"error": "Server not configured with Supabase"}), 500
 
-        supabase.table("downloads").insert({
-            "wallpaper_id": wallpaper_id,
-            "ip": request.remote_addr
-        }).execute()
-
-        current = supabase.table("wallpapers").select("download_count").eq("id", wallpaper_id).limit(1).execute()
-        count = 0
-        if current.data:
-            count = int(current.data[0].get("download_count") or 0) + 1
-
-        supabase.table("wallpapers").update({"download_count": count}).eq("id", wallpaper_id).execute()
+        record_download(wallpaper_id, request.remote_addr)
         return jsonify({"success": True})
     except Exception as e:
         log.exception("Error tracking download: %s", e)
@@ -426,115 +3159,146 @@ def track_download():
 
 @app.route("/api/popular")
 def get_popular_wallpapers():
+    """Most downloaded wallpapers, best first.
+
+    Query params: device, window ("all", the default, ranks by lifetime
+    downloads; "24h" and "7d" by time-decayed trending scores), category
+    (rank within one category) and top (default 6).
+    """
     device_type = request.args.get("device", "mobile")
-    wallpapers = []
-    if supabase:
-        try:
-            q = supabase.table("wallpapers").select("*")
-            if device_type in ("mobile","pc"):
-                q = q.eq("device_type", device_type)
-            res = q.execute()
-            wallpapers = res.data or []
-        except Exception as e:
-            log.exception("Error fetching popular wallpapers: %s", e)
-            wallpapers = []
-    else:
-        db = load_database()
-        wallpapers = db.get("wallpapers", [])
-        if device_type in ("mobile","pc"):
-            wallpapers = [w for w in wallpapers if w.get("device_type")==device_type]
+    window = request.args.get("window", "all")
+    if window not in TRENDING_WINDOWS:
+        return jsonify({"error": f"window must be one of: {', '.join(TRENDING_WINDOWS)}"}), 400
+    category = request.args.get("category", "all")
+    top = parse_top(request.args.get("top"))
+    try:
+        rows = popular_wallpapers(device_type, window, None if category == "all" else category, top)
+        body = EncodedBody.json(rows)
+        validators = (body.etag, None)
+    except Exception as e:
+        log.exception("Error ranking wallpapers: %s", e)
+        body, validators = EncodedBody.json([]), None
+    return cached_response("popular", validators, lambda: body)
 
-    popular_wallpapers = sorted(wallpapers, key=lambda x: int(x.get("download_count") or 0), reverse=True)[:6]
-    return jsonify(popular_wallpapers)
+@app.route("/api/bootstrap")
+def api_bootstrap():
+    """First-paint state for the gallery and analytics pages, see bootstrap_state().
+
+    Query params: device, limit (first page size, as /api/wallpapers) and
+    top (number of popular wallpapers, default 6).
+    """
+    device_type = request.args.get("device", "mobile")
+    limit = parse_limit(request.args.get("limit"))
+    top = parse_top(request.args.get("top"))
+    try:
+        state, complete = bootstrap_state(device_type, limit, top)
+        body = EncodedBody.json(state)
+        validators = (body.etag, None) if complete else None
+    except Exception as e:
+        log.exception("Error building bootstrap state: %s", e)
+        body, validators = EncodedBody.json(empty_bootstrap_state(device_type)), None
+    return cached_response("bootstrap", validators, lambda: body)
 
 @app.route("/api/stats")
 def get_download_stats():
     device_type = request.args.get("device", "mobile")
-    wallpapers = []
-    if supabase:
-        try:
-            wq = supabase.table("wallpapers").select("*")
-            if device_type in ("mobile","pc"):
-                wq = wq.eq("device_type", device_type)
-            wres = wq.execute()
-            wallpapers = wres.data or []
-        except Exception as e:
-            log.exception("Error fetching wallpapers for stats: %s", e)
-            wallpapers = []
-    else:
-        db = load_database()
-        wallpapers = db.get("wallpapers", [])
-
-    wallpaper_ids = {w["id"] for w in wallpapers if w.get("id")}
-    downloads = []
-    if supabase:
-        try:
-            dres = supabase.table("downloads").select("*").order("timestamp", desc=True).limit(1000).execute()
-            downloads = [d for d in (dres.data or []) if d.get("wallpaper_id") in wallpaper_ids]
-        except Exception as e:
-            log.exception("Error fetching downloads: %s", e)
-            downloads = []
-    else:
-        db = load_database()
-        downloads = [d for d in db.get("downloads", []) if d.get("wallpaper_id") in wallpaper_ids]
-
-    total_downloads = len(downloads)
-    total_wallpapers = len(wallpapers)
-    yesterday = datetime.utcnow() - timedelta(days=1)
-    recent_downloads = [
-        d for d in downloads
-        if d.get("timestamp") and datetime.fromisoformat(str(d["timestamp"]).replace("Z","")) > yesterday
-    ]
-
-    by_id = {w["id"]: w for w in wallpapers}
-    cat_counts = Counter()
-    for d in downloads:
-        w = by_id.get(d.get("wallpaper_id"))
-        if w:
-            cat_counts[w.get("category", "uncategorized")] += 1
-
-    stats = {
-        "total_downloads": total_downloads,
-        "total_wallpapers": total_wallpapers,
-        "downloads_24h": len(recent_downloads),
-        "popular_categories": dict(cat_counts.most_common(5))
-    }
-    return jsonify(stats)
+    try:
+        body = EncodedBody.json(download_stats.snapshot(device_type))
+        validators = (body.etag, None)
+    except Exception as e:
+        log.exception("Error computing download stats: %s", e)
+        body = EncodedBody.json(empty_stats())
+        validators = None
+    return cached_response("stats", validators, lambda: body)
 
 @app.route("/api/delete-wallpaper/<wallpaper_id>", methods=["DELETE"])
 def delete_wallpaper(wallpaper_id):
+    """Delete one wallpaper. Requires ?secret= like the batch delete."""
+    if request.args.get("secret") != SECRET_CODE:
+        return jsonify({"error": "Unauthorized"}), 403
     try:
         if not supabase:
             return jsonify({"error":"Server not configured with Supabase"}), 500
 
-        wres = supabase.table("wallpapers").select("*").eq("id", wallpaper_id).limit(1).execute()
-        rows = wres.data or []
-        if not rows:
+        result = delete_wallpapers([wallpaper_id])[wallpaper_id]
+        if result["status"] == "not_found":
             return jsonify({"error":"Wallpaper not found"}), 404
-        w = rows[0]
-        file_path = w.get("file_path")
-        if file_path:
-            try:
-                supabase.storage.from_(BUCKET_NAME).remove([file_path])
-            except Exception as stg_e:
-                log.warning("Storage remove error (best-effort): %s", stg_e)
-        supabase.table("downloads").delete().eq("wallpaper_id", wallpaper_id).execute()
-        supabase.table("wallpapers").delete().eq("id", wallpaper_id).execute()
-        return jsonify({"success": True, "message": f'Wallpaper \"{w.get("title")}\" deleted successfully'})
+        if result["status"] == "failed":
+            return jsonify({"error": result["error"]}), 500
+        return jsonify({"success": True, "message": f'Wallpaper \"{result.get("title")}\" deleted successfully'})
     except Exception as e:
         log.exception("Error deleting wallpaper: %s", e)
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/wallpapers/batch-delete", methods=["POST"])
+def batch_delete_wallpapers():
+    """Delete several wallpapers: {"ids": [...]} (at most BATCH_DELETE_MAX).
+
+    Answers with counts and one result per distinct id, in request order:
+    deleted, not_found or failed (with an error). Requires ?secret= like /upload.
+    """
+    if request.args.get("secret") != SECRET_CODE:
+        return jsonify({"error": "Unauthorized"}), 403
+    data = request.get_json(silent=True) or {}
+    ids = data.get("ids")
+    if not isinstance(ids, list) or not all(isinstance(wid, str) and wid for wid in ids):
+        return jsonify({"error": "ids must be a list of wallpaper ids"}), 400
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return jsonify({"error": "No ids given"}), 400
+    if len(ids) > BATCH_DELETE_MAX:
+        return jsonify({"error": f"At most {BATCH_DELETE_MAX} ids per request"}), 400
+    if not supabase:
+        return jsonify({"error":"Server not configured with Supabase"}), 500
+
+    try:
+        results = list(delete_wallpapers(ids).values())
+    except Exception as e:
+        log.exception("Error batch deleting %d wallpapers: %s", len(ids), e)
+        return jsonify({"error": str(e)}), 500
+    counts = Counter(r["status"] for r in results)
+    return jsonify({
+        "deleted": counts["deleted"], "not_found": counts["not_found"], "failed": counts["failed"],
+        "results": results,
+    })
+
 @app.route("/admin/analytics")
 def admin_analytics():
     secret = request.args.get("secret")
     if secret != SECRET_CODE:
         return "Unauthorized", 403
-    return render_template("analytics.html", authorized=True)
+    try:
+        state, _ = bootstrap_state("mobile", top=ANALYTICS_TOP)
+    except Exception as e:
+        log.exception("Error building bootstrap state: %s", e)
+        state = empty_bootstrap_state("mobile")
+    return render_template("analytics.html", authorized=True, bootstrap=state)
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus scrape endpoint (all gunicorn workers, see gunicorn.conf.py)."""
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return "Unauthorized", 401
+    if not instrumentation.enabled():
+        return "prometheus_client is not installed", 501
+    body, content_type = instrumentation.render_metrics()
+    resp = make_response(body)
+    resp.headers["Content-Type"] = content_type
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
 
 @app.route("/health")
 def health_check():
-    return jsonify({"status":"healthy", "timestamp": datetime.utcnow().isoformat()})
+    return jsonify({
+        "status":"healthy",
+        "timestamp": datetime.utcnow().isoformat(),
+        "catalog_cache": catalog_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "download_queue": download_queue.stats(),
+        "replica_mirror": replica_mirror.stats(),
+        "supabase": supabase.stats() if isinstance(supabase, SupabaseGateway) else {"backend": "local" if using_local_store() else None},
+        "uploads": dict(upload_stats, memory_budget=UPLOAD_MEMORY_BUDGET, dedup=UPLOAD_DEDUP, peak_rss=peak_rss())
+    })
 
 # ---------- Entrypoint ----------
 if __name__ == "__main__":
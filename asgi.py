@@ -0,0 +1,239 @@
+# asgi.py
+"""ASGI entry point: the same app served from an asyncio event loop.
+
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+
+app.py stays a Flask app and keeps every route. Here it runs on a pool of
+WSGI_THREADS threads per worker (a2wsgi), so a request waiting on Supabase
+no longer holds the whole worker the way a sync gunicorn worker does. For
+the endpoints that need several independent reads, warm() first sends
+whichever of them are missing together on the async Supabase client
+(fan_out) and fills the same caches; the Flask route then answers from
+them:
+
+- /, /api/bootstrap, /api/popular: the device's catalog rows (unless cached)
+  and, when the download stats are due for a reseed, the full catalog and
+  the 7-day download buckets
+- /api/stats: the reseed reads only
+
+A Flask route run on its own would make those reads one after the other.
+Without Supabase credentials (local store) they run in threads.
+
+/api/activity/stream is served here too: the SSE stream waits on the event
+loop instead of holding one of the WSGI threads for as long as the analytics
+page is open.
+"""
+import os
+import time
+import asyncio
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+
+import app as vault
+
+WSGI_THREADS = int(os.environ.get("WSGI_THREADS", "32"))
+
+log = vault.log
+wsgi = WSGIMiddleware(vault.app, workers=WSGI_THREADS)
+
+# ---------- Async reads ----------
+async def fan_out(*aws):
+    """Await independent reads concurrently; results in order, exceptions in place."""
+    return await asyncio.gather(*aws, return_exceptions=True)
+
+def _gateway():
+    gateway = vault.supabase
+    if isinstance(gateway, vault.SupabaseGateway) and gateway.aclient is not None:
+        return gateway
+    return None
+
+async def read(query):
+    """query(db).execute() on the async client, or on the sync one in a thread."""
+    gateway = _gateway()
+    if gateway is None:
+        return await asyncio.to_thread(lambda: query(vault.supabase).execute())
+    return await gateway.aexecute(query)
+
+async def query_wallpapers(device_type, replica=True):
+    """app._query_wallpapers() on the async client (replica fallback and mirror included)."""
+    if _gateway() is None:
+        return await asyncio.to_thread(vault._query_wallpapers, device_type, replica)
+    try:
+        rows = (await read(lambda db: vault.wallpapers_query(db, device_type))).data or []
+    except Exception as e:
+        if vault.local_store is None or not replica:
+            raise
+        return await asyncio.to_thread(vault.replica_wallpapers, device_type, e)
+    if vault.local_store is not None:
+        vault.mirror_catalog(device_type, rows)
+    return rows
+
+async def query_download_buckets(since, replica=True):
+    try:
+        res = await read(lambda db: db.rpc("download_buckets", {"since": since}))
+        return vault.parse_download_buckets(res.data)
+    except Exception as e:
+        log.warning("download_buckets RPC unavailable, reading raw downloads: %s", e)
+        vault.FALLBACKS.labels("download_buckets_raw").inc()
+    return await asyncio.to_thread(vault.query_raw_download_buckets, since, replica)
+
+# ---------- Async routes ----------
+def _args(scope):
+    return {k: v[0] for k, v in parse_qs(scope.get("query_string", b"").decode("latin-1")).items()}
+
+ACTIVITY_POLL = 0.5   # seconds between checks of the in-memory log
+
+async def _until_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+async def api_activity_stream(scope, receive, send):
+    """app.api_activity_stream(), kept open for ACTIVITY_STREAM_SECONDS on any worker."""
+    started = time.perf_counter()
+    args = _args(scope)
+    activity_type = args.get("type", "all")
+    device_type = args.get("device", "mobile")
+    headers = dict(scope.get("headers") or [])
+    last_id = headers.get(b"last-event-id", b"").decode("latin-1") or args.get("last_event_id")
+    activity = vault.activity_log
+
+    await asyncio.to_thread(activity.refresh)
+    after = activity.parse_event_id(last_id)
+    reset = after is None and bool(last_id)
+    if after is None:
+        after = activity.last_seq()
+
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream; charset=utf-8"),
+        (b"cache-control", b"no-store"),
+        (b"x-accel-buffering", b"no"),
+    ]})
+    body = f"retry: {vault.ACTIVITY_STREAM_RETRY_MS}\n\n"
+    if reset:
+        body += vault.sse_event(activity.event_id(after), {"type": "reset"}, "reset")
+    disconnected = asyncio.ensure_future(_until_disconnect(receive))
+    deadline = time.monotonic() + vault.ACTIVITY_STREAM_SECONDS
+    next_refresh = next_ping = time.monotonic()
+    try:
+        while not disconnected.done() and time.monotonic() < deadline:
+            after, chunk = vault.activity_stream_events(after, activity_type, device_type)
+            body += chunk
+            now = time.monotonic()
+            if not body and now >= next_ping:
+                body = ": ping\n\n"
+            if body:
+                await send({"type": "http.response.body", "body": body.encode(), "more_body": True})
+                body, next_ping = "", now + vault.ACTIVITY_HEARTBEAT
+            if now >= next_refresh:
+                await asyncio.to_thread(activity.refresh)
+                next_refresh = now + vault.ACTIVITY_HEARTBEAT
+            await asyncio.wait([disconnected], timeout=ACTIVITY_POLL)
+        if not disconnected.done():
+            await send({"type": "http.response.body", "body": b""})
+    finally:
+        disconnected.cancel()
+        # not routed through Flask, so its after_request timing doesn't apply
+        vault.HTTP_LATENCY.labels("/api/activity/stream", "GET", "200").observe(time.perf_counter() - started)
+
+async def hold(lock):
+    """Acquire a threading lock without blocking the loop.
+
+    Polled rather than acquired in a thread: a cancelled task must not leave
+    a thread behind that takes the lock after nobody is left to release it.
+    """
+    while not lock.acquire(blocking=False):
+        await asyncio.sleep(0.01)
+
+async def warm(device_type, catalog=True):
+    """Run the reads a request for device_type still needs, concurrently.
+
+    Fills catalog_cache with the device's rows (catalog=True, unless cached)
+    and reseeds download_stats if due. A failed read is left to the Flask
+    route, which retries it with its own fallbacks.
+    """
+    stats = vault.download_stats
+    key = vault.catalog_key(device_type)
+    load = catalog and not vault.catalog_cache.cached(key)
+    seed = stats.begin_seed()
+    if not (load or seed):
+        return
+    try:
+        version = vault.catalog_cache.version()
+        reads = {}
+        if seed:
+            replica = not stats.seeded()   # as DownloadStats.seed()
+            reads["all"] = lambda: query_wallpapers("all", replica)
+            reads["buckets"] = lambda: query_download_buckets(vault.stats_since(), replica)
+        if load and key[1] not in reads:
+            reads[key[1]] = lambda: query_wallpapers(key[1])
+        barrier = vault.download_queue.flush_barrier
+        if seed:
+            # as DownloadStats.seed(): no flush between the pending snapshot and the reads
+            await hold(barrier)
+        try:
+            pending = vault.download_queue.pending_events() if seed else None
+            results = dict(zip(reads, await fan_out(*(read() for read in reads.values()))))
+        finally:
+            if seed:
+                barrier.release()
+        if seed:
+            rows, buckets = results["all"], results["buckets"]
+            if isinstance(rows, Exception) or isinstance(buckets, Exception):
+                vault.FALLBACKS.labels("stale_stats").inc()
+                log.warning("Async stats reseed failed: %s", rows if isinstance(rows, Exception) else buckets)
+            else:
+                stats.load(version, pending, rows, buckets)
+    finally:
+        if seed:
+            stats.end_seed()
+    rows = results.get(key[1])
+    if load and rows is not None and not isinstance(rows, Exception):
+        vault.catalog_cache.put(key, rows, version)
+
+def warmed(catalog=True):
+    """An async route: warm() for the request's device, then the Flask route."""
+    async def route(scope, receive, send):
+        try:
+            await warm(_args(scope).get("device", "mobile"), catalog)
+        except Exception as e:
+            log.exception("Warming %s failed, the route reads for itself: %s", scope["path"], e)
+        await wsgi(scope, receive, send)
+    return route
+
+ASYNC_ROUTES = {
+    "/api/activity/stream": api_activity_stream,
+    "/": warmed(),
+    "/api/bootstrap": warmed(),
+    "/api/popular": warmed(),
+    "/api/stats": warmed(catalog=False),
+}
+
+# ---------- ASGI app ----------
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await vault.init_async_supabase()
+            except Exception as e:
+                log.exception("Failed to initialize async Supabase client, reads stay on threads: %s", e)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            gateway = _gateway()
+            if gateway is not None:
+                await gateway.aclient.postgrest.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    handler = None
+    if scope["type"] == "http" and scope["method"] == "GET":
+        handler = ASYNC_ROUTES.get(scope["path"])
+    if handler is None:
+        await wsgi(scope, receive, send)
+    else:
+        await handler(scope, receive, send)
@@ -0,0 +1,312 @@
+"""Per-endpoint latency, throughput and memory against a local Supabase stand-in.
+
+Each catalog size runs in its own process: a FakeSupabase (benchmarks/
+fake_supabase.py) is seeded with that many wallpapers and a download
+history, installed behind SupabaseGateway as app.supabase, and every
+endpoint is driven through Flask's test client. Per endpoint it reports:
+
+- cold: one request right after the catalog cache was invalidated, then
+  --warmup seconds for whatever it started in the background
+- p50/p95/p99/mean and req/s over --requests warm requests, --concurrency
+  threads in flight (injected latency is a sleep, so threads overlap on it)
+- Supabase calls per warm request (seen by the fake)
+- peak Python allocation (tracemalloc) over a cold request plus a few warm
+  ones, measured in a separate pass so tracing doesn't skew the timings
+- the process' peak RSS once the endpoint has run
+
+    python benchmarks/endpoints.py
+    python benchmarks/endpoints.py --sizes 1000 10000 100000 --latency 30 --jitter 10 --output bench.json
+    python benchmarks/endpoints.py --endpoints index wallpapers search --compare bench.json
+
+--output writes the results as JSON; --compare reads a previous --output
+file, prints p95 and req/s changes per size and endpoint, and exits 1 when
+either moved by more than --threshold in the wrong direction.
+
+At 100k wallpapers most of the run is cold cache fills, the traced ones
+several times slower; --memory-requests 0 skips the tracemalloc pass.
+"""
+import argparse
+import io
+import itertools
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SECRET = "bench"
+
+def _rotate(rows, i):
+    return rows[(i * 7919) % len(rows)]
+
+def _png(i):
+    from PIL import Image
+    out = io.BytesIO()
+    Image.new("RGB", (16, 32), ((i * 97) % 256, (i // 256) % 256, i % 251)).save(out, "PNG")
+    return out.getvalue()
+
+# name -> (i, ctx) -> (method, path, test client kwargs)
+ENDPOINTS = {
+    "index": lambda i, ctx: ("GET", "/?device=mobile", {}),
+    "bootstrap": lambda i, ctx: ("GET", "/api/bootstrap?device=mobile", {}),
+    "wallpapers": lambda i, ctx: ("GET", "/api/wallpapers?device=mobile&limit=60", {}),
+    "wallpapers_deep": lambda i, ctx: ("GET", f"/api/wallpapers?device=mobile&limit=60&cursor={ctx['cursor']}", {}),
+    "wallpapers_category": lambda i, ctx: ("GET", "/api/wallpapers?device=mobile&category=neon&limit=60", {}),
+    "search": lambda i, ctx: ("GET", "/api/wallpapers?device=mobile&search=galaxy&limit=60", {}),
+    "search_fuzzy": lambda i, ctx: ("GET", "/api/wallpapers?device=mobile&search=galxy&fuzzy=1&limit=60", {}),
+    "suggest": lambda i, ctx: ("GET", "/api/suggest?device=mobile&q=au", {}),
+    "popular": lambda i, ctx: ("GET", "/api/popular?device=mobile", {}),
+    "popular_24h": lambda i, ctx: ("GET", "/api/popular?device=mobile&window=24h", {}),
+    "popular_category": lambda i, ctx: ("GET", "/api/popular?device=all&window=7d&category=space&top=20", {}),
+    "stats": lambda i, ctx: ("GET", "/api/stats?device=all", {}),
+    "activity": lambda i, ctx: ("GET", "/api/activity?device=all", {}),
+    "download": lambda i, ctx: ("GET", f"/download/{_rotate(ctx['rows'], i)['filename']}", {}),
+    "download_track": lambda i, ctx: ("GET", f"/download/{_rotate(ctx['rows'], i)['filename']}?track=1", {}),
+    "track_download": lambda i, ctx: (
+        "POST", "/api/track-download", {"json": {"wallpaper_id": _rotate(ctx["rows"], i)["id"]}},
+    ),
+}
+# run with --writes; they change the catalog, so they go last
+WRITE_ENDPOINTS = {
+    "upload": lambda i, ctx: ("POST", f"/upload?secret={SECRET}", {
+        "data": {"title": f"Bench {i}", "category": "neon", "device_type": "mobile",
+                 "files": (io.BytesIO(_png(next(ctx["png"]))), f"bench-{i}.png")},
+        "content_type": "multipart/form-data",
+    }),
+    "delete": lambda i, ctx: ("DELETE", f"/api/delete-wallpaper/{ctx['uploaded'].pop()}", {}),
+}
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * p))]
+
+# ---------- One size (child process) ----------
+def request(client, endpoint, i, ctx):
+    method, path, kwargs = endpoint(i, ctx)
+    headers = {"Accept-Encoding": "gzip", "Accept": "application/json" if method != "GET" else "*/*"}
+    start = time.perf_counter()
+    resp = client.open(path, method=method, headers=headers, **kwargs)
+    elapsed = time.perf_counter() - start
+    if resp.status_code == 200 and path.startswith("/upload"):
+        ctx["uploaded"].extend(f["id"] for f in resp.get_json()["files"] if f.get("id"))
+    return elapsed, resp.status_code < 400
+
+def drive(vault, endpoint, ctx, requests, concurrency):
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        nonlocal errors
+        client = vault.app.test_client()
+        for i in iter(lambda: next(counter, None), None):
+            elapsed, ok = request(client, endpoint, i, ctx)
+            with lock:
+                latencies.append(elapsed)
+                errors += not ok
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sorted(latencies), errors, time.perf_counter() - started
+
+def measure(vault, fake, endpoint, ctx, args):
+    client = vault.app.test_client()
+    vault.catalog_cache.bump()
+    cold, _ = request(client, endpoint, 0, ctx)
+    time.sleep(args.warmup)   # background work the cold request started (index rebuilds)
+
+    calls_before = sum(fake.calls.values())
+    latencies, errors, elapsed = drive(vault, endpoint, ctx, args.requests, args.concurrency)
+    calls = sum(fake.calls.values()) - calls_before
+
+    peak = 0
+    if args.memory_requests:
+        vault.catalog_cache.bump()
+        tracemalloc.start()
+        for i in range(args.memory_requests):
+            request(client, endpoint, i, ctx)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "cold_ms": cold * 1000,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": (statistics.fmean(latencies) if latencies else 0.0) * 1000,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "supabase_calls": calls / max(len(latencies), 1),
+        "peak_alloc_kb": peak / 1024,
+        "max_rss_kb": vault.peak_rss() / 1024,
+    }
+
+def run_size(size, workdir, args):
+    """Seed, install and measure one catalog size (runs in a child process)."""
+    import app as vault
+    from fake_supabase import FakeSupabase, seed
+
+    vault.log.setLevel(logging.WARNING)   # per-upload info lines would drown the progress output
+
+    fake = FakeSupabase(os.path.join(workdir, "supabase"), args.latency / 1000, args.jitter / 1000)
+    started = time.perf_counter()
+    rows = seed(fake, size, int(size * args.downloads_per_wallpaper))
+    seeded = time.perf_counter() - started
+    vault.supabase = vault.SupabaseGateway(fake)
+    vault.SECRET_CODE = SECRET
+
+    mobile = [r for r in rows if r["device_type"] == "mobile"]
+    ctx = {"rows": mobile, "uploaded": [], "png": itertools.count(), "cursor": ""}
+    client = vault.app.test_client()
+    for _ in range(min(5, len(mobile) // 60)):   # a few pages in, like infinite scroll
+        next_cursor = client.get(f"/api/wallpapers?device=mobile&limit=60&cursor={ctx['cursor']}").headers.get("X-Next-Cursor")
+        if not next_cursor:
+            break
+        ctx["cursor"] = next_cursor
+
+    endpoints = {name: ENDPOINTS[name] for name in args.endpoints}
+    if args.writes:
+        endpoints.update(WRITE_ENDPOINTS)
+    results = {}
+    for name, endpoint in endpoints.items():
+        results[name] = measure(vault, fake, endpoint, ctx, args)
+        print(f"  {size:>7} {name:<20} p95 {results[name]['p95_ms']:8.2f}ms", file=sys.stderr)
+    vault.download_queue.flush()
+    return {
+        "size": size,
+        "downloads": int(size * args.downloads_per_wallpaper),
+        "seed_s": seeded,
+        "max_rss_kb": vault.peak_rss() / 1024,
+        "endpoints": results,
+    }
+
+# ---------- Parent ----------
+def spawn(size, args):
+    workdir = tempfile.mkdtemp(prefix=f"vault-bench-{size}-")
+    env = dict(os.environ)
+    for key in ("SUPABASE_SERVICE_ROLE", "SUPABASE_ANON_KEY", "SUPABASE_KEY", "PROMETHEUS_MULTIPROC_DIR"):
+        env.pop(key, None)
+    env.update(
+        LOCAL_DB=os.path.join(workdir, "replica.sqlite3"),
+        CATALOG_STAMP_FILE=os.path.join(workdir, "catalog.stamp"),
+    )
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", str(size), "--workdir", workdir,
+           "--child-args", json.dumps(vars(args))]
+    try:
+        proc = subprocess.run(cmd, cwd=ROOT, env=env)
+        if proc.returncode != 0:
+            raise SystemExit(f"benchmark for {size} wallpapers exited with {proc.returncode}")
+        with open(os.path.join(workdir, "result.json")) as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(report):
+    meta = report["meta"]
+    print(f"latency {meta['latency_ms']:.0f}ms +{meta['jitter_ms']:.0f}ms jitter, {meta['concurrency']} concurrent, "
+          f"{meta['requests']} requests per endpoint")
+    print(f"{'size':>7}  {'endpoint':<20} {'cold':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'req/s':>8} "
+          f"{'calls':>6} {'alloc':>9} {'rss':>9} {'err':>4}")
+    for run in report["runs"]:
+        for name, r in run["endpoints"].items():
+            print(f"{run['size']:>7}  {name:<20} {r['cold_ms']:>7.1f}ms {r['p50_ms']:>7.2f}ms {r['p95_ms']:>7.2f}ms "
+                  f"{r['p99_ms']:>7.2f}ms {r['rps']:>8.1f} {r['supabase_calls']:>6.2f} "
+                  f"{r['peak_alloc_kb'] / 1024:>7.1f}MB {r['max_rss_kb'] / 1024:>7.1f}MB {r['errors']:>4}")
+
+def compare(report, baseline, threshold):
+    """Print p95/req/s changes against a previous report; returns the regressions."""
+    previous = {(run["size"], name): r for run in baseline["runs"] for name, r in run["endpoints"].items()}
+    regressions = []
+    print(f"\nvs {baseline['meta'].get('commit') or 'baseline'} ({baseline['meta'].get('timestamp')}), "
+          f"threshold {threshold:.0%}")
+    print(f"{'size':>7}  {'endpoint':<20} {'p95':>18} {'change':>8} {'req/s':>18} {'change':>8}")
+    for run in report["runs"]:
+        for name, r in run["endpoints"].items():
+            old = previous.get((run["size"], name))
+            if old is None:
+                continue
+            p95 = r["p95_ms"] / old["p95_ms"] - 1 if old["p95_ms"] else 0.0
+            rps = r["rps"] / old["rps"] - 1 if old["rps"] else 0.0
+            flag = ""
+            if p95 > threshold or rps < -threshold:
+                regressions.append((run["size"], name))
+                flag = "  REGRESSION"
+            print(f"{run['size']:>7}  {name:<20} {old['p95_ms']:>7.2f}->{r['p95_ms']:>7.2f}ms {p95:>+8.1%} "
+                  f"{old['rps']:>8.1f}->{r['rps']:>8.1f} {rps:>+8.1%}{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="catalog sizes")
+    parser.add_argument("--downloads-per-wallpaper", type=float, default=2.0, help="download history size")
+    parser.add_argument("--endpoints", nargs="+", choices=list(ENDPOINTS), default=list(ENDPOINTS))
+    parser.add_argument("--writes", action="store_true", help="also measure upload and delete")
+    parser.add_argument("--requests", type=int, default=200, help="warm requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=4, help="threads in flight")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds between the cold and warm requests")
+    parser.add_argument("--memory-requests", type=int, default=5, help="requests in the tracemalloc pass (0 skips it)")
+    parser.add_argument("--latency", type=float, default=0, help="injected ms per Supabase call")
+    parser.add_argument("--jitter", type=float, default=0, help="up to this many extra ms per call")
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--compare", help="JSON from a previous --output run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed p95/req/s change for --compare")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--child-args", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        result = run_size(args.child, args.workdir, argparse.Namespace(**json.loads(args.child_args)))
+        with open(os.path.join(args.workdir, "result.json"), "w") as f:
+            json.dump(result, f)
+        return
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "latency_ms": args.latency,
+            "jitter_ms": args.jitter,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "writes": args.writes,
+        },
+        "runs": [spawn(size, args) for size in args.sizes],
+    }
+    print_results(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""In-process Supabase stand-in for benchmarks, with injected latency.
+
+The query engine is local_store.LocalStore (the same table()/rpc()/storage
+surface app.py falls back to), on its own SQLite file and object directory.
+FakeSupabase wraps it so every execute() and storage call first sleeps for
+`latency` seconds (plus up to `jitter`), roughly what one round trip to a
+hosted project costs. Because it is not app.local_store, app.py treats it as
+a remote backend: gateway, replica mirroring and storage redirects all run.
+
+    fake = FakeSupabase(tmpdir, latency=0.03, jitter=0.01)
+    seed(fake, wallpapers=10000, downloads=20000)
+    vault.supabase = vault.SupabaseGateway(fake)
+"""
+import os
+import sys
+import time
+import uuid
+import random
+import hashlib
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from local_store import LocalStore  # noqa: E402
+
+CATEGORIES = ["nature", "space", "abstract", "cars", "anime", "minimal", "city", "neon"]
+WORDS = ["amoled", "dark", "black", "glow", "night", "mountain", "galaxy", "ocean",
+         "forest", "skyline", "drift", "retro", "pixel", "storm", "aurora", "void"]
+DERIVATIVES = (("thumb", 480), ("preview", 1280), ("full", 1440))
+
+class FakeSupabase:
+    def __init__(self, root, latency=0.0, jitter=0.0, url="https://bench.supabase.invalid"):
+        os.makedirs(root, exist_ok=True)
+        self.store = LocalStore(os.path.join(root, "supabase.sqlite3"), os.path.join(root, "objects"))
+        self.latency = latency
+        self.jitter = jitter
+        self.url = url
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def delay(self, target):
+        with self._lock:
+            self.calls[target] += 1
+        seconds = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def table(self, name):
+        return _Delayed(self, self.store.table(name), f"table:{name}")
+
+    def rpc(self, fn, params=None):
+        return _Delayed(self, self.store.rpc(fn, params), f"rpc:{fn}")
+
+    @property
+    def storage(self):
+        return _DelayedStorage(self)
+
+class _Delayed:
+    """A query builder whose execute() pays the injected round trip."""
+
+    def __init__(self, fake, builder, target):
+        self._fake = fake
+        self._builder = builder
+        self._target = target
+
+    def execute(self):
+        self._fake.delay(self._target)
+        return self._builder.execute()
+
+    def __getattr__(self, name):
+        attr = getattr(self._builder, name)
+        if not callable(attr):
+            return attr
+
+        def chained(*args, **kwargs):
+            return _Delayed(self._fake, attr(*args, **kwargs), self._target)
+        return chained
+
+class _DelayedStorage:
+    def __init__(self, fake):
+        self._fake = fake
+
+    def from_(self, bucket):
+        return _DelayedBucket(self._fake, bucket)
+
+class _DelayedBucket:
+    def __init__(self, fake, bucket):
+        self._fake = fake
+        self._bucket = fake.store.storage.from_(bucket)
+        self._target = f"storage:{bucket}"
+        self._name = bucket
+
+    def upload(self, path, file, file_options=None):
+        self._fake.delay(self._target)
+        return self._bucket.upload(path, file, file_options)
+
+    def download(self, path):
+        self._fake.delay(self._target)
+        return self._bucket.download(path)
+
+    def remove(self, paths):
+        self._fake.delay(self._target)
+        return self._bucket.remove(paths)
+
+    def get_public_url(self, path):
+        return f"{self._fake.url}/storage/v1/object/public/{self._name}/{path}"
+
+# ---------- Synthetic data ----------
+def make_wallpapers(n, url="https://bench.supabase.invalid", bucket="wallpapers", now=None):
+    """n catalog rows: two thirds mobile, uploads spread over the last year."""
+    now = now or datetime.utcnow()
+    rng = random.Random(n)
+    rows = []
+    for i in range(n):
+        device = "pc" if i % 3 == 0 else "mobile"
+        category = CATEGORIES[i % len(CATEGORIES)]
+        digest = hashlib.sha256(f"{n}:{i}".encode()).hexdigest()
+        path = f"{device}/{digest}.png"
+        public = f"{url}/storage/v1/object/public/{bucket}"
+        rows.append({
+            "id": str(uuid.UUID(int=i + 1)),
+            "title": f"{rng.choice(WORDS).title()} {rng.choice(WORDS)} {category} #{i}",
+            "category": category,
+            "device_type": device,
+            "filename": f"{digest}.png",
+            "file_path": path,
+            "file_url": f"{public}/{path}",
+            "upload_date": (now - timedelta(minutes=i * 525600 // max(n, 1), seconds=i % 60)).isoformat(),
+            # a long tail: a few wallpapers take most of the downloads
+            "download_count": int(5000 / (1 + (i * 7919) % n)) + (i * 31) % 50,
+            "derivatives": {
+                name: {
+                    "path": f"{device}/{digest}.{name}.webp",
+                    "url": f"{public}/{device}/{digest}.{name}.webp",
+                    "width": width,
+                    "height": width * 2 if device == "mobile" else width * 9 // 16,
+                }
+                for name, width in DERIVATIVES
+            } if i % 4 else None,   # some rows predate derivatives
+        })
+    return rows
+
+def make_downloads(wallpapers, n, days=7, now=None):
+    """n download events over the last `days`, skewed towards popular rows."""
+    now = now or datetime.utcnow()
+    rng = random.Random(len(wallpapers) * 31 + n)
+    ids = [w["id"] for w in wallpapers]
+    weights = [int(w["download_count"]) + 1 for w in wallpapers]
+    picks = rng.choices(ids, weights=weights, k=n) if ids else []
+    span = days * 86400
+    return [
+        {
+            "wallpaper_id": wid,
+            "ip": f"10.{i % 256}.{(i // 256) % 256}.{rng.randrange(1, 255)}",
+            "timestamp": (now - timedelta(seconds=rng.randrange(span))).isoformat(),
+        }
+        for i, wid in enumerate(picks)
+    ]
+
+def seed(fake, wallpapers, downloads, days=7):
+    """Fill the fake with a synthetic catalog and download history; returns the catalog rows."""
+    rows = make_wallpapers(wallpapers, url=fake.url)
+    fake.store.insert_rows("wallpapers", rows, replace_where=("", []))
+    fake.store.insert_rows("downloads", make_downloads(rows, downloads, days), replace_where=("", []))
+    return rows
@@ -0,0 +1,110 @@
+"""Encode time and bytes on the wire for /api/wallpapers-sized payloads.
+
+Compares Flask's jsonify (stdlib json, what the routes used to do on every
+request) with the EncodedBody path in app.py: orjson when installed, plus
+gzip/brotli variants that are built once per cache fill. The last column
+shows what a repeat request costs once the body is cached.
+
+    python benchmarks/json_responses.py
+    python benchmarks/json_responses.py --rows 1000 10000 50000 --repeat 10
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+import hashlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as vault  # noqa: E402
+
+CATEGORIES = ["nature", "space", "abstract", "cars", "anime", "minimal", "city", "neon"]
+
+def make_catalog(n):
+    rows = []
+    for i in range(n):
+        device = "mobile" if i % 3 else "pc"
+        digest = hashlib.sha256(str(i).encode()).hexdigest()
+        path = f"{device}/{digest}.png"
+        rows.append({
+            "id": str(uuid.UUID(int=i)),
+            "title": f"Amoled {CATEGORIES[i % len(CATEGORIES)]} wallpaper #{i}",
+            "category": CATEGORIES[i % len(CATEGORIES)],
+            "device_type": device,
+            "filename": f"{digest}.png",
+            "file_path": path,
+            "file_url": vault.public_storage_url(path),
+            "upload_date": f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d}T12:{i % 60:02d}:00",
+            "download_count": (i * 7919) % 5000,
+            "derivatives": {
+                name: {
+                    "path": f"{device}/{digest}.{name}.webp",
+                    "url": vault.public_storage_url(f"{device}/{digest}.{name}.webp"),
+                    "width": width,
+                    "height": width * 2 if device == "mobile" else width * 9 // 16,
+                }
+                for name, width in (("thumb", 480), ("preview", 1280), ("full", 1440))
+            },
+        })
+    return rows
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000, result
+
+def run(rows, repeat):
+    catalog = make_catalog(rows)
+    out = {"rows": rows}
+
+    with vault.app.test_request_context():
+        ms, resp = timed(lambda: vault.jsonify(catalog), repeat)
+        out["jsonify"] = (ms, len(resp.get_data()))
+
+    ms, data = timed(lambda: json.dumps(catalog, separators=(",", ":")).encode(), repeat)
+    out["json"] = (ms, len(data))
+    if vault.orjson is not None:
+        ms, data = timed(lambda: vault.orjson.dumps(catalog), repeat)
+        out["orjson"] = (ms, len(data))
+
+    raw = vault.dumps_json(catalog)
+    ms, data = timed(lambda: vault.compress(raw, "gzip"), repeat)
+    out["gzip"] = (ms, len(data))
+    if vault.brotli is not None:
+        ms, data = timed(lambda: vault.compress(raw, "br"), repeat)
+        out["br"] = (ms, len(data))
+
+    body = vault.EncodedBody.json(catalog)
+    body.encoded("gzip")
+    ms, _ = timed(lambda: body.encoded("gzip"), repeat)
+    out["cached"] = (ms, None)
+    return out
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    columns = ["jsonify", "json", "orjson", "gzip", "br", "cached"]
+    print(f"gzip level {vault.GZIP_LEVEL}, brotli quality {vault.BROTLI_QUALITY}, median of {args.repeat} runs")
+    print(f"{'rows':>8}  " + "  ".join(f"{c:>18}" for c in columns))
+    for rows in args.rows:
+        result = run(rows, args.repeat)
+        cells = []
+        for c in columns:
+            if c not in result:
+                cells.append(f"{'n/a':>18}")
+                continue
+            ms, size = result[c]
+            cells.append(f"{ms:>8.2f}ms " + (f"{size / 1024:>7.1f}KB" if size is not None else " " * 9))
+        print(f"{rows:>8}  " + "  ".join(cells))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""app.py and asgi.py on a FakeSupabase, for serving_modes.py --fake.
+
+Each gunicorn worker imports this module and points the app at the fake
+seeded by serving_modes.py:
+
+    BENCH_SUPABASE_ROOT   FakeSupabase directory
+    BENCH_LATENCY         seconds per Supabase call
+    BENCH_JITTER          extra random seconds per call
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_supabase import FakeSupabase
+import app as vault
+import asgi
+
+vault.supabase = vault.SupabaseGateway(FakeSupabase(
+    os.environ["BENCH_SUPABASE_ROOT"],
+    float(os.environ.get("BENCH_LATENCY", "0")),
+    float(os.environ.get("BENCH_JITTER", "0")),
+))
+
+wsgi_app = vault.app
+asgi_app = asgi.app
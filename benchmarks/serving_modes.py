@@ -0,0 +1,187 @@
+"""Load comparison: sync gunicorn workers (render.yaml's default) vs asgi.py.
+
+Starts both servers from this checkout with the same environment and worker
+count, drives each with the same mix of read requests at a fixed
+concurrency, and prints throughput and latency percentiles per mode.
+
+    python benchmarks/serving_modes.py
+    python benchmarks/serving_modes.py --workers 2 --concurrency 64 --duration 20
+    python benchmarks/serving_modes.py --sync-url http://host:8000 --async-url http://host:8001
+    python benchmarks/serving_modes.py --fake --latency 30 --catalog-ttl 2
+
+The difference shows up when requests wait on the network: against a real
+Supabase project (SUPABASE_URL / SUPABASE_SERVICE_ROLE in the environment)
+or with --fake, which serves both modes from a seeded FakeSupabase with
+--latency ms per call. A short --catalog-ttl makes caches go cold during
+the run, which is when asgi.py's concurrent reads matter; with warm caches
+nothing waits and both modes are CPU bound.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PATHS = [
+    "/",
+    "/api/bootstrap?device=mobile",
+    "/api/wallpapers?device=mobile&limit=60",
+    "/api/activity?device=all",
+    "/api/stats?device=mobile",
+]
+
+MODES = {
+    "sync": ["app:app"],
+    "async": ["asgi:app", "-k", "uvicorn.workers.UvicornWorker"],
+}
+FAKE_MODES = {   # the same entry points on a FakeSupabase (serving_app.py)
+    "sync": ["serving_app:wsgi_app", "--pythonpath", "benchmarks"],
+    "async": ["serving_app:asgi_app", "--pythonpath", "benchmarks", "-k", "uvicorn.workers.UvicornWorker"],
+}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def fake_env(workdir, args):
+    """Seed a FakeSupabase under workdir; the environment serving_app.py reads."""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from fake_supabase import FakeSupabase, seed
+
+    root = os.path.join(workdir, "supabase")
+    seed(FakeSupabase(root), args.size, args.size * 3)
+    env = dict(os.environ)
+    for key in ("SUPABASE_SERVICE_ROLE", "SUPABASE_ANON_KEY", "SUPABASE_KEY"):
+        env.pop(key, None)
+    env.update(
+        BENCH_SUPABASE_ROOT=root,
+        BENCH_LATENCY=str(args.latency / 1000),
+        BENCH_JITTER=str(args.jitter / 1000),
+        LOCAL_DB=os.path.join(workdir, "replica.sqlite3"),
+        CATALOG_STAMP_FILE=os.path.join(workdir, "catalog.stamp"),
+    )
+    return env
+
+def start_server(mode, workers, env=None):
+    port = free_port()
+    entry = (FAKE_MODES if env and "BENCH_SUPABASE_ROOT" in env else MODES)[mode]
+    cmd = [sys.executable, "-m", "gunicorn", *entry, "-w", str(workers),
+           "-b", f"127.0.0.1:{port}", "--log-level", "warning"]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"{mode} server exited with {proc.returncode}")
+        try:
+            if httpx.get(f"{url}/health", timeout=1).status_code == 200:
+                return proc, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit(f"{mode} server did not come up on {url}")
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * p))]
+
+async def drive(url, paths, concurrency, duration, warmup):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+        for path in paths:   # fill the caches the way a running site has them
+            await client.get(path)
+        await asyncio.sleep(warmup)
+
+        latencies, errors = [], 0
+        stop = time.monotonic() + duration
+
+        async def worker(offset):
+            nonlocal errors
+            i = offset
+            while time.monotonic() < stop:
+                path = paths[i % len(paths)]
+                i += 1
+                start = time.perf_counter()
+                try:
+                    resp = await client.get(path)
+                    ok = resp.status_code < 500
+                except httpx.HTTPError:
+                    ok = False
+                latencies.append(time.perf_counter() - start)
+                if not ok:
+                    errors += 1
+
+        started = time.monotonic()
+        await asyncio.gather(*(worker(n) for n in range(concurrency)))
+        elapsed = time.monotonic() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p50": percentile(latencies, 0.50) * 1000,
+        "p95": percentile(latencies, 0.95) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "mean": (statistics.fmean(latencies) if latencies else 0.0) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers per mode")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests in flight")
+    parser.add_argument("--duration", type=float, default=15, help="seconds of load per mode")
+    parser.add_argument("--warmup", type=float, default=1)
+    parser.add_argument("--paths", nargs="+", default=PATHS)
+    parser.add_argument("--sync-url", help="use a running sync server instead of starting one")
+    parser.add_argument("--async-url", help="use a running async server instead of starting one")
+    parser.add_argument("--fake", action="store_true", help="serve from a seeded FakeSupabase")
+    parser.add_argument("--size", type=int, default=2000, help="wallpapers in the fake catalog")
+    parser.add_argument("--latency", type=float, default=30, help="injected ms per fake Supabase call")
+    parser.add_argument("--jitter", type=float, default=0, help="extra random ms per fake call")
+    parser.add_argument("--catalog-ttl", type=float, help="CATALOG_CACHE_TTL / STATS_RESEED_INTERVAL for the servers")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="vault-serving-")
+    env = fake_env(workdir, args) if args.fake else dict(os.environ)
+    if args.catalog_ttl is not None:
+        env.update(CATALOG_CACHE_TTL=str(args.catalog_ttl), STATS_RESEED_INTERVAL=str(args.catalog_ttl))
+    results = {}
+    try:
+        for mode, url in (("sync", args.sync_url), ("async", args.async_url)):
+            proc = None
+            if url is None:
+                proc, url = start_server(mode, args.workers, env)
+            try:
+                results[mode] = asyncio.run(drive(url, args.paths, args.concurrency, args.duration, args.warmup))
+            finally:
+                if proc is not None:
+                    proc.terminate()
+                    proc.wait()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{args.workers} workers, {args.concurrency} concurrent, {args.duration:.0f}s per mode, {len(args.paths)} paths")
+    if args.fake:
+        print(f"FakeSupabase: {args.size} wallpapers, {args.latency:.0f}ms +{args.jitter:.0f}ms per call, "
+              f"catalog ttl {args.catalog_ttl if args.catalog_ttl is not None else 'default'}")
+    print(f"{'mode':>6}  {'requests':>9}  {'errors':>6}  {'req/s':>8}  {'p50':>9}  {'p95':>9}  {'p99':>9}")
+    for mode, r in results.items():
+        print(f"{mode:>6}  {r['requests']:>9}  {r['errors']:>6}  {r['rps']:>8.1f}  "
+              f"{r['p50']:>7.1f}ms  {r['p95']:>7.1f}ms  {r['p99']:>7.1f}ms")
+    if results["sync"]["rps"]:
+        print(f"async/sync throughput: {results['async']['rps'] / results['sync']['rps']:.2f}x")
+
+if __name__ == "__main__":
+    main()
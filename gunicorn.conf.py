@@ -0,0 +1,29 @@
+# gunicorn.conf.py -- read automatically by `gunicorn app:app` and `gunicorn asgi:app`
+import os
+import shutil
+import tempfile
+
+# Prometheus multiprocess mode: each worker writes its samples under this
+# directory and /metrics merges them. It has to be set before the workers
+# import the app, and emptied when the server starts so old pids don't linger.
+multiproc_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "vault-metrics")
+)
+
+# gthread workers: a request waiting on Supabase holds one thread rather than
+# the whole worker, and /api/activity/stream can stay open (on a sync worker
+# each stream would tie up the worker, so it sends one batch and closes).
+# `-k uvicorn.workers.UvicornWorker` on the command line still wins for asgi.py.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+
+def on_starting(server):
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir, exist_ok=True)
+
+def child_exit(server, worker):
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,31 @@
+# imaging.py
+"""Image derivative rendering for app.py's process pool.
+
+Kept apart from app.py on purpose: the pool uses the "spawn" start method,
+so each worker process imports the module its task function lives in.
+Importing app there would open the Supabase client, the SQLite store and
+the thread pools again in every child; this module needs nothing but Pillow.
+"""
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+def render_derivatives(data, sizes, fmt, quality):
+    """Runs in a worker process; `data` is image bytes or a file path.
+
+    sizes is ((name, max long edge or None), ...). Returns {name: (encoded
+    bytes, width, height)}.
+    """
+    out = {}
+    with Image.open(data if isinstance(data, str) else BytesIO(data)) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        for name, edge in sizes:
+            im = img.copy()
+            if edge:
+                im.thumbnail((edge, edge), Image.LANCZOS)
+            buf = BytesIO()
+            im.save(buf, fmt.upper(), quality=quality)
+            out[name] = (buf.getvalue(), im.width, im.height)
+    return out
@@ -0,0 +1,117 @@
+# instrumentation.py
+"""Prometheus metrics and a sampling profiler for app.py.
+
+prometheus_client is optional: without it every metric is a no-op and
+/metrics answers 501. Under gunicorn, gunicorn.conf.py points
+PROMETHEUS_MULTIPROC_DIR at a shared directory before the workers start;
+each worker writes its samples there and /metrics merges them, so a scrape
+sees the whole server whichever worker answers it.
+"""
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+try:  # optional: metrics are no-ops without it
+    import prometheus_client
+    from prometheus_client import CollectorRegistry, generate_latest, multiprocess
+except ImportError:
+    prometheus_client = None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+def _metric(kind, name, documentation, labelnames=(), **kwargs):
+    if prometheus_client is None:
+        return _NoopMetric()
+    return getattr(prometheus_client, kind)(name, documentation, labelnames, **kwargs)
+
+HTTP_LATENCY = _metric(
+    "Histogram", "vault_http_request_duration_seconds",
+    "Request latency by Flask route, method and status.",
+    ("route", "method", "status"), buckets=LATENCY_BUCKETS,
+)
+SUPABASE_LATENCY = _metric(
+    "Histogram", "vault_supabase_call_duration_seconds",
+    "Supabase call latency, retries included, by table/bucket/function and operation.",
+    ("target", "operation", "outcome"), buckets=LATENCY_BUCKETS,
+)
+UPLOAD_BYTES = _metric("Counter", "vault_upload_bytes", "Bytes received in uploaded files.")
+UPLOAD_FILES = _metric("Counter", "vault_upload_files", "Uploaded files by result.", ("status",))
+CACHE_LOOKUPS = _metric("Counter", "vault_catalog_cache_lookups", "Catalog cache lookups by result.", ("result",))
+FALLBACKS = _metric(
+    "Counter", "vault_fallbacks",
+    "Fallback activations: replica reads, stale cache entries, open breaker, RPC fallbacks.",
+    ("kind",),
+)
+
+def enabled() -> bool:
+    return prometheus_client is not None
+
+def render_metrics():
+    """(body, content type) for a /metrics scrape."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+# ---------- Sampling profiler ----------
+class StackSampler:
+    """Samples one thread's Python stack at a fixed interval from a helper thread.
+
+    Cheap enough to leave on for a fraction of requests: the profiled thread
+    is never interrupted. write() emits collapsed stacks ("outer;inner count"
+    per line), readable by flamegraph.pl and speedscope.
+    """
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.samples
+
+    def write(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+def profile_path(directory: str, route: str, elapsed: float) -> str:
+    name = route.strip("/").replace("/", "_").replace("<", "").replace(">", "") or "index"
+    return os.path.join(directory, f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{name}-{elapsed * 1000:.0f}ms.folded")
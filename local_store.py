@@ -0,0 +1,548 @@
+# local_store.py
+"""SQLite stand-in for the Supabase client.
+
+Implements the part of supabase-py that app.py uses - table() query
+builders, rpc() for the two database functions and storage.from_() backed
+by a local directory - so every route runs unchanged against a local file.
+app.py uses it when Supabase isn't configured and as a read replica when
+Supabase is unreachable.
+
+The database runs in WAL mode, so readers in every gunicorn worker proceed
+alongside the single writer. Each worker process opens its own connection
+(re-opened after a fork); threads within a worker share it under a lock.
+"""
+import os
+import re
+import json
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timezone
+
+log = logging.getLogger("amoled-vault")
+
+SCHEMA = """
+create table if not exists wallpapers (
+    id text primary key,
+    title text,
+    category text,
+    device_type text,
+    filename text,
+    file_path text,
+    file_url text,
+    upload_date text,
+    download_count integer not null default 0,
+    derivatives text
+);
+create index if not exists wallpapers_device_type on wallpapers (device_type);
+create index if not exists wallpapers_category on wallpapers (category collate nocase);
+create index if not exists wallpapers_filename on wallpapers (filename);
+create index if not exists wallpapers_file_path on wallpapers (file_path);
+create index if not exists wallpapers_upload_date on wallpapers (upload_date, id);
+
+create table if not exists downloads (
+    id integer primary key autoincrement,
+    wallpaper_id text,
+    ip text,
+    timestamp text
+);
+create index if not exists downloads_wallpaper_id on downloads (wallpaper_id);
+create index if not exists downloads_timestamp on downloads (timestamp);
+
+create table if not exists meta (key text primary key, value text);
+"""
+
+JSON_COLUMNS = {"derivatives"}
+
+class LocalStoreError(Exception):
+    pass
+
+class Result:
+    """Shape of a postgrest APIResponse: .data rows and an optional .count."""
+
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+        self.error = None
+
+# ---------- Filters ----------
+# Filters compile to (sql, params). Column names are checked against the
+# table, values are always bound parameters.
+OPERATORS = {"eq": "=", "neq": "!=", "gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+
+def _unquote(value: str) -> str:
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return re.sub(r'\\(.)', r"\1", value[1:-1])
+    return value
+
+def _split_top_level(expr: str):
+    """Split a PostgREST logic tree on commas outside quotes and parentheses."""
+    parts, depth, quoted, start = [], 0, False, 0
+    i = 0
+    while i < len(expr):
+        ch = expr[i]
+        if quoted:
+            if ch == "\\":
+                i += 1
+            elif ch == '"':
+                quoted = False
+        elif ch == '"':
+            quoted = True
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            parts.append(expr[start:i])
+            start = i + 1
+        i += 1
+    parts.append(expr[start:])
+    return [p.strip() for p in parts if p.strip()]
+
+def _like(pattern: str) -> str:
+    return pattern.replace("*", "%")
+
+def _insert_sql(table, columns):
+    cols = ", ".join(f'"{c}"' for c in columns)
+    return f'insert into "{table}" ({cols}) values ({", ".join("?" * len(columns))})'
+
+class Filters:
+    def __init__(self, columns):
+        self.columns = columns
+        self.clauses = []
+        self.params = []
+
+    def _column(self, column):
+        if column not in self.columns:
+            raise LocalStoreError(f"column {column} does not exist")
+        return f'"{column}"'
+
+    def compile(self, column, op, value, negate=False):
+        col = self._column(column)
+        if op in OPERATORS:
+            sql, params = f"{col} {OPERATORS[op]} ?", [value]
+        elif op == "like":
+            # sqlite's LIKE ignores case; GLOB is the case-sensitive one
+            sql, params = f"{col} glob ?", [_like(value).replace("%", "*").replace("_", "?")]
+        elif op == "ilike":
+            sql, params = f"{col} like ?", [_like(value)]
+        elif op == "in":
+            values = list(value)
+            if not values:
+                sql, params = "0", []
+            else:
+                sql, params = f"{col} in ({','.join('?' * len(values))})", values
+        elif op == "is":
+            literal = {"null": "null", "true": "1", "false": "0"}.get(str(value).lower())
+            if literal is None:
+                raise LocalStoreError(f"invalid is value {value!r}")
+            sql, params = f"{col} is {literal}", []
+        else:
+            raise LocalStoreError(f"unsupported operator {op}")
+        return (f"not ({sql})" if negate else sql), params
+
+    def add(self, column, op, value, negate=False):
+        sql, params = self.compile(column, op, value, negate)
+        self.clauses.append(sql)
+        self.params.extend(params)
+
+    def parse_tree(self, expr: str, joiner: str):
+        """`a.eq.1,and(b.lt."x",c.is.null)` -> one SQL clause + params."""
+        sqls, params = [], []
+        for part in _split_top_level(expr):
+            m = re.fullmatch(r"(not\.)?(and|or)\((.*)\)", part, re.S)
+            if m:
+                sql, p = self.parse_tree(m.group(3), m.group(2))
+                sqls.append(f"not {sql}" if m.group(1) else sql)
+                params.extend(p)
+                continue
+            column, rest = part.split(".", 1)
+            negate = rest.startswith("not.")
+            if negate:
+                rest = rest[4:]
+            op, raw = rest.split(".", 1)
+            if op == "in":
+                value = [_unquote(v) for v in _split_top_level(raw.strip()[1:-1])]
+            else:
+                value = _unquote(raw)
+            sql, p = self.compile(column, op, value, negate)
+            sqls.append(sql)
+            params.extend(p)
+        return "(" + f" {joiner} ".join(sqls) + ")", params
+
+    def where(self):
+        return (" where " + " and ".join(self.clauses)) if self.clauses else ""
+
+# ---------- Query builder ----------
+class Query:
+    def __init__(self, store, table):
+        self.store = store
+        self.table = table
+        self.columns = store.columns(table)
+        self.filters = Filters(self.columns)
+        self.op = "select"
+        self.fields = None
+        self.count_mode = None
+        self.payload = None
+        self.orders = []
+        self._limit = None
+        self._offset = 0
+
+    # verbs
+    def select(self, columns="*", count=None):
+        self.op = "select"
+        self.count_mode = count
+        cols = [c.strip() for c in columns.split(",") if c.strip()]
+        if cols and cols != ["*"]:
+            for c in cols:
+                self.filters._column(c)
+            self.fields = cols
+        return self
+
+    def insert(self, payload, **kwargs):
+        self.op, self.payload = "insert", payload
+        return self
+
+    def update(self, payload, **kwargs):
+        self.op, self.payload = "update", payload
+        return self
+
+    def delete(self, **kwargs):
+        self.op = "delete"
+        return self
+
+    # filters
+    def eq(self, column, value):
+        self.filters.add(column, "eq", value)
+        return self
+
+    def neq(self, column, value):
+        self.filters.add(column, "neq", value)
+        return self
+
+    def gt(self, column, value):
+        self.filters.add(column, "gt", value)
+        return self
+
+    def gte(self, column, value):
+        self.filters.add(column, "gte", value)
+        return self
+
+    def lt(self, column, value):
+        self.filters.add(column, "lt", value)
+        return self
+
+    def lte(self, column, value):
+        self.filters.add(column, "lte", value)
+        return self
+
+    def like(self, column, pattern):
+        self.filters.add(column, "like", pattern)
+        return self
+
+    def ilike(self, column, pattern):
+        self.filters.add(column, "ilike", pattern)
+        return self
+
+    def in_(self, column, values):
+        self.filters.add(column, "in", values)
+        return self
+
+    def is_(self, column, value):
+        self.filters.add(column, "is", value)
+        return self
+
+    def or_(self, filters):
+        sql, params = self.filters.parse_tree(filters, "or")
+        self.filters.clauses.append(sql)
+        self.filters.params.extend(params)
+        return self
+
+    # modifiers
+    def order(self, column, desc=False, **kwargs):
+        self.orders.append(f"{self.filters._column(column)} {'desc' if desc else 'asc'}")
+        return self
+
+    def limit(self, size):
+        self._limit = int(size)
+        return self
+
+    def range(self, start, end):
+        self._offset, self._limit = int(start), int(end) - int(start) + 1
+        return self
+
+    def execute(self):
+        return getattr(self, "_" + self.op)()
+
+    def _select(self):
+        cols = ", ".join(f'"{c}"' for c in self.fields) if self.fields else "*"
+        sql = f'select {cols} from "{self.table}"{self.filters.where()}'
+        if self.orders:
+            sql += " order by " + ", ".join(self.orders)
+        if self._limit is not None or self._offset:
+            sql += f" limit {self._limit if self._limit is not None else -1} offset {self._offset}"
+        rows = self.store.query(sql, self.filters.params)
+        count = None
+        if self.count_mode:
+            count = self.store.query(
+                f'select count(*) as n from "{self.table}"{self.filters.where()}', self.filters.params
+            )[0]["n"]
+        return Result(rows, count)
+
+    def _insert(self):
+        rows = self.payload if isinstance(self.payload, list) else [self.payload]
+        return Result(self.store.insert_rows(self.table, rows))
+
+    def _update(self):
+        values = self.store.encode_row(self.table, self.payload)
+        assignments = ", ".join(f'"{c}" = ?' for c in values)
+        sql = f'update "{self.table}" set {assignments}{self.filters.where()} returning *'
+        return Result(self.store.query(sql, list(values.values()) + self.filters.params, write=True))
+
+    def _delete(self):
+        sql = f'delete from "{self.table}"{self.filters.where()} returning *'
+        return Result(self.store.query(sql, self.filters.params, write=True))
+
+class RPC:
+    def __init__(self, fn, params):
+        self.fn, self.params = fn, params
+
+    def execute(self):
+        return Result(self.fn(**self.params))
+
+# ---------- Storage ----------
+class LocalBucket:
+    """storage3 bucket API over a directory."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def _path(self, path):
+        full = os.path.abspath(os.path.join(self.root, path))
+        if not full.startswith(self.root + os.sep):
+            raise LocalStoreError(f"invalid object path {path!r}")
+        return full
+
+    def upload(self, path, file, file_options=None):
+        target = self._path(path)
+        upsert = str((file_options or {}).get("upsert", "false")).lower() == "true"
+        if os.path.exists(target) and not upsert:
+            raise LocalStoreError(f"The resource already exists: {path}")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as out:
+            if isinstance(file, (bytes, bytearray, memoryview)):
+                out.write(file)
+            elif isinstance(file, (str, os.PathLike)):
+                with open(file, "rb") as src:
+                    while chunk := src.read(1 << 20):
+                        out.write(chunk)
+            else:
+                while chunk := file.read(1 << 20):
+                    out.write(chunk)
+        os.replace(tmp, target)
+        return {"Key": path}
+
+    def download(self, path):
+        with open(self._path(path), "rb") as f:
+            return f.read()
+
+    def remove(self, paths):
+        removed = []
+        for path in paths:
+            try:
+                os.unlink(self._path(path))
+                removed.append({"name": path})
+            except FileNotFoundError:
+                pass
+        return removed
+
+class LocalStorage:
+    def __init__(self, root):
+        self.root = root
+
+    def from_(self, bucket):
+        # one directory regardless of bucket name, matching the old static/wallpapers layout
+        return LocalBucket(self.root)
+
+# ---------- Store ----------
+class LocalStore:
+    def __init__(self, path, storage_root, seed_json=None):
+        self.path = path
+        self.seed_json = seed_json
+        self.storage = LocalStorage(storage_root)
+        self._conn = None
+        self._pid = None
+        self._columns = {}
+        self._lock = threading.RLock()
+        self._functions = {
+            "increment_download_count": self._increment_download_count,
+            "download_buckets": self._download_buckets,
+        }
+        self._connection()   # fail fast on a broken path
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("pragma journal_mode=wal")
+            conn.execute("pragma synchronous=normal")
+            conn.executescript(SCHEMA)
+            self._columns = {
+                table: [r["name"] for r in conn.execute(f'pragma table_info("{table}")')]
+                for table in ("wallpapers", "downloads")
+            }
+            self._conn, self._pid = conn, os.getpid()
+            self._import_json()
+        return self._conn
+
+    def columns(self, table):
+        with self._lock:
+            self._connection()
+            if table not in self._columns:
+                raise LocalStoreError(f"table {table} does not exist")
+            return self._columns[table]
+
+    def _decode(self, row):
+        out = dict(row)
+        for c in JSON_COLUMNS & out.keys():
+            if out[c] is not None:
+                out[c] = json.loads(out[c])
+        return out
+
+    def encode_row(self, table, row):
+        columns = self.columns(table)
+        unknown = set(row) - set(columns)
+        if unknown:
+            raise LocalStoreError(f"column {sorted(unknown)[0]} does not exist on {table}")
+        return {c: (json.dumps(v) if c in JSON_COLUMNS and v is not None else v) for c, v in row.items()}
+
+    def query(self, sql, params=(), write=False):
+        with self._lock:
+            conn = self._connection()
+            if write:
+                conn.execute("begin immediate")
+                try:
+                    rows = conn.execute(sql, params).fetchall()
+                    conn.execute("commit")
+                except BaseException:
+                    conn.execute("rollback")
+                    raise
+            else:
+                rows = conn.execute(sql, params).fetchall()
+        return [self._decode(r) for r in rows]
+
+    def insert_rows(self, table, rows, replace_where=None):
+        """Insert rows in one transaction (optionally after a delete); returns them."""
+        encoded = [self.encode_row(table, r) for r in rows]
+        with self._lock:
+            conn = self._connection()
+            conn.execute("begin immediate")
+            try:
+                if replace_where is not None:
+                    conn.execute(f'delete from "{table}"{replace_where[0]}', replace_where[1])
+                for row in encoded:
+                    conn.execute(_insert_sql(table, row), list(row.values()))
+                conn.execute("commit")
+            except BaseException:
+                conn.execute("rollback")
+                raise
+        return [dict(r) for r in rows]
+
+    # supabase-py surface
+    def table(self, name):
+        return Query(self, name)
+
+    def rpc(self, fn, params=None):
+        if fn not in self._functions:
+            raise LocalStoreError(f"function {fn} does not exist")
+        return RPC(self._functions[fn], params or {})
+
+    def _increment_download_count(self, wid, amount):
+        self.query(
+            "update wallpapers set download_count = coalesce(download_count, 0) + ? where id = ?",
+            [int(amount), wid], write=True,
+        )
+        return None
+
+    def _download_buckets(self, since):
+        # timestamps are stored as naive UTC ISO strings, so compare in that form
+        since_dt = datetime.fromisoformat(str(since).replace("Z", "+00:00"))
+        if since_dt.tzinfo:
+            since_dt = since_dt.astimezone(timezone.utc).replace(tzinfo=None)
+        return self.query(
+            "select wallpaper_id, substr(timestamp, 1, 16) || ':00' as bucket, count(*) as downloads "
+            "from downloads where timestamp >= ? group by 1, 2",
+            [since_dt.isoformat()],
+        )
+
+    # replica
+    def mirror_wallpapers(self, device_type, rows, digest=None):
+        """Replace the local copy of one device's catalog (or all of it) with rows.
+
+        If digest is given and matches the one recorded by the last mirror of
+        this device type (by any process), nothing is written. Returns True if
+        the rows were written.
+        """
+        device_type = device_type if device_type in ("mobile", "pc") else "all"
+        if digest is not None and self.query(
+            "select 1 from meta where key = ? and value = ?", [f"digest:{device_type}", digest]
+        ):
+            return False
+        columns = set(self.columns("wallpapers"))
+        rows = [{k: v for k, v in r.items() if k in columns} for r in rows]
+        if device_type == "all":
+            self.insert_rows("wallpapers", rows, replace_where=("", []))
+        else:
+            self.insert_rows("wallpapers", rows, replace_where=(" where device_type = ?", [device_type]))
+        self.query(
+            "insert or replace into meta (key, value) values (?, ?)",
+            [f"mirrored:{device_type}", datetime.now(timezone.utc).isoformat()], write=True,
+        )
+        if digest is not None:
+            self.query(
+                "insert or replace into meta (key, value) values (?, ?)",
+                [f"digest:{device_type}", digest], write=True,
+            )
+        return True
+
+    def mirrored(self, device_type=None):
+        """True if the catalog rows for device_type (None = all) have been mirrored."""
+        keys = ["mirrored:all"]
+        if device_type in ("mobile", "pc"):
+            keys.append(f"mirrored:{device_type}")
+        rows = self.query(f"select 1 from meta where key in ({', '.join('?' * len(keys))})", keys)
+        return bool(rows)
+
+    # one-off import of the old JSON fallback
+    def _import_json(self):
+        conn = self._conn
+        if not self.seed_json or not os.path.exists(self.seed_json):
+            return
+        conn.execute("begin immediate")
+        try:
+            if conn.execute("select 1 from meta where key = 'json_imported'").fetchone():
+                conn.execute("commit")
+                return
+            with open(self.seed_json) as f:
+                data = json.load(f)
+            counts = {}
+            for table in ("wallpapers", "downloads"):
+                columns = self._columns[table]
+                rows = data.get(table) or []
+                for row in rows:
+                    row = {k: (json.dumps(v) if k in JSON_COLUMNS and v is not None else v)
+                           for k, v in row.items() if k in columns}
+                    if not row:
+                        continue
+                    conn.execute(_insert_sql(table, row).replace("insert", "insert or ignore", 1), list(row.values()))
+                counts[table] = len(rows)
+            conn.execute(
+                "insert into meta (key, value) values ('json_imported', ?)",
+                [datetime.now(timezone.utc).isoformat()],
+            )
+            conn.execute("commit")
+            log.info("Imported %s into %s: %s", self.seed_json, self.path, counts)
+        except BaseException:
+            conn.execute("rollback")
+            raise
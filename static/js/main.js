@@ -2,6 +2,13 @@
 let currentSlide = 0
 let currentCategory = "all"
 let currentDeviceType = "mobile"
+let currentSearch = ""
+let nextCursor = null
+let loadingMore = false
+
+// Columns the list views actually render
+const WALLPAPER_LIST_FIELDS = "id,title,category,device_type,filename,file_url,download_count,upload_date,derivatives"
+const WALLPAPER_PAGE_SIZE = 60
 
 // DOM elements
 const carousel = document.getElementById("carousel")
@@ -44,6 +51,22 @@ const vibrationPatterns = {
   download: [80, 40, 80],
 }
 
+// Responsive images: derivative URL if generated yet, otherwise the original
+function imageSrc(wallpaper, size = "thumb") {
+  const derivative = (wallpaper.derivatives || {})[size]
+  if (derivative && derivative.url) return derivative.url
+  return wallpaper.file_url || `/static/wallpapers/${wallpaper.filename}`
+}
+
+function imageSrcset(wallpaper) {
+  const derivatives = wallpaper.derivatives || {}
+  return ["thumb", "preview", "full"]
+    .map((size) => derivatives[size])
+    .filter((d) => d && d.url && d.width)
+    .map((d) => `${d.url} ${d.width}w`)
+    .join(", ")
+}
+
 // Utility functions
 function vibrate(pattern) {
   if (isMobile && supportsVibration) {
@@ -203,35 +226,67 @@ function switchDeviceType(deviceType) {
   showToast(`Now showing ${deviceName} wallpapers 📱💻`, "info", 2000)
 }
 
+// Fetch one page of wallpapers; the next page's cursor comes back in a header
+async function fetchWallpaperPage(deviceType, category, cursor = null) {
+  const params = new URLSearchParams({
+    device: deviceType,
+    category: category,
+    limit: WALLPAPER_PAGE_SIZE,
+    fields: WALLPAPER_LIST_FIELDS,
+  })
+  if (currentSearch) {
+    params.set("search", currentSearch)
+    params.set("fuzzy", "1")
+  }
+  if (cursor) params.set("cursor", cursor)
+
+  const response = await fetch(`/api/wallpapers?${params}`)
+  const wallpapers = await response.json()
+  const total = response.headers.get("X-Total-Count")
+  return {
+    wallpapers,
+    nextCursor: response.headers.get("X-Next-Cursor"),
+    total: total === null ? wallpapers.length : Number.parseInt(total),
+  }
+}
+
+// Gallery page, categories, latest, popular and stats for a device in one request
+async function fetchBootstrap(deviceType) {
+  const params = new URLSearchParams({ device: deviceType, limit: WALLPAPER_PAGE_SIZE })
+  const response = await fetch(`/api/bootstrap?${params}`)
+  return response.json()
+}
+
 async function loadWallpapersByDevice(deviceType) {
   try {
-    const [wallpapersResponse, popularResponse, statsResponse] = await Promise.all([
-      fetch(`/api/wallpapers?device=${deviceType}&category=${currentCategory}`),
-      fetch(`/api/popular?device=${deviceType}`),
-      fetch(`/api/stats?device=${deviceType}`),
+    // the bootstrap page is unfiltered; an active filter or search still needs its own page
+    const filtered = currentCategory !== "all" || currentSearch
+    const [state, filteredPage] = await Promise.all([
+      fetchBootstrap(deviceType),
+      filtered ? fetchWallpaperPage(deviceType, currentCategory) : null,
     ])
+    const page = filteredPage || { wallpapers: state.wallpapers, nextCursor: state.next_cursor, total: state.total }
 
-    const wallpapers = await wallpapersResponse.json()
-    const popularWallpapers = await popularResponse.json()
-    const stats = await statsResponse.json()
+    const wallpapers = page.wallpapers
+    nextCursor = page.nextCursor
 
     // Update gallery
-    updateGallery(wallpapers)
+    updateGallery(wallpapers, page.total)
 
     // Update popular section
-    updatePopularSection(popularWallpapers)
+    updatePopularSection(state.popular)
 
     // Update carousel
-    updateCarousel(wallpapers.slice(0, 5))
+    updateCarousel(state.latest)
 
     // Update statistics
-    updateStatistics(stats)
+    updateStatistics(state.stats)
 
     // Update device info
-    updateDeviceInfo(deviceType, wallpapers.length)
+    updateDeviceInfo(deviceType, page.total)
 
     // Update categories for this device type
-    updateCategories(wallpapers)
+    updateCategories(state.categories)
 
     hideLoadingOverlay()
 
@@ -242,7 +297,7 @@ async function loadWallpapersByDevice(deviceType) {
     } else {
       gallery.style.display = "grid"
       noResults.classList.add("hidden")
-      showToast(`Found ${wallpapers.length} ${deviceType.toUpperCase()} wallpapers 🔍`, "success", 2000)
+      showToast(`Found ${page.total} ${deviceType.toUpperCase()} wallpapers 🔍`, "success", 2000)
     }
   } catch (error) {
     console.error("Error loading wallpapers:", error)
@@ -251,18 +306,17 @@ async function loadWallpapersByDevice(deviceType) {
   }
 }
 
-function updateGallery(wallpapers) {
-  const gallery = document.getElementById("gallery")
-
-  gallery.innerHTML = wallpapers
-    .map(
-      (wallpaper, index) => `
+function renderWallpaperCard(wallpaper, index) {
+  return `
     <div class="wallpaper-card" data-category="${wallpaper.category}" data-device="${wallpaper.device_type}" style="animation-delay: ${index * 0.05}s">
       <div class="image-container">
-        <img src="/static/wallpapers/${wallpaper.filename}" 
+        <img src="${imageSrc(wallpaper)}" 
+             srcset="${imageSrcset(wallpaper)}"
+             sizes="(max-width: 768px) 100vw, 280px"
              alt="${wallpaper.title}" 
              loading="lazy"
              class="wallpaper-image wallpaper-preview-img"
+             data-preview="${imageSrc(wallpaper, "preview")}"
              data-filename="${wallpaper.filename}"
              data-title="${wallpaper.title}"
              data-category="${wallpaper.category}"
@@ -286,11 +340,47 @@ function updateGallery(wallpapers) {
         </div>
       </div>
     </div>
-  `,
-    )
-    .join("")
+  `
+}
+
+function updateGallery(wallpapers, total = wallpapers.length) {
+  const gallery = document.getElementById("gallery")
+
+  gallery.innerHTML = wallpapers.map(renderWallpaperCard).join("")
 
-  updateGalleryCount(wallpapers.length)
+  updateGalleryCount(total)
+}
+
+// Append the next page when the sentinel below the gallery scrolls into view
+async function loadMoreWallpapers() {
+  if (!nextCursor || loadingMore) return
+  loadingMore = true
+  showLoading()
+  try {
+    const page = await fetchWallpaperPage(currentDeviceType, currentCategory, nextCursor)
+    nextCursor = page.nextCursor
+    gallery.insertAdjacentHTML("beforeend", page.wallpapers.map(renderWallpaperCard).join(""))
+  } catch (error) {
+    console.error("Error loading more wallpapers:", error)
+  } finally {
+    loadingMore = false
+    hideLoading()
+  }
+}
+
+function initializeInfiniteScroll() {
+  const sentinel = document.getElementById("gallery-sentinel")
+  if (!sentinel || !("IntersectionObserver" in window)) return
+
+  const observer = new IntersectionObserver(
+    (entries) => {
+      if (entries.some((entry) => entry.isIntersecting)) {
+        loadMoreWallpapers()
+      }
+    },
+    { rootMargin: "600px" },
+  )
+  observer.observe(sentinel)
 }
 
 function updatePopularSection(wallpapers) {
@@ -301,10 +391,13 @@ function updatePopularSection(wallpapers) {
       (wallpaper) => `
     <div class="popular-card" data-device="${wallpaper.device_type}">
       <div class="popular-image-container">
-        <img src="/static/wallpapers/${wallpaper.filename}" 
+        <img src="${imageSrc(wallpaper)}" 
+             srcset="${imageSrcset(wallpaper)}"
+             sizes="(max-width: 768px) 50vw, 280px"
              alt="${wallpaper.title}" 
              loading="lazy"
              class="popular-image wallpaper-preview-img"
+             data-preview="${imageSrc(wallpaper, "preview")}"
              data-filename="${wallpaper.filename}"
              data-title="${wallpaper.title}"
              data-category="${wallpaper.category}"
@@ -344,10 +437,13 @@ function updateCarousel(wallpapers) {
     .map(
       (wallpaper) => `
     <div class="carousel-slide" data-device="${wallpaper.device_type}">
-      <img src="/static/wallpapers/${wallpaper.filename}" 
+      <img src="${imageSrc(wallpaper, "preview")}" 
+           srcset="${imageSrcset(wallpaper)}"
+           sizes="100vw"
            alt="${wallpaper.title}" 
            loading="lazy"
            class="wallpaper-preview-img"
+           data-preview="${imageSrc(wallpaper, "preview")}"
            data-filename="${wallpaper.filename}"
            data-title="${wallpaper.title}"
            data-category="${wallpaper.category}"
@@ -383,8 +479,7 @@ function updateStatistics(stats) {
   animateNumber("downloads-24h", stats.downloads_24h)
 }
 
-function updateCategories(wallpapers) {
-  const categories = [...new Set(wallpapers.map((w) => w.category))].sort()
+function updateCategories(categories) {
   const filterButtons = document.querySelector(".filter-buttons")
 
   filterButtons.innerHTML = `
@@ -432,9 +527,19 @@ document.addEventListener("DOMContentLoaded", () => {
 
   initializeCarousel()
   initializeLazyLoading()
-  loadStatistics()
+  initializeInfiniteScroll()
+  initializeSearch()
   initializeMobileInteractions()
 
+  // The server embedded the first-paint state; only fetch what it lacks
+  const bootstrap = window.BOOTSTRAP
+  if (bootstrap && bootstrap.device === currentDeviceType) {
+    nextCursor = bootstrap.next_cursor
+    updateStatistics(bootstrap.stats)
+  } else {
+    loadStatistics()
+  }
+
   // Auto-play carousel
   setInterval(() => {
     moveCarousel(1)
@@ -564,10 +669,11 @@ function filterWallpapers(category) {
 
 async function loadFilteredWallpapers(category, deviceType) {
   try {
-    const response = await fetch(`/api/wallpapers?device=${deviceType}&category=${category}`)
-    const wallpapers = await response.json()
+    const page = await fetchWallpaperPage(deviceType, category)
+    const wallpapers = page.wallpapers
+    nextCursor = page.nextCursor
 
-    updateGallery(wallpapers)
+    updateGallery(wallpapers, page.total)
     hideLoadingOverlay()
 
     if (wallpapers.length === 0) {
@@ -577,7 +683,7 @@ async function loadFilteredWallpapers(category, deviceType) {
     } else {
       gallery.style.display = "grid"
       noResults.classList.add("hidden")
-      showToast(`Found ${wallpapers.length} wallpapers 🔍`)
+      showToast(`Found ${page.total} wallpapers 🔍`)
     }
   } catch (error) {
     console.error("Error loading filtered wallpapers:", error)
@@ -586,8 +692,68 @@ async function loadFilteredWallpapers(category, deviceType) {
   }
 }
 
+// Search box: autocomplete from /api/suggest, results from the search index
+let suggestTimer = null
+
+function initializeSearch() {
+  const input = document.getElementById("search-input")
+  const datalist = document.getElementById("search-suggestions")
+  if (!input || !datalist) return
+
+  input.addEventListener("input", () => {
+    clearTimeout(suggestTimer)
+    const q = input.value.trim()
+    if (!q) {
+      datalist.innerHTML = ""
+      if (currentSearch) searchWallpapers("")
+      return
+    }
+    suggestTimer = setTimeout(async () => {
+      try {
+        const params = new URLSearchParams({ q, device: currentDeviceType })
+        const response = await fetch(`/api/suggest?${params}`)
+        const suggestions = await response.json()
+        datalist.innerHTML = suggestions.map((s) => `<option value="${s.text}">${s.type}</option>`).join("")
+      } catch (error) {
+        console.error("Error loading suggestions:", error)
+      }
+    }, 150)
+  })
+
+  input.addEventListener("change", () => searchWallpapers(input.value.trim()))
+  input.addEventListener("keydown", (e) => {
+    if (e.key === "Enter") searchWallpapers(input.value.trim())
+  })
+}
+
+async function searchWallpapers(query) {
+  if (query === currentSearch) return
+  currentSearch = query
+
+  try {
+    const page = await fetchWallpaperPage(currentDeviceType, currentCategory)
+    nextCursor = page.nextCursor
+    updateGallery(page.wallpapers, page.total)
+
+    if (page.wallpapers.length === 0) {
+      gallery.style.display = "none"
+      noResults.classList.remove("hidden")
+    } else {
+      gallery.style.display = "grid"
+      noResults.classList.add("hidden")
+      if (query) showToast(`Found ${page.total} wallpapers for "${query}" 🔍`)
+    }
+  } catch (error) {
+    console.error("Error searching wallpapers:", error)
+    showMessage("Search failed 😞", "error", 3000)
+  }
+}
+
 function resetFilters() {
   currentCategory = "all"
+  currentSearch = ""
+  const searchInput = document.getElementById("search-input")
+  if (searchInput) searchInput.value = ""
   switchDeviceType("mobile")
   filterWallpapers("all")
 }
@@ -673,43 +839,25 @@ function handleDownload(filename, title, wallpaperId) {
   showInstagramModal(filename, title, wallpaperId)
 }
 
-// Track downloads
+// Track downloads: the ?track=1 download link records the download itself
 function trackDownload(wallpaperId, filename, title) {
-  // Track the download in backend
-  fetch("/api/track-download", {
-    method: "POST",
-    headers: {
-      "Content-Type": "application/json",
-    },
-    body: JSON.stringify({
-      wallpaper_id: wallpaperId,
-    }),
-  })
-    .then((response) => response.json())
-    .then((data) => {
-      if (data.success) {
-        // Proceed with actual download
-        downloadWallpaper(filename, title)
-        // Update statistics on page
-        loadStatistics()
-        // Update popular wallpapers
-        updatePopularWallpapers()
-
-        // Show success message
-        showMessage(`"${title}" downloaded successfully! ✅`, "success", 3000)
-      }
-    })
-    .catch((error) => {
-      console.error("Error tracking download:", error)
-      showMessage("Oops! Something went wrong. Please try again 😅", "error", 3000)
-      // Still allow download even if tracking fails
-      downloadWallpaper(filename, title)
-    })
+  downloadWallpaper(filename, title, true)
+
+  // The redirect is counted server side; refresh once it has gone through
+  setTimeout(() => {
+    // Update statistics on page
+    loadStatistics()
+    // Update popular wallpapers
+    updatePopularWallpapers()
+  }, 1500)
+
+  // Show success message
+  showMessage(`"${title}" downloaded successfully! ✅`, "success", 3000)
 }
 
 // Load and display statistics
 function loadStatistics() {
-  fetch(`/api/stats?device=${currentDeviceType}`)
+  fetch(`/api/stats?device=${currentDeviceType}`, { cache: "no-cache" })
     .then((response) => response.json())
     .then((stats) => {
       // Update stat numbers with animation
@@ -760,7 +908,7 @@ function updatePopularWallpapers() {
     })
 }
 
-function downloadWallpaper(filename, title) {
+function downloadWallpaper(filename, title, track = false) {
   // Show download modal with enhanced feedback
   showDownloadModal(title)
 
@@ -768,7 +916,7 @@ function downloadWallpaper(filename, title) {
   vibrate(vibrationPatterns.download)
 
   // Create download link
-  const downloadUrl = `/download/${filename}`
+  const downloadUrl = `/download/${filename}${track ? "?track=1" : ""}`
   const link = document.createElement("a")
   link.href = downloadUrl
   link.download = filename
@@ -893,7 +1041,7 @@ window.addEventListener("offline", () => {
 })
 
 // Wallpaper Modal Functions
-function openWallpaperModal(filename, title, category, downloads, wallpaperId) {
+function openWallpaperModal(filename, title, category, downloads, wallpaperId, previewUrl) {
   const modal = document.getElementById("wallpaper-modal")
   const modalImage = document.getElementById("modal-wallpaper-image")
   const modalTitle = document.getElementById("modal-wallpaper-title")
@@ -940,7 +1088,7 @@ function openWallpaperModal(filename, title, category, downloads, wallpaperId) {
     showMessage("Failed to load wallpaper image 😞", "error", 3000)
   }
 
-  img.src = `/static/wallpapers/${filename}`
+  img.src = previewUrl || `/static/wallpapers/${filename}`
 
   showMessage(`Opening ${title} preview 🖼️`, "info", 2000)
 }
@@ -982,8 +1130,9 @@ document.addEventListener("DOMContentLoaded", () => {
       const category = e.target.dataset.category
       const downloads = e.target.dataset.downloads
       const wallpaperId = e.target.dataset.id
+      const previewUrl = e.target.dataset.preview
 
-      openWallpaperModal(filename, title, category, downloads, wallpaperId)
+      openWallpaperModal(filename, title, category, downloads, wallpaperId, previewUrl)
     }
   })
 
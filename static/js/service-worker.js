@@ -1,12 +1,250 @@
-// Simple service worker for PWA
+// Service worker: offline-first caching for the gallery
+//
+// - app shell (css/js/manifest/icon): precached per version, cache-first
+// - gallery page (/): network-first, cached copy when offline or slow
+// - /api/bootstrap, /api/wallpapers, /api/popular, /api/stats: stale-while-revalidate
+//   in an LRU cache capped by entry count (every search term and cursor is its
+//   own URL)
+// - wallpaper images (storage + /static/wallpapers): cache-first in an LRU
+//   cache capped by total bytes; least recently used entries go first
+//
+// The version comes from the registration URL (/service-worker.js?v=<hash of
+// the shell files>), so a deploy that changes them installs a fresh precache
+// and API cache; activate deletes the previous version's.
+
+const VERSION = new URL(self.location).searchParams.get("v") || "dev"
+const SHELL_CACHE = `shell-${VERSION}`
+const API_CACHE = `api-${VERSION}`
+const API_INDEX_KEY = "/__api-cache-index__"
+const API_CACHE_ENTRIES = 200
+const IMAGE_CACHE = "images-v1"
+const IMAGE_INDEX_KEY = "/__image-cache-index__"
+const IMAGE_CACHE_BYTES = 100 * 1024 * 1024
+const NAVIGATION_TIMEOUT_MS = 3000
+
+const SHELL_FILES = [
+  "/",
+  "/static/css/style.css",
+  "/static/js/main.js",
+  "/manifest.json",
+  encodeURI("/static/Colorful Minimalist Space Desktop Wallpaper 2.png"),
+]
+const SWR_PATHS = ["/api/bootstrap", "/api/wallpapers", "/api/popular", "/api/stats"]
+const IMAGE_PATTERN = /\.(png|jpe?g|webp|avif)$/i
+
 self.addEventListener("install", (event) => {
-  self.skipWaiting()
+  event.waitUntil(
+    caches
+      .open(SHELL_CACHE)
+      // one missing file shouldn't block the whole install
+      .then((cache) => Promise.all(SHELL_FILES.map((url) => cache.add(url).catch(() => null))))
+      .then(() => self.skipWaiting()),
+  )
 })
 
 self.addEventListener("activate", (event) => {
-  event.waitUntil(self.clients.claim())
+  event.waitUntil(
+    caches
+      .keys()
+      .then((keys) => Promise.all(keys.filter(isStaleCache).map((key) => caches.delete(key))))
+      .then(() => self.clients.claim()),
+  )
 })
 
+function isStaleCache(key) {
+  // "api-v1" predates versioned API caches
+  return (key.startsWith("shell-") && key !== SHELL_CACHE) || (key.startsWith("api-") && key !== API_CACHE)
+}
+
 self.addEventListener("fetch", (event) => {
-  // You can add caching logic here if needed
+  const request = event.request
+  if (request.method !== "GET") return
+  const url = new URL(request.url)
+
+  if (request.mode === "navigate") {
+    // only the gallery; admin pages carry the secret in their URL and stay uncached
+    if (url.pathname === "/") event.respondWith(networkFirst(request))
+  } else if (url.origin === self.location.origin && SWR_PATHS.includes(url.pathname)) {
+    // explicit revalidation (admin pages after an upload/delete) must hit the network
+    if (["no-cache", "no-store", "reload"].includes(request.cache)) {
+      event.respondWith(networkFirst(request, API_CACHE, putApi(event)))
+    } else {
+      event.respondWith(staleWhileRevalidate(event, request, API_CACHE, putApi(event)))
+    }
+  } else if (isImage(request, url)) {
+    event.respondWith(imageCacheFirst(event, request))
+  } else if (url.origin === self.location.origin && SHELL_FILES.includes(url.pathname)) {
+    event.respondWith(cacheFirst(request, SHELL_CACHE))
+  }
 })
+
+function isImage(request, url) {
+  if (!IMAGE_PATTERN.test(url.pathname)) return false
+  if (url.origin === self.location.origin) return url.pathname.startsWith("/static/wallpapers/")
+  return url.pathname.includes("/storage/v1/object/public/")
+}
+
+// ---------- Strategies ----------
+
+async function cacheFirst(request, cacheName) {
+  const cache = await caches.open(cacheName)
+  const cached = await cache.match(request)
+  if (cached) return cached
+  const response = await fetch(request)
+  if (response.ok) cache.put(request, response.clone())
+  return response
+}
+
+// store(cache, request, response) writes a fetched response; strategies also
+// call it with a null response on a cache hit, for caches that track use
+function put(cache, request, response) {
+  return response ? cache.put(request, response) : Promise.resolve()
+}
+
+async function networkFirst(request, cacheName = SHELL_CACHE, store = put) {
+  const cache = await caches.open(cacheName)
+  const network = fetch(request).then((response) => {
+    if (response.ok) store(cache, request, response.clone())
+    return response
+  })
+  if (request.mode === "navigate") {
+    // slow network: fall back to the cached page, the fetch still refreshes it
+    const timeout = new Promise((resolve) => setTimeout(resolve, NAVIGATION_TIMEOUT_MS))
+    const first = await Promise.race([network.catch(() => null), timeout])
+    if (first) return first
+    const cached = (await cache.match(request)) || (await cache.match("/"))
+    return cached || network
+  }
+  try {
+    return await network
+  } catch (err) {
+    const cached = await cache.match(request)
+    if (cached) return cached
+    throw err
+  }
+}
+
+async function staleWhileRevalidate(event, request, cacheName, store = put) {
+  const cache = await caches.open(cacheName)
+  const cached = await cache.match(request)
+  const network = fetch(request).then((response) => {
+    if (response.ok) store(cache, request, response.clone())
+    return response
+  })
+  if (cached) {
+    event.waitUntil(network.catch(() => null))
+    store(cache, request, null)
+    return cached
+  }
+  return network
+}
+
+// ---------- LRU indexes ----------
+// Cache Storage keeps no access times, so each LRU cache holds a small index
+// {url: ...lastUsed} under its own key. All updates to one index go through
+// one promise chain so concurrent fetches can't lose each other's writes.
+
+const lruIndexes = {}   // cacheName -> {index, queue}
+
+function withIndex(cacheName, indexKey, fn) {
+  const state = lruIndexes[cacheName] || (lruIndexes[cacheName] = { index: null, queue: Promise.resolve() })
+  const run = state.queue.then(async () => {
+    const cache = await caches.open(cacheName)
+    if (!state.index) {
+      const stored = await cache.match(indexKey)
+      state.index = stored ? await stored.json() : {}
+    }
+    const changed = await fn(cache, state.index)
+    if (changed) {
+      await cache.put(indexKey, new Response(JSON.stringify(state.index), { headers: { "Content-Type": "application/json" } }))
+    }
+  })
+  state.queue = run.catch(() => null)
+  return run
+}
+
+function withImageIndex(fn) {
+  return withIndex(IMAGE_CACHE, IMAGE_INDEX_KEY, fn)
+}
+
+// ---------- API LRU ----------
+// index {url: lastUsed}; the least recently used responses beyond
+// API_CACHE_ENTRIES are deleted.
+
+function putApi(event) {
+  return (cache, request, response) => {
+    const done = withIndex(API_CACHE, API_INDEX_KEY, async (cache, index) => {
+      if (response) await cache.put(request, response)
+      index[request.url] = Date.now()
+      await evictApi(cache, index)
+      return true
+    })
+    event.waitUntil(done.catch(() => null))
+    return done
+  }
+}
+
+async function evictApi(cache, index) {
+  const urls = Object.keys(index)
+  if (urls.length <= API_CACHE_ENTRIES) return
+  urls.sort((a, b) => index[a] - index[b])
+  for (const url of urls.slice(0, urls.length - API_CACHE_ENTRIES)) {
+    await cache.delete(url)
+    delete index[url]
+  }
+}
+
+// ---------- Image LRU ----------
+// index {url: [bytes, lastUsed]}; least recently used images go first once the
+// total passes IMAGE_CACHE_BYTES.
+
+async function imageCacheFirst(event, request) {
+  const cache = await caches.open(IMAGE_CACHE)
+  const cached = await cache.match(request.url)
+  if (cached) {
+    event.waitUntil(
+      withImageIndex(async (cache, index) => {
+        // entries missing from the index (lost write) are re-counted here
+        const size = index[request.url] ? index[request.url][0] : (await (await cache.match(request.url)).blob()).size
+        index[request.url] = [size, Date.now()]
+        return true
+      }),
+    )
+    return cached
+  }
+
+  let response
+  try {
+    // a CORS fetch makes the body readable, so its size can count against the budget
+    response = await fetch(request.url, { mode: "cors", credentials: "omit" })
+  } catch (err) {
+    return fetch(request)
+  }
+  if (!response.ok) return response
+
+  const copy = response.clone()
+  event.waitUntil(
+    copy.blob().then((blob) => {
+      if (blob.size > IMAGE_CACHE_BYTES / 4) return null
+      return withImageIndex(async (cache, index) => {
+        await cache.put(request.url, new Response(blob, { headers: copy.headers }))
+        index[request.url] = [blob.size, Date.now()]
+        await evictImages(cache, index)
+        return true
+      })
+    }),
+  )
+  return response
+}
+
+async function evictImages(cache, index) {
+  let total = Object.values(index).reduce((sum, [size]) => sum + size, 0)
+  if (total <= IMAGE_CACHE_BYTES) return
+  const oldestFirst = Object.entries(index).sort((a, b) => a[1][1] - b[1][1])
+  for (const [url, [size]] of oldestFirst) {
+    if (total <= IMAGE_CACHE_BYTES) break
+    await cache.delete(url)
+    delete index[url]
+    total -= size
+  }
+}
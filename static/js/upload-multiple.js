@@ -159,8 +159,8 @@ document.addEventListener("DOMContentLoaded", () => {
     fileInput.files = dt.files
   }
 
-  // Form submission with progress tracking
-  uploadForm.addEventListener("submit", (e) => {
+  // Form submission: one request for the whole batch, per-file status comes back as JSON
+  uploadForm.addEventListener("submit", async (e) => {
     e.preventDefault()
 
     if (selectedFiles.length === 0) {
@@ -181,16 +181,52 @@ document.addEventListener("DOMContentLoaded", () => {
     // Show upload progress
     showUploadProgress()
 
-    // Update file input and submit
-    updateFileInput()
+    const formData = new FormData(uploadForm)
+    formData.delete("files")
+    selectedFiles.forEach((file) => formData.append("files", file))
+
+    const secret = new URLSearchParams(window.location.search).get("secret") || ""
+
+    try {
+      const response = await fetch(`/upload?secret=${encodeURIComponent(secret)}`, {
+        method: "POST",
+        body: formData,
+        headers: { Accept: "application/json" },
+      })
+      const result = await response.json()
+
+      if (!response.ok) {
+        throw new Error(result.error || "Upload failed")
+      }
 
-    setTimeout(() => {
-      uploadForm.submit()
-    }, 1000)
+      updateUploadProgress(result.files)
+
+      if (result.failed === 0) {
+        showMessage(`🎉 Successfully uploaded ${result.uploaded} ${fileText}!`, "success", 5000)
+        showToast("Upload successful! ✅", "success", 3000)
+        selectedFiles = []
+        updateFileInput()
+        uploadForm.reset()
+        if (typeof loadWallpapersForDelete === "function") loadWallpapersForDelete(CURRENT_DEVICE_TYPE)
+      } else if (result.uploaded > 0) {
+        showMessage(`⚠️ Uploaded ${result.uploaded}, ${result.failed} failed.`, "error", 5000)
+      } else {
+        showMessage("❌ All uploads failed. Please check file types and server logs.", "error", 5000)
+      }
+    } catch (error) {
+      console.error("Upload error:", error)
+      showMessage(`❌ ${error.message}`, "error", 5000)
+      markUploadProgress("Failed ❌", "#f44336")
+    } finally {
+      submitBtn.classList.remove("loading")
+      submitBtn.disabled = false
+    }
   })
 
   // Show upload progress for multiple files
   function showUploadProgress() {
+    filePreview.querySelector(".upload-progress-container")?.remove()
+
     const progressContainer = document.createElement("div")
     progressContainer.className = "upload-progress-container"
     progressContainer.style.display = "block"
@@ -203,7 +239,7 @@ document.addEventListener("DOMContentLoaded", () => {
                 <div class="upload-progress-item">
                     <div class="progress-header">
                         <span class="progress-filename">${file.name}</span>
-                        <span class="progress-status" id="status-${index}">Preparing...</span>
+                        <span class="progress-status" id="status-${index}">Uploading...</span>
                     </div>
                     <div class="progress-bar-container">
                         <div class="progress-bar-fill" id="progress-${index}"></div>
@@ -215,26 +251,36 @@ document.addEventListener("DOMContentLoaded", () => {
         `
 
     filePreview.appendChild(progressContainer)
+  }
+
+  // Apply the per-file results returned by the server
+  function updateUploadProgress(files) {
+    files.forEach((file) => {
+      const statusEl = document.getElementById(`status-${file.index}`)
+      const progressEl = document.getElementById(`progress-${file.index}`)
+      if (!statusEl || !progressEl) return
+
+      progressEl.style.width = "100%"
+      if (file.status === "uploaded") {
+        statusEl.textContent = "Complete ✅"
+        statusEl.style.color = "#4caf50"
+      } else if (file.status === "duplicate") {
+        statusEl.textContent = "Already uploaded ⚠️"
+        statusEl.style.color = "#ff9800"
+      } else {
+        statusEl.textContent = `${file.error || "Failed"} ❌`
+        statusEl.style.color = "#f44336"
+      }
+    })
+  }
 
-    // Simulate progress for each file
+  function markUploadProgress(text, color) {
     selectedFiles.forEach((file, index) => {
-      setTimeout(() => {
-        const statusEl = document.getElementById(`status-${index}`)
-        const progressEl = document.getElementById(`progress-${index}`)
-
-        if (statusEl && progressEl) {
-          statusEl.textContent = "Uploading..."
-          progressEl.style.width = "100%"
-
-          setTimeout(
-            () => {
-              statusEl.textContent = "Complete ✅"
-              statusEl.style.color = "#4caf50"
-            },
-            1000 + index * 200,
-          )
-        }
-      }, index * 300)
+      const statusEl = document.getElementById(`status-${index}`)
+      if (statusEl) {
+        statusEl.textContent = text
+        statusEl.style.color = color
+      }
     })
   }
 
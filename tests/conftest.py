@@ -0,0 +1,10 @@
+# conftest.py
+"""Point app.py's local store and catalog stamp at a temp dir before it is imported."""
+import os
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="amoled-vault-tests-")
+os.environ.setdefault("LOCAL_DB", os.path.join(_tmp, "vault.sqlite3"))
+os.environ.setdefault("CATALOG_STAMP_FILE", os.path.join(_tmp, "catalog.stamp"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,162 @@
+# test_algorithms.py
+"""Pure algorithms behind search, pagination and download stats."""
+import base64
+import json
+
+import pytest
+
+import app as vault
+
+
+# ---------- edit distance / fuzzy search ----------
+
+@pytest.mark.parametrize("a, b, expected", [
+    ("space", "space", 0),
+    ("spcae", "space", 1),    # adjacent transposition is one edit
+    ("sapce", "space", 1),
+    ("spac", "space", 1),
+    ("spaace", "space", 1),
+    ("spice", "space", 1),
+    ("scape", "space", 2),
+])
+def test_edit_distance(a, b, expected):
+    assert vault._edit_distance(a, b, 2) == expected
+
+
+def test_edit_distance_gives_up_past_limit():
+    assert vault._edit_distance("abcdef", "uvwxyz", 1) == 2
+    assert vault._edit_distance("ab", "abcdef", 2) == 3
+
+
+def _index(*titles):
+    index = vault.SearchIndex()
+    rows = [
+        {"id": str(i), "title": title, "category": "misc", "device_type": "mobile", "download_count": 0}
+        for i, title in enumerate(titles)
+    ]
+    index.rebuild(rows, vault.catalog_cache.version())
+    return index
+
+
+@pytest.mark.parametrize("query, expected", [("spcae", "0"), ("sapce", "0"), ("nebual", "0"), ("galxay", "1")])
+def test_fuzzy_search_finds_transpositions(query, expected):
+    index = _index("Deep Space Nebula", "Neon Galaxy", "Black Minimal")
+    assert not index.search(query)   # only the fuzzy pass finds it
+    assert [w["id"] for w in index.search(query, fuzzy=True)][:1] == [expected]
+
+
+def test_search_ranks_prefix_before_substring():
+    index = _index("Ocean Space", "Space Ocean", "Aerospace")
+    assert [w["title"] for w in index.search("space")] == ["Space Ocean", "Ocean Space", "Aerospace"]
+
+
+# ---------- cursors ----------
+
+def _cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def test_cursor_round_trip():
+    row = {"upload_date": "2025-03-01T12:30:00.123456", "id": "0f8fad5b-d9cb-469f-a165-70867728950e"}
+    assert vault.decode_cursor(vault.encode_cursor(row)) == (row["upload_date"], row["id"])
+
+
+def test_cursor_canonicalises_the_id():
+    upload_date, wid = vault.decode_cursor(_cursor(["2025-03-01", "{0F8FAD5B-D9CB-469F-A165-70867728950E}"]))
+    assert wid == "0f8fad5b-d9cb-469f-a165-70867728950e"
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    _cursor(["2025-03-01"]),
+    _cursor([20250301, "0f8fad5b-d9cb-469f-a165-70867728950e"]),
+    _cursor(['2025-03-01"),id.neq.x', "0f8fad5b-d9cb-469f-a165-70867728950e"]),
+    _cursor(["2025-03-01", 'x",or(id.gt.0']),
+])
+def test_cursor_rejects_malformed(cursor):
+    with pytest.raises(ValueError):
+        vault.decode_cursor(cursor)
+
+
+def test_offset_cursor_round_trip():
+    assert vault.decode_offset_cursor(vault.encode_offset_cursor(120)) == 120
+    with pytest.raises(ValueError):
+        vault.decode_offset_cursor(_cursor({"o": -1}))
+
+
+# ---------- RollingWindow ----------
+
+def test_rolling_window_expires_old_buckets():
+    window = vault.RollingWindow(60, 3)
+    now = 10_000.0
+    window.add(["a", "cat"], now - 30, now=now)
+    window.add(["a", "cat"], now - 150, now=now)
+    window.add(["b"], now, n=2, now=now)
+    assert window.totals["a"] == 2 and window.totals["b"] == 2
+    window.add(["b"], now + 120, now=now + 120)    # the event at -150s has left the window
+    assert window.totals["a"] == 1 and window.totals["cat"] == 1
+    assert window.totals["b"] == 3
+    window.add(["b"], now + 240, now=now + 240)
+    assert window.totals["a"] == 0 and window.totals["cat"] == 0
+    assert window.totals["b"] == 2
+
+
+def test_rolling_window_ignores_expired_and_future_events():
+    window = vault.RollingWindow(60, 3)
+    now = 10_000.0
+    window.add(["a"], now - 1_000, now=now)
+    window.add(["a"], now + 3_600, now=now)
+    assert window.totals["a"] == 0
+
+
+def test_rolling_window_remove():
+    window = vault.RollingWindow(60, 3)
+    now = 10_000.0
+    window.add(["a", "cat"], now, n=3, now=now)
+    window.add(["b", "cat"], now, n=1, now=now)
+    window.remove(["a", "cat"])
+    assert window.totals["a"] == 0 and window.totals["cat"] == 1
+
+
+# ---------- TopK ----------
+
+def test_topk_keeps_the_best():
+    top = vault.TopK(2)
+    for score, wid in [(5, "a"), (1, "b"), (9, "c"), (3, "d"), (7, "e")]:
+        top.offer((score, wid))
+    assert top.top(2) == ["c", "e"]
+
+
+def test_topk_raises_an_existing_entry():
+    top = vault.TopK(2)
+    top.offer((1, "a"))
+    top.offer((2, "b"))
+    top.offer((3, "a"))
+    assert top.top(2) == ["a", "b"]
+
+
+def test_topk_remove_asks_for_refill_after_evictions():
+    top = vault.TopK(1)
+    entries = [(score, str(score)) for score in range(4)]
+    for entry in entries:
+        top.offer(entry)
+    assert not top.remove("3")        # two kept, one left
+    assert top.remove("2")            # none left to back it up, and "1"/"0" were seen
+    top.refill([e for e in entries if e[1] not in ("2", "3")])
+    assert top.top(1) == ["1"]
+
+
+def test_topk_remove_without_evictions_needs_no_refill():
+    top = vault.TopK(2)
+    top.offer((1, "a"))
+    top.offer((2, "b"))
+    assert not top.remove("b")
+    assert top.top(2) == ["a"]
+
+
+def test_topk_rescale_keeps_order():
+    top = vault.TopK(3)
+    for score, wid in [(4.0, "a"), (2.0, "b"), (8.0, "c")]:
+        top.offer((score, wid))
+    top.rescale(0.25)
+    assert top.top(3) == ["c", "a", "b"]